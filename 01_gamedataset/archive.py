@@ -0,0 +1,116 @@
+import socket
+import logging
+import json
+import gzip
+import time
+import os
+
+# Kinds of responses that are archived, each in its own set of chunk files
+ARCHIVE_KINDS = ["appdetails", "appreviews"]
+
+# Size in bytes after which a chunk file is closed and a new one started
+CHUNK_BYTES = 64 * 1024 * 1024
+
+def get_archive_directory(db_file):
+    '''
+    Returns the default archive directory of a database, next to the database file.
+
+    Args:
+        db_file (str): The path to the SQLite database.
+
+    Returns:
+        str: The path of the archive directory, e.g. steam.db.archive
+    '''
+    return db_file + ".archive"
+
+class ArchiveWriter():
+    '''
+    Appends raw API responses to gzip compressed, append-only chunk files.
+
+    Every call to append writes one complete gzip member, so a chunk file is always readable up to
+    the last finished append, even if the scraper is killed while writing. Each writer only appends
+    to chunk files it created itself, so several scrapers can archive into the same directory.
+    '''
+    def __init__(self, directory, chunk_bytes = CHUNK_BYTES, compresslevel = 6):
+        '''
+        Args:
+            directory (str): The archive directory, created if it does not exist.
+            chunk_bytes (int): Size in bytes after which a new chunk file is started.
+            compresslevel (int): gzip compression level.
+        '''
+        self.directory = directory
+        self.chunk_bytes = chunk_bytes
+        self.compresslevel = compresslevel
+        self.writer_name = time.strftime("%Y%m%dT%H%M%S") + "-" + socket.gethostname() + "-" + str(os.getpid())
+        self.chunk_numbers = {}
+        self.files = {}
+
+        os.makedirs(directory, exist_ok = True)
+
+    def _get_file(self, kind):
+        f = self.files.get(kind)
+        if f is not None and f.tell() >= self.chunk_bytes:
+            f.close()
+            f = None
+
+        if f is None:
+            self.chunk_numbers[kind] = self.chunk_numbers.get(kind, -1) + 1
+            path = os.path.join(self.directory, kind + "-" + self.writer_name + "-" + str(self.chunk_numbers[kind]).zfill(5) + ".jsonl.gz")
+            logging.debug("Starting archive chunk " + path)
+            f = self.files[kind] = open(path, "ab")
+
+        return f
+
+    def append(self, kind, records):
+        '''
+        Appends records to the archive.
+
+        Args:
+            kind (str): One of ARCHIVE_KINDS.
+            records (list): A list of (appid, data) tuples, where data is the raw decoded response for the app.
+        '''
+        if len(records) == 0:
+            return
+
+        fetched = int(time.time())
+        lines = "".join(json.dumps({"appid": appid, "fetched": fetched, "data": data}) + "\n" for appid, data in records)
+
+        f = self._get_file(kind)
+        f.write(gzip.compress(lines.encode("utf-8"), compresslevel = self.compresslevel))
+        f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+def get_chunk_files(directory, kind):
+    '''
+    Returns the chunk files of one kind in an archive directory, oldest first.
+
+    Args:
+        directory (str): The archive directory.
+        kind (str): One of ARCHIVE_KINDS.
+
+    Returns:
+        list: Paths of the chunk files.
+    '''
+    names = [name for name in os.listdir(directory) if name.startswith(kind + "-") and name.endswith(".jsonl.gz")]
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+def iter_records(path):
+    '''
+    Yields the records of a chunk file, stopping at a truncated final gzip member.
+
+    Args:
+        path (str): The path of the chunk file.
+
+    Yields:
+        dict: Records with the appid, fetch time and raw data of a response.
+    '''
+    with gzip.open(path, "rt", encoding = "utf-8") as f:
+        try:
+            for line in f:
+                yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError):
+            logging.warning("Archive chunk " + path + " ends with a partial write, skipping the rest of it")
@@ -0,0 +1,98 @@
+'''
+Trains zstd dictionaries on an existing database and compresses its datajson and text columns in place.
+
+Safe to interrupt and re-run, only values that are still plain text are compressed.
+Once dictionaries exist, run.py compresses new rows as it writes them.
+
+Usage:
+    python compress_database.py --db steam.db --vacuum
+'''
+import sqlite_helpers
+import compression
+import tqdm
+import logging
+import click
+import os
+
+COLOR_DARK_GREY = "\x1b[38;5;240m"
+COLOR_BOLD = "\x1b[1m"
+COLOR_RESET = "\x1b[0m"
+LOGGING_FORMAT = COLOR_DARK_GREY + '[%(asctime)s - %(name)s]' + COLOR_RESET + COLOR_BOLD + ' %(levelname)s:' + COLOR_RESET + ' %(message)s'
+
+@click.command()
+@click.option('--db', required=True, help='Path to SQLite database to compress')
+@click.option('--retrain', is_flag=True, help='Train new dictionaries even for columns that already have one')
+@click.option('--samples', default=20000, help='Number of values to train each dictionary on')
+@click.option('--dict-size', default=112640, help='Maximum size of each dictionary in bytes')
+@click.option('--batch-size', default=5000, help='Number of rows to compress per transaction')
+@click.option('--vacuum', is_flag=True, help='Vacuum the database afterwards to return the freed space to the file system')
+@click.option('--verbose', is_flag=True, help='Print verbose output')
+def main(db, retrain, samples, dict_size, batch_size, vacuum, verbose):
+    logging.basicConfig(format = LOGGING_FORMAT, level = logging.INFO if not verbose else logging.DEBUG)
+
+    if not os.path.exists(db):
+        logging.error(f"Input SQLite database {db} does not exist")
+        exit(1)
+
+    conn = sqlite_helpers.create_connection(db)
+    if not sqlite_helpers.check_tables(conn):
+        sqlite_helpers.create_tables(conn)
+
+    compression.create_dictionary_table(conn)
+
+    codec = compression.load_codec(conn)
+    for column in compression.COMPRESSED_COLUMNS:
+        if retrain or not codec.has_dictionary(column):
+            compression.train_dictionary(conn, column, sample_count = samples, dict_size = dict_size)
+
+    # Reload, so compress_column uses the new dictionaries
+    codec = compression.register_functions(conn)
+
+    for column in compression.COMPRESSED_COLUMNS:
+        if codec.has_dictionary(column):
+            compress_column(conn, column, batch_size)
+
+    if vacuum:
+        logging.info("Vacuuming database")
+        conn.execute("VACUUM")
+
+    conn.close()
+
+def compress_column(conn, column, batch_size):
+    table, column_name = column.split(".")
+
+    c = conn.cursor()
+
+    c.execute(f'''
+        SELECT count(*) FROM {table} WHERE typeof({column_name}) = 'text'
+    ''')
+    bar = tqdm.tqdm(total = c.fetchone()[0], desc = "Compressing " + column, smoothing = 0.1)
+
+    # Walks the table in rowid order, so each batch is a short range scan
+    last_rowid = None
+    while True:
+        c.execute(f'''
+            SELECT rowid FROM {table}
+            WHERE typeof({column_name}) = 'text' AND rowid > ?
+            ORDER BY rowid
+            LIMIT ?
+        ''', (last_rowid if last_rowid is not None else -(2 ** 63), batch_size))
+        rowids = [rowid for (rowid,) in c.fetchall()]
+        if len(rowids) == 0:
+            break
+
+        with conn:
+            c.execute(f'''
+                UPDATE {table}
+                SET {column_name} = compress_column(?, {column_name})
+                WHERE rowid BETWEEN ? AND ? AND typeof({column_name}) = 'text'
+            ''', (column, rowids[0], rowids[-1]))
+
+        last_rowid = rowids[-1]
+        bar.update(len(rowids))
+
+    bar.close()
+    c.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import zstandard
+import threading
+import logging
+import time
+
+# Columns that are stored zstd compressed once compress_database.py has trained a dictionary for them.
+# Columns used in WHERE clauses (type, content_descriptors) stay plain text.
+COMPRESSED_COLUMNS = [
+    "gamelist.datajson",
+    "appdetails.datajson",
+    "appdetails.storedescription",
+    "appreviews.datajson",
+    "appreviews.review",
+]
+
+# Compression level of new values, dictionaries make low levels almost as small as high ones on short rows
+COMPRESSION_LEVEL = 9
+
+class ColumnCodec():
+    '''
+    Compresses and decompresses column values with zstd dictionaries trained on our own data.
+
+    Compressed values are stored as BLOBs holding a zstd frame whose header names the dictionary it was
+    compressed with, so values written before a dictionary existed (TEXT) or with an older dictionary
+    can always be read back. New values are compressed with the newest dictionary of their column.
+    '''
+    def __init__(self, dictionaries = [], level = COMPRESSION_LEVEL):
+        '''
+        Args:
+            dictionaries (list): (dict_id, column, dictionary) tuples, oldest first.
+            level (int): zstd compression level of new values.
+        '''
+        self.level = level
+        self.column_dictionaries = {}
+        self.id_dictionaries = {}
+        for dict_id, column, dictionary in dictionaries:
+            dictionary = zstandard.ZstdCompressionDict(dictionary)
+            self.column_dictionaries[column] = dictionary
+            self.id_dictionaries[dictionary.dict_id()] = dictionary
+
+        # zstd (de)compressors must not be shared between threads
+        self._local = threading.local()
+
+    def _compressor(self, column):
+        compressors = getattr(self._local, "compressors", None)
+        if compressors is None:
+            compressors = self._local.compressors = {}
+        compressor = compressors.get(column)
+        if compressor is None:
+            compressor = compressors[column] = zstandard.ZstdCompressor(level = self.level, dict_data = self.column_dictionaries[column])
+        return compressor
+
+    def _decompressor(self, dict_id):
+        decompressors = getattr(self._local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id == 0:
+                decompressor = zstandard.ZstdDecompressor()
+            elif dict_id in self.id_dictionaries:
+                decompressor = zstandard.ZstdDecompressor(dict_data = self.id_dictionaries[dict_id])
+            else:
+                raise ValueError("Unknown compression dictionary " + str(dict_id))
+            decompressors[dict_id] = decompressor
+        return decompressor
+
+    def has_dictionary(self, column):
+        return column in self.column_dictionaries
+
+    def compress(self, column, value):
+        '''
+        Compresses a text value for storage in a column.
+
+        Args:
+            column (str): The column, as table.column (e.g. appreviews.review).
+            value (str): The value to compress.
+
+        Returns:
+            The compressed value as bytes, or the value unchanged if it is not text or the column has no dictionary yet.
+        '''
+        if not isinstance(value, str) or column not in self.column_dictionaries:
+            return value
+        return self._compressor(column).compress(value.encode("utf-8"))
+
+    def decompress(self, value):
+        '''
+        Decompresses a stored column value.
+
+        Args:
+            value: A value read from a compressed column.
+
+        Returns:
+            str: The original text. Values that were never compressed are returned unchanged.
+        '''
+        if not isinstance(value, bytes):
+            return value
+        dict_id = zstandard.get_frame_parameters(value).dict_id
+        return self._decompressor(dict_id).decompress(value).decode("utf-8")
+
+def create_dictionary_table(conn):
+    '''
+    Creates the table holding the trained dictionaries.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+    '''
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS compression_dictionaries (
+            dict_id INTEGER PRIMARY KEY,
+            column_name TEXT NOT NULL,
+            dictionary BLOB NOT NULL,
+            created INTEGER NOT NULL
+        )
+    ''')
+
+    conn.commit()
+    c.close()
+
+def load_codec(conn):
+    '''
+    Creates a codec with every dictionary stored in the database.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Returns:
+        ColumnCodec: The codec, without dictionaries if none were trained yet.
+    '''
+    c = conn.cursor()
+
+    c.execute('''
+        SELECT count(name) FROM sqlite_master WHERE type='table' AND name='compression_dictionaries'
+    ''')
+    if c.fetchone()[0] == 0:
+        c.close()
+        return ColumnCodec()
+
+    c.execute('''
+        SELECT dict_id, column_name, dictionary FROM compression_dictionaries ORDER BY created ASC, rowid ASC
+    ''')
+    dictionaries = c.fetchall()
+
+    c.close()
+
+    return ColumnCodec(dictionaries)
+
+def register_functions(conn):
+    '''
+    Loads the codec of a database and makes it available to SQL on the connection as:
+        compress_column(column, value) - Compresses a value for storage in a column, e.g. in INSERT statements.
+        decompress_column(value) - Returns the original text of a stored value.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Returns:
+        ColumnCodec: The loaded codec.
+    '''
+    codec = load_codec(conn)
+    conn.create_function("compress_column", 2, codec.compress, deterministic = True)
+    conn.create_function("decompress_column", 1, codec.decompress, deterministic = True)
+    return codec
+
+def train_dictionary(conn, column, sample_count = 20000, dict_size = 112640):
+    '''
+    Trains a dictionary for a column on a random sample of its values, and stores it in the database.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        column (str): The column, as table.column (e.g. appreviews.review).
+        sample_count (int): The number of values to train on.
+        dict_size (int): Maximum size of the dictionary in bytes.
+
+    Returns:
+        int: The id of the new dictionary, or None if there was not enough data to train one.
+    '''
+    table, column_name = column.split(".")
+    logging.info("Training compression dictionary for " + column)
+
+    codec = load_codec(conn)
+    c = conn.cursor()
+
+    # Already compressed values are decompressed so retraining works on an existing database too
+    c.execute(f'''
+        SELECT {column_name} FROM {table}
+        WHERE {column_name} IS NOT NULL
+        ORDER BY random()
+        LIMIT ?
+    ''', (sample_count,))
+    samples = [codec.decompress(value).encode("utf-8") for (value,) in c.fetchall()]
+    samples = [sample for sample in samples if len(sample) > 0]
+
+    try:
+        dictionary = zstandard.train_dictionary(dict_size, samples, level = COMPRESSION_LEVEL)
+    except zstandard.ZstdError as e:
+        logging.warning("Not enough data to train a dictionary for " + column + " (" + str(len(samples)) + " samples): " + str(e))
+        c.close()
+        return None
+
+    c.execute('''
+        INSERT OR REPLACE INTO compression_dictionaries (dict_id, column_name, dictionary, created)
+        VALUES (?, ?, ?, ?)
+    ''', (dictionary.dict_id(), column, dictionary.as_bytes(), int(time.time())))
+
+    conn.commit()
+    c.close()
+
+    return dictionary.dict_id()
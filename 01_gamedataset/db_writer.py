@@ -0,0 +1,138 @@
+import sqlite_helpers
+import metrics
+import logging
+import time
+
+class BatchWriter():
+    '''
+    Buffers scraper results and writes them to the SQLite database in batches.
+
+    Each appid's data and its "updated" mark are always flushed in the same transaction,
+    so a crash can lose the most recent batch but never leaves an appid marked as updated
+    without the data that was fetched for it.
+    '''
+    def __init__(self, conn, batch_size = 100, flush_interval = 30.0, archive = None):
+        '''
+        Args:
+            conn (sqlite3.Connection): A connection to the SQLite database.
+            batch_size (int): Number of appids to buffer before flushing.
+            flush_interval (float): Maximum number of seconds to hold buffered results.
+            archive (archive.ArchiveWriter): Optional archive the raw responses are appended to before each flush.
+        '''
+        self.conn = conn
+        self.archive = archive
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._reset()
+
+    def _reset(self):
+        self.appdetails_rows = []
+        self.appdetails_updated = []
+        self.appdetails_failure_rows = []
+        self.appreview_rows = []
+        self.appreviews_updated = []
+        self.reviewsync_state_rows = []
+        self.finished_work_rows = {}
+        self.archive_records = {"appdetails": [], "appreviews": []}
+        self.last_flush = time.monotonic()
+
+    def pending_count(self):
+        return len(self.appdetails_updated) + len(self.appreviews_updated)
+
+    def add_appdetails(self, appid, appdetails, error = None):
+        '''
+        Buffers the details of a game, and marks its appdetails as updated.
+
+        Failures are recorded in appdetails_failures, which puts the app back in the work queue once its backoff ends.
+
+        Args:
+            appid (int): The appid of the game.
+            appdetails (dict): The details of the game, or None if they could not be fetched.
+            error (Exception): The error raised while fetching the details, if any.
+        '''
+        if appdetails is not None:
+            # Archived even if no row can be made from it, a later schema may handle it
+            self.archive_records["appdetails"].append((appid, appdetails))
+            try:
+                self.appdetails_rows.append(sqlite_helpers.get_appdetails_row(appid, appdetails))
+            except Exception as e:
+                logging.warning("Failed to insert app details for appid " + str(appid) + ". Skipping...")
+                error = e
+        elif error is None:
+            error = Exception("No details for appid " + str(appid))
+
+        if error is not None:
+            self.appdetails_failure_rows.append((appid, type(error).__name__))
+        self.appdetails_updated.append(appid)
+        self.flush_if_needed()
+
+    def add_appreviews(self, appid, appreviews, sync_state = None):
+        '''
+        Buffers the reviews of a game, and marks its appreviews as updated.
+
+        Args:
+            appid (int): The appid of the game.
+            appreviews (list): The reviews of the game, or None if they could not be fetched.
+            sync_state (tuple): Optional (watermark_timestamp, watermark_recommendationid) to store for the game.
+        '''
+        if appreviews is not None:
+            self.appreview_rows += sqlite_helpers.get_appreview_rows(appid, appreviews)
+            if len(appreviews) > 0:
+                self.archive_records["appreviews"].append((appid, appreviews))
+        if sync_state is not None:
+            self.reviewsync_state_rows.append((appid,) + tuple(sync_state))
+        self.appreviews_updated.append(appid)
+        self.flush_if_needed()
+
+    def finish_work(self, kind, appid, next_eligible):
+        '''
+        Buffers the release of a claimed appid back to the work queue. Written in the same transaction as its results.
+
+        Args:
+            kind (str): The kind of work, 'appdetails' or 'appreviews'.
+            appid (int): The appid of the game.
+            next_eligible (int): Unix time after which the appid may be claimed again, or None to remove it from the queue.
+        '''
+        self.finished_work_rows.setdefault(kind, []).append((appid, next_eligible))
+
+    def flush_if_needed(self):
+        if self.pending_count() >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes all buffered results to the database in a single transaction.
+        '''
+        if self.pending_count() == 0:
+            self.last_flush = time.monotonic()
+            return
+
+        logging.debug("Flushing " + str(self.pending_count()) + " appids to SQLite database")
+        start = time.perf_counter()
+
+        # Archived first, so the database never holds data the archive is missing.
+        # Rebuilding from the archive ignores duplicates left by a crash between the two.
+        if self.archive is not None:
+            for kind, records in self.archive_records.items():
+                self.archive.append(kind, records)
+        # Cleared right away, so retrying a failed transaction does not archive the same records again
+        self.archive_records = {"appdetails": [], "appreviews": []}
+
+        with self.conn:
+            sqlite_helpers.insert_appdetails_rows(self.conn, self.appdetails_rows)
+            sqlite_helpers.mark_appdetails_updated_many(self.conn, self.appdetails_updated)
+            sqlite_helpers.clear_appdetails_failure_rows(self.conn, [row[1] for row in self.appdetails_rows])
+            sqlite_helpers.insert_appreview_rows(self.conn, self.appreview_rows)
+            sqlite_helpers.mark_appreviews_updated_many(self.conn, self.appreviews_updated)
+            sqlite_helpers.update_reviewsync_state_rows(self.conn, self.reviewsync_state_rows)
+            for kind, rows in self.finished_work_rows.items():
+                sqlite_helpers.finish_work_rows(self.conn, kind, rows)
+            # After finish_work_rows, so failed apps are requeued with their backoff
+            sqlite_helpers.record_appdetails_failure_rows(self.conn, self.appdetails_failure_rows)
+
+        metrics.observe("sqlite_flush_seconds", time.perf_counter() - start)
+        metrics.increment("sqlite_appids_flushed_total", self.pending_count())
+        self._reset()
+
+    def close(self):
+        self.flush()
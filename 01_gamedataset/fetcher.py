@@ -0,0 +1,104 @@
+import concurrent.futures
+import threading
+import logging
+import queue
+
+# Sentinel appid a producer puts on the queue once it has finished
+PRODUCER_DONE = None
+
+def put_until_stopped(output_queue, item, stop_event):
+    '''
+    Puts an item on a bounded queue, giving up if the stop event is set while waiting for space.
+
+    Returns:
+        bool: True if the item was put on the queue, False if stopped.
+    '''
+    while not stop_event.is_set():
+        try:
+            output_queue.put(item, timeout = 1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def fetch_all(name, fetch_function, appids, output_queue, stop_event, max_workers = 4):
+    '''
+    Calls fetch_function for every appid on a thread pool, putting each result on the output queue as it completes.
+
+    Items put on the queue are tuples of (name, appid, result, error), where exactly one of result and error is set.
+    Once every appid has been fetched, (name, PRODUCER_DONE, None, None) is put on the queue.
+
+    Args:
+        name (str): Name of this producer, used to tell results apart on a shared queue.
+        fetch_function (callable): Function taking an appid and returning the fetched data.
+        appids (iterable): The appids to fetch. Only consumed as fast as the appids are fetched, so it may be a generator claiming work lazily.
+        output_queue (queue.Queue): Queue to put results on.
+        stop_event (threading.Event): When set, remaining appids are skipped.
+        max_workers (int): Maximum number of calls in flight at once.
+    '''
+    def fetch(appid):
+        if stop_event.is_set():
+            return
+        try:
+            item = (name, appid, fetch_function(appid), None)
+        except Exception as e:
+            logging.debug("Failed to fetch " + name + " for appid " + str(appid) + ": " + repr(e))
+            item = (name, appid, None, e)
+        put_until_stopped(output_queue, item, stop_event)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = name) as executor:
+        in_flight = set()
+        for appid in appids:
+            if stop_event.is_set():
+                break
+            if len(in_flight) >= max_workers * 2:
+                _, in_flight = concurrent.futures.wait(in_flight, return_when = concurrent.futures.FIRST_COMPLETED)
+            in_flight.add(executor.submit(fetch, appid))
+
+    put_until_stopped(output_queue, (name, PRODUCER_DONE, None, None), stop_event)
+
+def start_producer(name, fetch_function, appids, output_queue, stop_event, max_workers = 4):
+    '''
+    Starts fetch_all on a background thread.
+
+    Returns:
+        threading.Thread: The started producer thread.
+    '''
+    logging.debug("Starting " + name + " producer")
+    thread = threading.Thread(
+        target = fetch_all,
+        args = (name, fetch_function, appids, output_queue, stop_event, max_workers),
+        name = name + "-producer",
+        daemon = True)
+    thread.start()
+    return thread
+
+def consume(output_queue, producer_count, alive = None, on_idle = None):
+    '''
+    Yields results from the output queue until every producer has finished.
+
+    Args:
+        output_queue (queue.Queue): The queue shared by the producers, or a multiprocessing.Queue fed by worker processes.
+        producer_count (int): The number of producers feeding the queue.
+        alive (callable): Optional function returning False once the producers can no longer put anything on the queue,
+            e.g. because their worker processes exited. Stops waiting for producers that died without finishing.
+        on_idle (callable): Optional function called whenever no result arrived for a second, e.g. to flush buffered writes.
+
+    Yields:
+        tuple: (name, appid, result, error) for each fetched appid.
+    '''
+    finished = 0
+    while finished < producer_count:
+        try:
+            name, appid, result, error = output_queue.get(timeout = 1)
+        except queue.Empty:
+            if on_idle is not None:
+                on_idle()
+            if alive is not None and not alive():
+                logging.warning(str(producer_count - finished) + " producers exited without finishing")
+                return
+            continue
+        if appid is PRODUCER_DONE:
+            finished += 1
+            continue
+        yield name, appid, result, error
@@ -0,0 +1,171 @@
+import requests
+import requests.adapters
+import urllib3.util
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import threading
+import logging
+import codecs
+import time
+
+# Number of keep-alive connections to hold open per host.
+# Most calls go to the store, the app list is only fetched once per run.
+HOST_POOL_SIZES = {
+    "store.steampowered.com": 8,
+    "api.steampowered.com": 2,
+}
+DEFAULT_POOL_SIZE = 4
+
+# (connect, read) timeouts in seconds
+REQUEST_TIMEOUT = (10, 60)
+
+# Time spent opening connections on the current thread, filled in by the timed connection classes
+_connect_timing = threading.local()
+
+# Functions called with (endpoint, timings) after every request
+timing_hooks = []
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + time.perf_counter() - start
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + time.perf_counter() - start
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    '''
+    An HTTPAdapter whose connections record how long the TCP and TLS handshakes took.
+    '''
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+def create_session():
+    '''
+    Creates a requests session that keeps connections alive and asks for compressed responses.
+
+    Returns:
+        requests.Session: The new session.
+    '''
+    session = requests.Session()
+
+    # Only advertise encodings urllib3 can decode (br requires the brotli package)
+    session.headers.update(urllib3.util.make_headers(accept_encoding = True, keep_alive = True))
+
+    default_adapter = TimedHTTPAdapter(pool_connections = len(HOST_POOL_SIZES) + 1, pool_maxsize = DEFAULT_POOL_SIZE)
+    session.mount("http://", default_adapter)
+    session.mount("https://", default_adapter)
+
+    for host, pool_size in HOST_POOL_SIZES.items():
+        adapter = TimedHTTPAdapter(pool_connections = 1, pool_maxsize = pool_size)
+        session.mount("http://" + host + "/", adapter)
+        session.mount("https://" + host + "/", adapter)
+
+    return session
+
+session = create_session()
+
+def add_timing_hook(hook):
+    '''
+    Registers a function to be called after every request.
+
+    Args:
+        hook (callable): Called with (endpoint, timings), where timings is a dictionary with:
+            connect (float): Seconds spent opening a new connection (0 if one was reused).
+            ttfb (float): Seconds from sending the request until the response headers arrived, excluding connect.
+            download (float): Seconds spent reading the response body.
+            bytes (int): Size of the response body as transferred, before decompression.
+            status (int): The HTTP status code.
+    '''
+    timing_hooks.append(hook)
+
+def get(url, params = {}, endpoint = None):
+    '''
+    Performs a GET request on the shared session, reporting its timings to the registered hooks.
+
+    Args:
+        url (str): The url to request.
+        params (dict): Query parameters for the request.
+        endpoint (str): Name of the endpoint, passed to the timing hooks.
+
+    Returns:
+        requests.Response: The response, with its body already read.
+    '''
+    _connect_timing.seconds = 0.0
+
+    start = time.perf_counter()
+    response = session.get(url = url, params = params, stream = True, timeout = REQUEST_TIMEOUT)
+    headers_received = time.perf_counter()
+    response.content # Read the body
+    finished = time.perf_counter()
+
+    connect = _connect_timing.seconds
+    timings = {
+        "connect": connect,
+        "ttfb": headers_received - start - connect,
+        "download": finished - headers_received,
+        "bytes": response.raw.tell(),
+        "status": response.status_code,
+    }
+    logging.debug("Timings for " + str(endpoint) + ": " + str(timings))
+
+    for hook in timing_hooks:
+        hook(endpoint, timings)
+
+    return response
+
+def get_stream(url, params = {}, endpoint = None, chunk_size = 64 * 1024):
+    '''
+    Performs a GET request on the shared session without reading the body up front.
+
+    The timing hooks are called once the body has been read to the end.
+
+    Args:
+        url (str): The url to request.
+        params (dict): Query parameters for the request.
+        endpoint (str): Name of the endpoint, passed to the timing hooks.
+        chunk_size (int): Number of bytes to read at a time.
+
+    Returns:
+        tuple: (response, chunks), where chunks is an iterator over the decoded text of the body.
+    '''
+    _connect_timing.seconds = 0.0
+
+    start = time.perf_counter()
+    response = session.get(url = url, params = params, stream = True, timeout = REQUEST_TIMEOUT)
+    headers_received = time.perf_counter()
+    connect = _connect_timing.seconds
+
+    def chunks():
+        decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+        for chunk in response.iter_content(chunk_size = chunk_size):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final = True)
+
+        timings = {
+            "connect": connect,
+            "ttfb": headers_received - start - connect,
+            "download": time.perf_counter() - headers_received,
+            "bytes": response.raw.tell(),
+            "status": response.status_code,
+        }
+        logging.debug("Timings for " + str(endpoint) + ": " + str(timings))
+
+        for hook in timing_hooks:
+            hook(endpoint, timings)
+
+    return response, chunks()
@@ -0,0 +1,225 @@
+import functools
+import threading
+import logging
+import bisect
+import time
+import os
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Histogram():
+    '''
+    A thread-safe histogram with fixed buckets, in the shape Prometheus expects.
+    '''
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        '''
+        Args:
+            buckets (tuple): Sorted upper bounds of the buckets.
+        '''
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        '''
+        Estimates a quantile as the upper bound of the bucket it falls in.
+
+        Returns:
+            float: The estimated quantile, or None if nothing was observed.
+        '''
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = q * self.count
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+                cumulative += count
+                if cumulative >= rank:
+                    return bound
+            return float("inf")
+
+class MetricsRegistry():
+    '''
+    Holds the counters and histograms of one process, keyed by metric name and labels.
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.default_labels = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted({**self.default_labels, **labels}.items())))
+
+    def increment(self, name, amount = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def to_prometheus(self):
+        '''
+        Returns:
+            str: All metrics in the Prometheus text exposition format.
+        '''
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append("# TYPE " + name + " counter")
+                typed.add(name)
+            lines.append(name + _format_labels(labels) + " " + str(value))
+
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append("# TYPE " + name + " histogram")
+                typed.add(name)
+            with histogram.lock:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append(name + "_bucket" + _format_labels(labels + (("le", le),)) + " " + str(cumulative))
+                lines.append(name + "_sum" + _format_labels(labels) + " " + str(histogram.sum))
+                lines.append(name + "_count" + _format_labels(labels) + " " + str(histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        '''
+        Returns:
+            str: A human readable summary of all metrics, with per second rates over the lifetime of the registry.
+        '''
+        elapsed = max(time.time() - self.started, 1e-9)
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = ["Metrics summary over " + str(round(elapsed, 1)) + " seconds:"]
+        for (name, labels), histogram in histograms:
+            if histogram.count == 0:
+                continue
+            lines.append("  " + name + _format_labels(labels)
+                + ": count=" + str(histogram.count)
+                + " mean=" + str(round(histogram.sum / histogram.count, 3))
+                + " p50<=" + str(histogram.quantile(0.5))
+                + " p95<=" + str(histogram.quantile(0.95))
+                + " total=" + str(round(histogram.sum, 1)))
+        for (name, labels), value in counters:
+            lines.append("  " + name + _format_labels(labels) + ": " + str(value) + " (" + str(round(value / elapsed, 2)) + "/s)")
+
+        return "\n".join(lines)
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, value in labels) + "}"
+
+# Metrics of the current process
+registry = MetricsRegistry()
+
+def increment(name, amount = 1, **labels):
+    '''
+    Adds to a counter.
+
+    Args:
+        name (str): Name of the counter, e.g. steam_retries_total.
+        amount (float): The amount to add.
+        **labels: Labels of the counter, e.g. endpoint="appdetails".
+    '''
+    registry.increment(name, amount, **labels)
+
+def observe(name, value, **labels):
+    '''
+    Records a value in a histogram.
+
+    Args:
+        name (str): Name of the histogram, e.g. steam_request_seconds.
+        value (float): The value to record.
+        **labels: Labels of the histogram, e.g. endpoint="appdetails".
+    '''
+    registry.observe(name, value, **labels)
+
+def set_default_labels(**labels):
+    '''
+    Sets labels added to every metric of this process, e.g. process="worker-0".
+    '''
+    registry.default_labels = labels
+
+def timed(name, **labels):
+    '''
+    Decorator recording how long each call of a function takes in a histogram, whether it returns or raises.
+
+    Args:
+        name (str): Name of the histogram.
+        **labels: Labels of the histogram.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+def write_prometheus(path):
+    '''
+    Writes all metrics to a file in the Prometheus text format, e.g. for the node_exporter textfile collector.
+
+    The file is replaced atomically, so a scrape never sees a partial file.
+
+    Args:
+        path (str): The path of the file to write.
+    '''
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(registry.to_prometheus())
+    os.replace(temp_path, path)
+
+def start_exporter(path, interval = 15.0):
+    '''
+    Starts a background thread writing the metrics to a file every interval seconds.
+
+    Args:
+        path (str): The path of the file to write.
+        interval (float): Seconds between writes.
+
+    Returns:
+        threading.Event: Set it to stop the exporter.
+    '''
+    stop_event = threading.Event()
+
+    def export():
+        while not stop_event.wait(interval):
+            try:
+                write_prometheus(path)
+            except OSError as e:
+                logging.warning("Failed to write metrics to " + path + ": " + repr(e))
+
+    threading.Thread(target = export, name = "metrics-exporter", daemon = True).start()
+    return stop_event
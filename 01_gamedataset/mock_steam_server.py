@@ -0,0 +1,302 @@
+'''
+A local stand-in for the Steam API endpoints used by steamapi.py, for benchmarking the scraper offline.
+
+Serves GetAppList, appdetails and appreviews with generated data, or with responses replayed from a fixtures directory:
+    <fixtures>/applist.json           - A GetAppList response
+    <fixtures>/appdetails/<appid>.json - An appdetails response
+    <fixtures>/appreviews/<appid>.json - A list of reviews for the app, paged by the server
+
+Point the scraper at it with:
+    python mock_steam_server.py --port 8080
+    python run.py --db ./bench.db --new --api-base-url http://localhost:8080 --rate-limit 1000/1
+'''
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import threading
+import logging
+import random
+import click
+import json
+import gzip
+import time
+import os
+
+COLOR_DARK_GREY = "\x1b[38;5;240m"
+COLOR_BOLD = "\x1b[1m"
+COLOR_RESET = "\x1b[0m"
+LOGGING_FORMAT = COLOR_DARK_GREY + '[%(asctime)s - %(name)s]' + COLOR_RESET + COLOR_BOLD + ' %(levelname)s:' + COLOR_RESET + ' %(message)s'
+
+WORDS = ("adventure explore dungeon craft build survive story puzzle strategy combat roguelike open world "
+    "multiplayer co-op pixel art soundtrack relaxing challenging boss level upgrade character quest magic "
+    "sword space ship racing farm city management horror atmosphere narrative choices friends").split()
+
+class MockSteamData():
+    '''
+    Generates deterministic Steam API responses for a fake catalog, or loads them from recorded fixtures.
+    '''
+    def __init__(self, app_count = 1000, missing_rate = 0.1, seed = 0, fixtures = None):
+        self.app_count = app_count
+        self.missing_rate = missing_rate
+        self.seed = seed
+        self.fixtures = fixtures
+        self.known_appids = set(self.appids())
+
+    def _random(self, *key):
+        # Seeded from a string so the catalog is the same in every process
+        return random.Random(":".join(str(part) for part in (self.seed,) + key))
+
+    def _load_fixture(self, *path):
+        if self.fixtures is None:
+            return None
+        path = os.path.join(self.fixtures, *path)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _text(self, rng, word_count):
+        return " ".join(rng.choice(WORDS) for _ in range(word_count))
+
+    def app_list(self):
+        fixture = self._load_fixture("applist.json")
+        if fixture is not None:
+            return fixture
+
+        apps = [{"appid": appid, "name": "Mock Game " + str(appid)} for appid in self.appids()]
+        return {"applist": {"apps": apps}}
+
+    def appids(self):
+        return [10 * (i + 1) for i in range(self.app_count)]
+
+    def app_details(self, appid):
+        fixture = self._load_fixture("appdetails", str(appid) + ".json")
+        if fixture is not None:
+            return fixture
+
+        rng = self._random("appdetails", appid)
+        if appid not in self.known_appids or rng.random() < self.missing_rate:
+            # Delisted and region locked apps look like this
+            return {str(appid): {"success": False}}
+
+        # Store descriptions are mostly HTML, with a few images
+        paragraphs = []
+        for i in range(rng.randint(2, 12)):
+            paragraphs.append("<p>" + self._text(rng, rng.randint(30, 150)) + "</p>")
+            if rng.random() < 0.5:
+                paragraphs.append('<img src="https://shared.akamai.steamstatic.com/store_item_assets/steam/apps/' + str(appid) + '/extras/' + str(i) + '.gif" />')
+        description = "<h1>About This Game</h1>" + "<br>".join(paragraphs)
+
+        data = {
+            "type": "game" if rng.random() < 0.8 else "dlc",
+            "name": "Mock Game " + str(appid),
+            "steam_appid": appid,
+            "required_age": 0,
+            "is_free": rng.random() < 0.2,
+            "detailed_description": description,
+            "about_the_game": description,
+            "short_description": self._text(rng, 30),
+            "supported_languages": "English",
+            "header_image": "https://shared.akamai.steamstatic.com/store_item_assets/steam/apps/" + str(appid) + "/header.jpg",
+            "developers": ["Mock Studio " + str(rng.randint(1, 500))],
+            "publishers": ["Mock Publisher " + str(rng.randint(1, 100))],
+            "platforms": {"windows": True, "mac": rng.random() < 0.3, "linux": rng.random() < 0.2},
+            "categories": [{"id": i, "description": rng.choice(WORDS)} for i in range(rng.randint(1, 8))],
+            "genres": [{"id": str(i), "description": rng.choice(WORDS)} for i in range(rng.randint(1, 4))],
+            "screenshots": [{"id": i, "path_full": "https://shared.akamai.steamstatic.com/store_item_assets/steam/apps/" + str(appid) + "/ss_" + str(i) + ".jpg"} for i in range(rng.randint(3, 15))],
+            "release_date": {"coming_soon": False, "date": "1 Jan, 2020"},
+            "content_descriptors": {"ids": rng.sample([1, 2, 3, 4, 5], rng.choice([0, 0, 0, 1, 2])), "notes": None},
+        }
+        return {str(appid): {"success": True, "data": data}}
+
+    def reviews(self, appid):
+        fixture = self._load_fixture("appreviews", str(appid) + ".json")
+        if fixture is not None:
+            return fixture
+
+        rng = self._random("appreviews", appid)
+        if appid not in self.known_appids:
+            return []
+
+        # Most apps have a handful of reviews, a few have thousands
+        review_count = min(int(rng.paretovariate(0.8)) - 1, 5000)
+        now = 1700000000
+        reviews = []
+        for i in range(review_count):
+            created = now - rng.randint(0, 5 * 365 * 24 * 60 * 60)
+            reviews.append({
+                "recommendationid": str(appid * 100000 + i),
+                "author": {"steamid": str(76561197960265728 + rng.randint(0, 10 ** 9)), "num_games_owned": rng.randint(0, 2000), "num_reviews": rng.randint(1, 100), "playtime_forever": rng.randint(0, 100000)},
+                "language": "english",
+                "review": self._text(rng, int(rng.lognormvariate(3.5, 1.2)) + 1),
+                "timestamp_created": created,
+                "timestamp_updated": created,
+                "voted_up": rng.random() < 0.75,
+                "votes_up": int(rng.paretovariate(1.0)) - 1,
+                "votes_funny": int(rng.paretovariate(1.5)) - 1,
+                "weighted_vote_score": str(rng.random()),
+                "comment_count": 0,
+                "steam_purchase": True,
+                "received_for_free": False,
+                "written_during_early_access": False,
+            })
+        return reviews
+
+    def reviews_page(self, appid, filter, cursor, num_per_page):
+        reviews = self.reviews(appid)
+        if filter == "recent":
+            reviews = sorted(reviews, key = lambda review: review["timestamp_created"], reverse = True)
+        else:
+            reviews = sorted(reviews, key = lambda review: review["votes_up"], reverse = True)
+
+        # Cursors are opaque to the client, this one is just the offset
+        offset = 0 if cursor in (None, "*") else int(cursor[len("AoJ"):])
+        page = reviews[offset:offset + num_per_page]
+        return {
+            "success": 1,
+            "query_summary": {"num_reviews": len(page)},
+            "reviews": page,
+            "cursor": "AoJ" + str(offset + len(page)),
+        }
+
+class MockSteamServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, data, latency = 0.2, latency_sigma = 0.5, failure_rate = 0.0, throttle_rate = 0.0, rate_limit = None):
+        '''
+        Args:
+            address (tuple): (host, port) to listen on.
+            data (MockSteamData): The data to serve.
+            latency (float): Median response latency in seconds, drawn from a log-normal distribution.
+            latency_sigma (float): Shape of the latency distribution, larger values give a longer tail.
+            failure_rate (float): Fraction of requests answered with a 500 error.
+            throttle_rate (float): Fraction of requests answered with a 429 error, on top of the rate limit.
+            rate_limit (tuple): Optional (calls, period) enforced per endpoint, answering with 429 when exceeded.
+        '''
+        super().__init__(address, MockSteamRequestHandler)
+        self.data = data
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def over_rate_limit(self, endpoint):
+        '''
+        Counts a call against a fixed window per endpoint, like Steam does.
+
+        Returns:
+            int: Seconds until the window resets if the call is over the limit, otherwise None.
+        '''
+        if self.rate_limit is None:
+            return None
+
+        calls, period = self.rate_limit
+        now = time.monotonic()
+        with self.lock:
+            window_start, count = self.windows.get(endpoint, (now, 0))
+            if now - window_start >= period:
+                window_start, count = now, 0
+            count += 1
+            self.windows[endpoint] = (window_start, count)
+
+        if count > calls:
+            return int(period - (now - window_start)) + 1
+        return None
+
+class MockSteamRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        server = self.server
+
+        if url.path.startswith("/ISteamApps/GetAppList"):
+            endpoint = "applist"
+        elif url.path == "/api/appdetails":
+            endpoint = "appdetails"
+        elif url.path.startswith("/appreviews/"):
+            endpoint = "appreviews"
+        else:
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        time.sleep(random.lognormvariate(0, server.latency_sigma) * server.latency)
+
+        retry_after = server.over_rate_limit(endpoint)
+        if retry_after is None and random.random() < server.throttle_rate:
+            retry_after = random.randint(1, 30)
+        if retry_after is not None:
+            self.send_json(429, {"error": "Too Many Requests"}, headers = {"Retry-After": str(retry_after)})
+            return
+
+        if random.random() < server.failure_rate:
+            self.send_json(500, {"error": "Internal Server Error"})
+            return
+
+        if endpoint == "applist":
+            self.send_json(200, server.data.app_list())
+        elif endpoint == "appdetails":
+            self.send_json(200, server.data.app_details(int(query["appids"])))
+        else:
+            appid = int(url.path[len("/appreviews/"):])
+            self.send_json(200, server.data.reviews_page(appid, query.get("filter", "all"), query.get("cursor"), int(query.get("num_per_page", 20))))
+
+    def send_json(self, status, body, headers = {}):
+        body = json.dumps(body).encode()
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            body = gzip.compress(body)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(self.address_string() + " " + format % args)
+
+@click.command()
+@click.option('--host', default='localhost', help='Host to listen on')
+@click.option('--port', default=8080, help='Port to listen on')
+@click.option('--apps', default=1000, help='Number of apps in the generated catalog')
+@click.option('--missing-rate', default=0.1, help='Fraction of apps whose appdetails always fail')
+@click.option('--seed', default=0, help='Seed for the generated catalog')
+@click.option('--fixtures', default=None, help='Directory of recorded responses to replay instead of generated ones')
+@click.option('--latency', default=0.2, help='Median response latency in seconds')
+@click.option('--latency-sigma', default=0.5, help='Spread of the log-normal latency distribution')
+@click.option('--failure-rate', default=0.01, help='Fraction of requests that fail with a 500 error')
+@click.option('--throttle-rate', default=0.0, help='Fraction of requests that fail with a 429 error')
+@click.option('--rate-limit', default=None, help='Per endpoint rate limit to enforce, as CALLS/SECONDS (e.g. 200/300)')
+@click.option('--verbose', is_flag=True, help='Print verbose output')
+def main(host, port, apps, missing_rate, seed, fixtures, latency, latency_sigma, failure_rate, throttle_rate, rate_limit, verbose):
+    logging.basicConfig(format = LOGGING_FORMAT, level = logging.INFO if not verbose else logging.DEBUG)
+
+    if rate_limit is not None:
+        calls, period = rate_limit.split("/")
+        rate_limit = (int(calls), float(period))
+
+    data = MockSteamData(app_count = apps, missing_rate = missing_rate, seed = seed, fixtures = fixtures)
+    server = MockSteamServer((host, port), data,
+        latency = latency,
+        latency_sigma = latency_sigma,
+        failure_rate = failure_rate,
+        throttle_rate = throttle_rate,
+        rate_limit = rate_limit)
+
+    logging.info(f"Serving mock Steam API on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import collections
+import threading
+import logging
+import time
+
+# Outcomes of a call, reported to AdaptiveRateController.release
+SUCCESS = "success"
+THROTTLED = "throttled"
+TRANSIENT_ERROR = "transient_error"
+PERMANENT_ERROR = "permanent_error"
+
+class TokenBucket():
+    '''
+    A thread-safe token bucket rate limiter.
+
+    The refill rate is reduced by the burst size so that no window of `period` seconds
+    ever contains more than `calls` calls, even if the bucket starts out full.
+    '''
+    def __init__(self, name, calls, period, burst = 1):
+        '''
+        Args:
+            name (str): Name of the limiter, used for logging.
+            calls (int): Maximum number of calls allowed per period.
+            period (float): Length of the period in seconds.
+            burst (int): Number of calls that may be made back to back without waiting.
+        '''
+        if burst >= calls:
+            raise ValueError("Burst size must be smaller than the number of calls per period")
+
+        self.name = name
+        self.capacity = max(1, burst)
+        self.rate = (calls - burst) / period
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        # During a pause last_refill is the end of the pause, nothing refills before it
+        if now < self.last_refill:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def set_rate(self, rate):
+        '''
+        Changes the refill rate.
+
+        Args:
+            rate (float): The new number of calls allowed per second.
+        '''
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+    def pause(self, seconds):
+        '''
+        Blocks all calls for the given number of seconds, and empties the bucket.
+
+        Args:
+            seconds (float): How long to pause for.
+        '''
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.last_refill = self.paused_until
+
+    def acquire(self):
+        '''
+        Blocks until a call is allowed.
+
+        Returns:
+            float: The number of seconds spent waiting.
+        '''
+        waited = 0.0
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait_time = self.paused_until - now
+                else:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    wait_time = (1 - self.tokens) / self.rate
+
+            logging.debug("Rate limiter " + self.name + " waiting " + str(round(wait_time, 2)) + " seconds")
+            time.sleep(wait_time)
+            waited += wait_time
+
+class AdaptiveRateController():
+    '''
+    Adjusts the rate and concurrency of calls to one endpoint based on how the endpoint responds.
+
+    Rate and concurrency grow additively while calls succeed, and are halved when the endpoint
+    throttles us or the recent transient error rate gets too high. A throttled response also
+    pauses the endpoint for its Retry-After time.
+    '''
+    def __init__(self, name, calls, period, burst = 1, max_concurrency = 4, window = 50, max_error_rate = 0.2, default_retry_after = 60):
+        '''
+        Args:
+            name (str): Name of the endpoint, used for logging.
+            calls (int): Maximum number of calls allowed per period, the rate never goes above this.
+            period (float): Length of the period in seconds.
+            burst (int): Number of calls that may be made back to back without waiting.
+            max_concurrency (int): Maximum number of calls in flight at once.
+            window (int): Number of recent calls the error rate is measured over.
+            max_error_rate (float): Fraction of transient errors in the window that triggers a slow down.
+            default_retry_after (float): Seconds to pause for when throttled without a Retry-After header.
+        '''
+        self.name = name
+        self.calls = calls
+        self.period = period
+        self.burst = burst
+        self.bucket = TokenBucket(name, calls, period, burst = burst)
+        self.max_rate = self.bucket.rate
+        self.min_rate = self.max_rate / 16
+        self.rate = self.max_rate
+        self.max_concurrency = max_concurrency
+        self.concurrency = 1
+        self.max_error_rate = max_error_rate
+        self.default_retry_after = default_retry_after
+
+        self.outcomes = collections.deque(maxlen = window)
+        self.successes_since_change = 0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def set_max_concurrency(self, max_concurrency):
+        with self.condition:
+            self.max_concurrency = max_concurrency
+            self.concurrency = min(self.concurrency, max_concurrency)
+            self.condition.notify_all()
+
+    def acquire(self):
+        '''
+        Blocks until a concurrency slot is free and the rate limit allows a call.
+        Must be paired with a call to release.
+
+        Returns:
+            float: The number of seconds spent waiting.
+        '''
+        start = time.monotonic()
+        with self.condition:
+            while self.in_flight >= self.concurrency:
+                self.condition.wait()
+            self.in_flight += 1
+
+        self.bucket.acquire()
+        return time.monotonic() - start
+
+    def release(self, outcome, retry_after = None):
+        '''
+        Frees the concurrency slot taken by acquire, and adapts to the outcome of the call.
+
+        Args:
+            outcome (str): One of SUCCESS, THROTTLED, TRANSIENT_ERROR or PERMANENT_ERROR.
+            retry_after (float): The Retry-After time of a throttled response, if it had one.
+        '''
+        with self.condition:
+            self.in_flight -= 1
+            self.outcomes.append(outcome)
+
+            if outcome == THROTTLED:
+                retry_after = retry_after if retry_after is not None else self.default_retry_after
+                logging.warning("Endpoint " + self.name + " throttled, pausing for " + str(retry_after) + " seconds")
+                self.bucket.pause(retry_after)
+                self._slow_down()
+            elif outcome == TRANSIENT_ERROR:
+                if self.error_rate() > self.max_error_rate:
+                    self._slow_down()
+            else:
+                # A permanent error is still a healthy response from the endpoint
+                self.successes_since_change += 1
+                if self.successes_since_change >= self.outcomes.maxlen // 5:
+                    self._speed_up()
+
+            self.condition.notify_all()
+
+    def error_rate(self):
+        '''
+        Returns:
+            float: The fraction of recent calls that were throttled or failed transiently.
+        '''
+        if len(self.outcomes) == 0:
+            return 0.0
+        errors = sum(1 for outcome in self.outcomes if outcome in (THROTTLED, TRANSIENT_ERROR))
+        return errors / len(self.outcomes)
+
+    def _slow_down(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.concurrency = max(1, self.concurrency // 2)
+        self.bucket.set_rate(self.rate)
+        self.successes_since_change = 0
+        self.outcomes.clear()
+        logging.debug("Endpoint " + self.name + " slowed down to " + str(round(self.rate, 3)) + " calls/s, concurrency " + str(self.concurrency))
+
+    def _speed_up(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 8)
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        self.bucket.set_rate(self.rate)
+        self.successes_since_change = 0
+        logging.debug("Endpoint " + self.name + " sped up to " + str(round(self.rate, 3)) + " calls/s, concurrency " + str(self.concurrency))
@@ -0,0 +1,94 @@
+'''
+Rebuilds the appdetails and appreviews tables from the raw response archive written by run.py,
+so a change to the extracted columns only needs a local rebuild instead of a re-scrape.
+
+Only the rows found in the archive are rewritten, rows scraped before the archive existed or with --no-archive are kept.
+--replace-all also deletes them, so the tables hold exactly what the archive holds.
+
+Usage:
+    python rebuild_from_archive.py --db steam.db [--replace-all]
+'''
+import sqlite_helpers
+import archive
+import tqdm
+import logging
+import click
+import os
+
+COLOR_DARK_GREY = "\x1b[38;5;240m"
+COLOR_BOLD = "\x1b[1m"
+COLOR_RESET = "\x1b[0m"
+LOGGING_FORMAT = COLOR_DARK_GREY + '[%(asctime)s - %(name)s]' + COLOR_RESET + COLOR_BOLD + ' %(levelname)s:' + COLOR_RESET + ' %(message)s'
+
+@click.command()
+@click.option('--db', required=True, help='Path to SQLite database to rebuild')
+@click.option('--archive-dir', default=None, help='Archive directory to read (default: next to the database)')
+@click.option('--tables', type=click.Choice(['all', 'appdetails', 'appreviews']), default='all', help='Tables to rebuild')
+@click.option('--replace-all', is_flag=True, help='Delete the rows the archive does not cover, instead of keeping them')
+@click.option('--verbose', is_flag=True, help='Print verbose output')
+def main(db, archive_dir, tables, replace_all, verbose):
+    logging.basicConfig(format = LOGGING_FORMAT, level = logging.INFO if not verbose else logging.DEBUG)
+
+    if not os.path.exists(db):
+        logging.error(f"Input SQLite database {db} does not exist")
+        exit(1)
+
+    archive_dir = archive_dir if archive_dir is not None else archive.get_archive_directory(db)
+    if not os.path.isdir(archive_dir):
+        logging.error(f"Archive directory {archive_dir} does not exist")
+        exit(1)
+
+    conn = sqlite_helpers.create_connection(db)
+    if not sqlite_helpers.check_tables(conn):
+        sqlite_helpers.create_tables(conn)
+
+    # The rebuild is one transaction, a crash rolls it back, so the journal does not need to be synced
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA cache_size=-262144')
+
+    kinds = [kind for kind in ["appdetails", "appreviews"] if tables in ["all", kind]]
+    chunk_files = {kind: archive.get_chunk_files(archive_dir, kind) for kind in kinds}
+
+    # Replacing a table with an empty archive would only delete it
+    if replace_all and any(len(chunk_files[kind]) == 0 for kind in kinds):
+        logging.error("The archive has no " + " or ".join(kind for kind in kinds if len(chunk_files[kind]) == 0) + " chunks, refusing to replace the tables with it")
+        exit(1)
+
+    if "appdetails" in kinds:
+        skipped = []
+        logging.info("Rebuilding appdetails from " + str(len(chunk_files["appdetails"])) + " archive chunks")
+        row_count, uncovered_count = sqlite_helpers.rebuild_appdetails(conn, iter_appdetails_rows(chunk_files["appdetails"], skipped), replace_all = replace_all)
+        logging.info("Loaded " + str(row_count) + " appdetails rows, skipped " + str(len(skipped)) + " responses without details")
+        log_uncovered_rows("appdetails", uncovered_count, replace_all)
+
+    if "appreviews" in kinds:
+        logging.info("Rebuilding appreviews from " + str(len(chunk_files["appreviews"])) + " archive chunks")
+        row_count, uncovered_count = sqlite_helpers.rebuild_appreviews(conn, iter_appreview_rows(chunk_files["appreviews"]), replace_all = replace_all)
+        logging.info("Loaded " + str(row_count) + " appreviews rows")
+        log_uncovered_rows("appreviews", uncovered_count, replace_all)
+
+    conn.close()
+
+def log_uncovered_rows(table, uncovered_count, replace_all):
+    if uncovered_count == 0:
+        return
+    if replace_all:
+        logging.warning("Deleted " + str(uncovered_count) + " " + table + " rows the archive does not cover")
+    else:
+        logging.warning("Kept " + str(uncovered_count) + " " + table + " rows the archive does not cover, they were not rebuilt")
+
+def iter_appdetails_rows(chunk_files, skipped):
+    for path in tqdm.tqdm(chunk_files, desc = "Reading appdetails archive"):
+        for record in archive.iter_records(path):
+            try:
+                yield sqlite_helpers.get_appdetails_row(record["appid"], record["data"])
+            except Exception:
+                skipped.append(record["appid"])
+
+def iter_appreview_rows(chunk_files):
+    for path in tqdm.tqdm(chunk_files, desc = "Reading appreviews archive"):
+        for record in archive.iter_records(path):
+            yield from sqlite_helpers.get_appreview_rows(record["appid"], record["data"])
+
+if __name__ == "__main__":
+    main()
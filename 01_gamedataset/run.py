@@ -1,29 +1,97 @@
-from steamapi import get_game_list, get_app_details, get_n_reviews
+from steamapi import iter_game_list, get_app_details, get_n_reviews, get_new_reviews, PermanentFetchError
+import steamapi
 import sqlite_helpers
+import fetcher
+import metrics
+from db_writer import BatchWriter
+from archive import ArchiveWriter
+from work_leases import WorkLeases
+import archive
+import multiprocessing
+import threading
+import queue
 import tqdm
 import logging
 import click
 import os
+import socket
+import signal
+import time
 
 COLOR_DARK_GREY = "\x1b[38;5;240m"
 COLOR_BOLD = "\x1b[1m"
 COLOR_RESET = "\x1b[0m"
 LOGGING_FORMAT = COLOR_DARK_GREY + '[%(asctime)s - %(name)s]' + COLOR_RESET + COLOR_BOLD + ' %(levelname)s:' + COLOR_RESET + ' %(message)s'
 
+# Seconds before an appid goes back into the work queue.
+# Apps whose details fail are backed off exponentially by sqlite_helpers.record_appdetails_failure_rows.
+REVIEWS_RETRY_DELAY = 24 * 60 * 60
+REVIEWS_REFRESH_DELAY = 24 * 60 * 60
+
+# Seconds between app list refreshes in daemon mode
+GAME_LIST_REFRESH_INTERVAL = 24 * 60 * 60
+
+# Seconds a daemon waits before polling an empty work queue again
+WORK_POLL_INTERVAL = 60
+
+# Seconds claimed appids stay leased, the leases are renewed until the appids are finished
+WORK_LEASE_SECONDS = 600
+
+# Work queue kind of each producer
+WORK_KINDS = {
+    "details": "appdetails",
+    "reviews": "appreviews",
+}
+
 @click.command()
 @click.option('--db', required=True, help='Path to SQLite database to open (or create with --new)')
 @click.option('--new', is_flag=True, help='Create a new database instead of updating an existing one')
 @click.option('--limit', default=5000, help='Limit the number of appids to update')
 @click.option('--update-all', is_flag=True, help='Ignore limit, update all appids')
 @click.option('--update-type', default='all', help='Type of appids to update (all, details, reviews)')
+@click.option('--workers', default=4, help='Maximum number of concurrent API calls per endpoint')
+@click.option('--processes', default=1, help='Number of worker processes claiming appids from the shared work queue')
+@click.option('--shard', default=None, help='Only update appids in this shard, as INDEX/COUNT (e.g. 0/4), to split the work between hosts')
+@click.option('--batch-size', default=100, help='Number of appids to write to the database per transaction')
+@click.option('--review-sync', type=click.Choice(['incremental', 'full']), default='incremental', help='Only fetch reviews newer than the last sync, or always fetch the most helpful reviews')
+@click.option('--api-base-url', default=None, help='Send API calls to this server instead of Steam (e.g. a local mock_steam_server.py)')
+@click.option('--rate-limit', default=None, help='Override the per endpoint rate limit, as CALLS/SECONDS (e.g. 200/300)')
+@click.option('--daemon', is_flag=True, help='Keep running, refreshing the app list and working through the work queue as appids become due, until SIGTERM')
+@click.option('--daily-budget', default=None, type=int, help='Maximum number of API calls per day across all endpoints, spread evenly over the day')
+@click.option('--archive-dir', default=None, help='Directory to append raw API responses to (default: next to the database)')
+@click.option('--no-archive', is_flag=True, help='Do not archive raw API responses')
+@click.option('--metrics-file', default=None, help='Periodically write scraper metrics to this file in the Prometheus text format (e.g. steam.prom)')
 @click.option('--verbose', is_flag=True, help='Print verbose output')
-def main(db, new, limit, update_all, update_type, verbose):
+def main(db, new, limit, update_all, update_type, workers, processes, shard, batch_size, review_sync, api_base_url, rate_limit, daemon, daily_budget, archive_dir, no_archive, metrics_file, verbose):
     logging.basicConfig(format = LOGGING_FORMAT, level = logging.INFO if not verbose else logging.DEBUG)
+
+    if api_base_url is not None:
+        steamapi.set_base_url(api_base_url)
+
+    if rate_limit is not None:
+        calls, period = rate_limit.split("/")
+        steamapi.set_rate_limit(int(calls), float(period))
+
+    steamapi.set_max_concurrency(workers)
+
+    if daily_budget is not None:
+        steamapi.set_daily_budget(daily_budget)
     
     if update_type not in ["all", "details", "reviews"]:
         logging.error("Invalid update type. Must be one of: all, details, reviews")
         exit(1)
 
+    if shard is not None:
+        shard_index, shard_count = [int(part) for part in shard.split("/")]
+        if not 0 <= shard_index < shard_count:
+            logging.error("Invalid shard. Must be INDEX/COUNT with 0 <= INDEX < COUNT")
+            exit(1)
+        shard = (shard_index, shard_count)
+
+    if daemon and processes > 1:
+        logging.error("Daemon mode runs in a single process, use --workers for concurrency")
+        exit(1)
+
     # Create SQLite database
     if new:
         if os.path.exists(db):
@@ -40,64 +108,246 @@ def main(db, new, limit, update_all, update_type, verbose):
         if not sqlite_helpers.check_tables(conn):
             sqlite_helpers.create_tables(conn)
 
-    # Update game list
-    gamelist = get_game_list()
-    known_appids = set(sqlite_helpers.get_known_appids(conn))
-    new_gamelist = [game for game in gamelist if game["appid"] not in known_appids]
-    logging.info("Found " + str(len(new_gamelist)) + " new games on Steam.")
-    sqlite_helpers.insert_gamelist(conn, new_gamelist)
+    if metrics_file is not None:
+        exporter_stop_event = metrics.start_exporter(metrics_file)
 
-    if update_all:
-        limit = len(gamelist)
+    update_game_list(conn)
 
-    appids_to_update_details = sqlite_helpers.get_appdetails_to_update(conn, count = limit)
-    
-    # Update app details
-    if update_type == "all" or update_type == "details":
-        bar = tqdm.tqdm(appids_to_update_details, desc = "Updating app details", smoothing = 0.0)
-        for appid in bar:
-            bar.set_postfix(appid=str(appid))
-            try:
-                appdetails = get_app_details(appid)
-                sqlite_helpers.insert_appdetails(conn, appid, appdetails)
-            except KeyboardInterrupt:
-                raise
-            except:
-                logging.warning("Failed to get app details for appid " + str(appid) + ". Skipping...")
-                continue
-            finally:
-                sqlite_helpers.mark_appdetails_updated(conn, appid)
-
-
-    # Update app reviews
-    if update_type == "all" or update_type == "reviews":
-        appids_to_update_reviews = sqlite_helpers.get_appreviews_to_update(conn, output_count = limit)
-
-        bar = tqdm.tqdm(appids_to_update_reviews, desc = "Getting app reviews", smoothing = 0.0)
-        last_appid = None
-        last_appreviews_count = None
-
-        for appid in bar:
-            if last_appid is not None:
-                bar.set_postfix(appid=str(last_appid), reviews=str(last_appreviews_count))
-            
-            last_appid = appid
-            last_appreviews_count = None
-
-            try:
-                known_reviews = sqlite_helpers.get_appreview_recommendationids(conn, appid)
-                appreviews = get_n_reviews(appid, n = 500)
-                new_appreviews = [review for review in appreviews if int(review["recommendationid"]) not in known_reviews]
-                logging.debug("Found " + str(len(new_appreviews)) + " new reviews for appid " + str(appid) + ".")
-                sqlite_helpers.insert_appreviews(conn, appid, new_appreviews)
-                last_appreviews_count = len(new_appreviews)
-            finally:
-                sqlite_helpers.mark_appreviews_updated(conn, appid)
-
-                if last_appreviews_count is None:
-                    last_appreviews_count = 'Failed'
+    if update_all or daemon:
+        limit = None
+
+    # In daemon mode SIGTERM stops claiming new appids, the ones in flight are still fetched and written
+    shutdown_event = None
+    if daemon:
+        shutdown_event = threading.Event()
+        def shutdown(signum, frame):
+            logging.info("Received signal " + str(signum) + ", shutting down after the appids in flight")
+            shutdown_event.set()
+        signal.signal(signal.SIGTERM, shutdown)
+
+        threading.Thread(target = refresh_game_list_periodically, args = (db, GAME_LIST_REFRESH_INTERVAL, shutdown_event), name = "gamelist-refresh", daemon = True).start()
+
+    kinds = [kind for kind in ["details", "reviews"] if update_type in ["all", kind]]
+
+    # Fetch app details and app reviews concurrently, writing results as they arrive.
+    # Appids are claimed from the work queue in small batches as the fetchers need them.
+    bars = {}
+    for kind in kinds:
+        description = "Updating app details" if kind == "details" else "Getting app reviews"
+        bars[kind] = tqdm.tqdm(total = count_work(conn, WORK_KINDS[kind], limit, shard) if not daemon else None, desc = description, smoothing = 0.0, position = len(bars))
+
+    if processes > 1:
+        # Each worker process claims its own appids and has its own rate limiters, this process is the only writer
+        context = multiprocessing.get_context("spawn")
+        output_queue = context.Queue(maxsize = 100)
+        stop_event = context.Event()
+        worker_processes = []
+        for index in range(processes):
+            worker_limit = None if limit is None else limit // processes + (1 if index < limit % processes else 0)
+            worker_process = context.Process(
+                target = run_worker,
+                args = (db, kinds, worker_limit, shard, workers, processes, review_sync, api_base_url, rate_limit, daily_budget, metrics_file, verbose, output_queue, stop_event),
+                name = "worker-" + str(index))
+            worker_process.start()
+            worker_processes.append(worker_process)
+
+        producer_count = processes * len(kinds)
+        alive = lambda: any(worker_process.is_alive() for worker_process in worker_processes)
+    else:
+        output_queue = queue.Queue(maxsize = 100)
+        stop_event = threading.Event()
+        worker_processes = []
+        start_producers(db, kinds, limit, shard, workers, review_sync, output_queue, stop_event, shutdown_event = shutdown_event)
+        producer_count = len(kinds)
+        alive = None
+
+    response_archive = None
+    if not no_archive:
+        response_archive = ArchiveWriter(archive_dir if archive_dir is not None else archive.get_archive_directory(db))
+    writer = BatchWriter(conn, batch_size = batch_size, archive = response_archive)
+
+    try:
+        for name, appid, result, error in fetcher.consume(output_queue, producer_count, alive = alive, on_idle = writer.flush_if_needed):
+            if name == "details":
+                write_appdetails(writer, appid, result, error)
+                bars[name].set_postfix(appid=str(appid))
+            else:
+                new_appreviews_count = write_appreviews(writer, appid, result, error)
+                bars[name].set_postfix(appid=str(appid), reviews=str(new_appreviews_count) if new_appreviews_count is not None else 'Failed')
+            bars[name].update(1)
+    finally:
+        stop_event.set()
+        writer.close()
+        if response_archive is not None:
+            response_archive.close()
+        for bar in bars.values():
+            bar.close()
+        for worker_process in worker_processes:
+            worker_process.join(timeout = 10)
+            if worker_process.is_alive():
+                # Its claimed appids are picked up again once their leases expire
+                worker_process.terminate()
+
+        if metrics_file is not None:
+            exporter_stop_event.set()
+            metrics.write_prometheus(metrics_file)
+        logging.info(metrics.registry.summary())
 
     conn.close()
 
+def update_game_list(conn):
+    # Diffs the app list against the database as it is downloaded
+    new_count, total_count = sqlite_helpers.insert_gamelist_stream(conn, iter_game_list())
+    logging.info("Found " + str(total_count) + " games in steam app list.")
+    logging.info("Found " + str(new_count) + " new games on Steam.")
+
+def refresh_game_list_periodically(db, interval, shutdown_event):
+    conn = sqlite_helpers.get_thread_connection(db)
+    while not shutdown_event.wait(interval):
+        try:
+            update_game_list(conn)
+        except Exception as e:
+            logging.warning("Failed to refresh game list, retrying in " + str(interval) + " seconds: " + repr(e))
+
+def start_producers(db, kinds, limit, shard, workers, review_sync, output_queue, stop_event, shutdown_event = None):
+    owner = socket.gethostname() + ":" + str(os.getpid())
+    producers = []
+
+    def claim(kind):
+        # Renewed until the process exits, so appids waiting to be fetched or written keep their leases
+        leases = WorkLeases(db, kind, owner, lease_seconds = WORK_LEASE_SECONDS)
+        leases.start()
+        if shutdown_event is not None:
+            return claim_work_continuously(db, kind, owner, shard, workers, leases, shutdown_event)
+        return claim_work_lazily(db, kind, owner, limit, shard, leases)
+
+    if "details" in kinds:
+        appids_to_update_details = claim("appdetails")
+        producers.append(fetcher.start_producer("details", get_app_details, appids_to_update_details, output_queue, stop_event, max_workers = workers))
+
+    if "reviews" in kinds:
+        appids_to_update_reviews = claim("appreviews")
+        producers.append(fetcher.start_producer("reviews", lambda appid: fetch_appreviews(db, appid, review_sync), appids_to_update_reviews, output_queue, stop_event, max_workers = workers))
+
+    return producers
+
+def run_worker(db, kinds, limit, shard, workers, processes, review_sync, api_base_url, rate_limit, daily_budget, metrics_file, verbose, output_queue, stop_event):
+    # Entry point of a worker process started by main with --processes
+    logging.basicConfig(format = LOGGING_FORMAT, level = logging.INFO if not verbose else logging.DEBUG)
+
+    # Each worker exports its own metrics next to the main file, labelled with the worker name
+    worker_name = multiprocessing.current_process().name
+    metrics.set_default_labels(process = worker_name)
+    if metrics_file is not None:
+        root, extension = os.path.splitext(metrics_file)
+        worker_metrics_file = root + "." + worker_name + extension
+        exporter_stop_event = metrics.start_exporter(worker_metrics_file)
+
+    if api_base_url is not None:
+        steamapi.set_base_url(api_base_url)
+
+    if rate_limit is not None:
+        calls, period = rate_limit.split("/")
+        steamapi.set_rate_limit(int(calls), float(period))
+
+    # The workers call from the same address, so they split the rate limits and the daily budget between them
+    steamapi.share_rate_limits(processes)
+    steamapi.set_max_concurrency(workers)
+
+    if daily_budget is not None:
+        steamapi.set_daily_budget(max(2, daily_budget // processes))
+
+    try:
+        for producer in start_producers(db, kinds, limit, shard, workers, review_sync, output_queue, stop_event):
+            producer.join()
+    except KeyboardInterrupt:
+        stop_event.set()
+    finally:
+        if metrics_file is not None:
+            exporter_stop_event.set()
+            metrics.write_prometheus(worker_metrics_file)
+        logging.info(worker_name + " " + metrics.registry.summary())
+
+def claim_work_lazily(db, kind, owner, limit, shard, leases):
+    # Iterated on the producer thread, so it claims through that thread's own connection.
+    # Appids can wait for a fetch slot longer than a lease, so leases keeps renewing them and drops the ones lost anyway.
+    conn = sqlite_helpers.get_thread_connection(db)
+    for appid in sqlite_helpers.iter_claimed_work(conn, kind, owner, lease_seconds = leases.lease_seconds, limit = limit, shard = shard, on_claim = leases.add):
+        if leases.holds(appid):
+            yield appid
+
+def claim_work_continuously(db, kind, owner, shard, batch_size, leases, shutdown_event):
+    # Like claim_work_lazily, but waits for appids to become due instead of stopping at an empty queue
+    conn = sqlite_helpers.get_thread_connection(db)
+    while not shutdown_event.is_set():
+        appids = sqlite_helpers.claim_work(conn, kind, owner, count = batch_size, lease_seconds = leases.lease_seconds, shard = shard)
+        leases.add(appids)
+        if len(appids) == 0:
+            shutdown_event.wait(WORK_POLL_INTERVAL)
+        for appid in appids:
+            if shutdown_event.is_set():
+                # Leave the rest to a later run, their leases expire on their own once renewal stops
+                return
+            if leases.holds(appid):
+                yield appid
+
+def count_work(conn, kind, limit, shard):
+    count = sqlite_helpers.count_eligible_work(conn, kind, shard = shard)
+    return count if limit is None else min(count, limit)
+
+def write_appdetails(writer, appid, appdetails, error):
+    if isinstance(error, PermanentFetchError):
+        logging.debug("No app details for appid " + str(appid) + ". Backing off...")
+    elif error is not None:
+        logging.warning("Failed to get app details for appid " + str(appid) + ". Skipping...")
+    else:
+        writer.finish_work("appdetails", appid, None)
+
+    writer.add_appdetails(appid, appdetails, error = error)
+
+def fetch_appreviews(db, appid, review_sync):
+    # Runs on a fetch thread, so it reads through that thread's own connection
+    conn = sqlite_helpers.get_thread_connection(db)
+    known_reviews = sqlite_helpers.get_appreview_recommendationids(conn, appid)
+    sync_state = sqlite_helpers.get_reviewsync_state(conn, appid)
+
+    if review_sync == "incremental" and (sync_state is not None or len(known_reviews) > 0):
+        # Newest first, stopping at the first review we already have
+        watermark_timestamp = sync_state["watermark_timestamp"] if sync_state is not None else None
+        appreviews = get_new_reviews(appid, known_reviews, watermark_timestamp = watermark_timestamp, n = 500)
+    else:
+        # First sync for this app, start from the most helpful reviews
+        watermark_timestamp = None
+        appreviews = get_n_reviews(appid, n = 500)
+
+    new_appreviews = [review for review in appreviews if int(review["recommendationid"]) not in known_reviews]
+    logging.debug("Found " + str(len(new_appreviews)) + " new reviews for appid " + str(appid) + ".")
+
+    # Keep the previous watermark if nothing newer was found
+    watermark_recommendationid = sync_state["watermark_recommendationid"] if sync_state is not None else None
+    for review in new_appreviews:
+        if watermark_timestamp is None or review["timestamp_created"] > watermark_timestamp:
+            watermark_timestamp = review["timestamp_created"]
+            watermark_recommendationid = int(review["recommendationid"])
+
+    review_count = len(known_reviews) + len(new_appreviews)
+    return new_appreviews, (watermark_timestamp, watermark_recommendationid), review_count
+
+def write_appreviews(writer, appid, result, error):
+    if error is not None:
+        logging.warning("Failed to get app reviews for appid " + str(appid) + ". Skipping...")
+        writer.finish_work("appreviews", appid, int(time.time()) + REVIEWS_RETRY_DELAY)
+        writer.add_appreviews(appid, None)
+        return None
+
+    new_appreviews, sync_state, review_count = result
+    if review_count >= sqlite_helpers.MINIMUM_REVIEW_COUNT:
+        writer.finish_work("appreviews", appid, None)
+    else:
+        writer.finish_work("appreviews", appid, int(time.time()) + REVIEWS_REFRESH_DELAY)
+
+    writer.add_appreviews(appid, new_appreviews, sync_state = sync_state)
+    return len(new_appreviews)
+
 if __name__ == "__main__":
     main()
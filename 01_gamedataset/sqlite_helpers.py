@@ -2,6 +2,27 @@ import sqlite3
 import json
 import logging
 import tqdm
+import threading
+import compression
+import metrics
+import time
+
+# Read connections opened by get_thread_connection, one per thread
+_thread_connections = threading.local()
+
+# Apps with at least this many reviews stored are not updated again
+MINIMUM_REVIEW_COUNT = 100
+
+# Seconds to wait before retrying the details of an app after its first failure, by error class.
+# The wait doubles with every further failure, up to FAILURE_BACKOFF_MAX.
+FAILURE_BACKOFF_BASE = {
+    "PermanentFetchError": 24 * 60 * 60,
+}
+FAILURE_BACKOFF_DEFAULT = 60 * 60
+FAILURE_BACKOFF_MAX = 90 * 24 * 60 * 60
+
+# Seconds to wait for another process holding the write lock, e.g. a scraper worker claiming work
+BUSY_TIMEOUT = 60
 
 ## SQLite functions
 
@@ -16,7 +37,34 @@ def create_connection(db_file = "steam.db"):
         sqlite3.Connection: A connection to the SQLite database.
     '''
     logging.debug("Creating connection to SQLite database")
-    return sqlite3.connect(db_file)
+    conn = sqlite3.connect(db_file, timeout = BUSY_TIMEOUT)
+
+    # WAL lets readers continue while a batch is being written, and with synchronous=NORMAL
+    # a commit no longer waits on an fsync. Transactions stay atomic either way.
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+
+    # Compresses datajson and text columns once compress_database.py has trained dictionaries for them
+    compression.register_functions(conn)
+    return conn
+
+def get_thread_connection(db_file):
+    '''
+    Returns a connection to the SQLite database owned by the calling thread, creating it on first use.
+
+    Used by fetch threads that need to read from the database while the main thread writes to it.
+
+    Args:
+        db_file (str): The path to the SQLite database.
+
+    Returns:
+        sqlite3.Connection: A connection to the SQLite database.
+    '''
+    conn = getattr(_thread_connections, "conn", None)
+    if conn is None:
+        conn = create_connection(db_file)
+        _thread_connections.conn = conn
+    return conn
 
 def check_tables(conn):
     '''
@@ -47,9 +95,30 @@ def check_tables(conn):
     ''')
     appreviews_exists = c.fetchone()[0] == 1
 
+    c.execute('''
+        SELECT count(name) FROM sqlite_master WHERE type='table' AND name='reviewsync_state'
+    ''')
+    reviewsync_state_exists = c.fetchone()[0] == 1
+
+    # Left by older versions, create_tables drops it
+    c.execute('''
+        SELECT count(name) FROM sqlite_master WHERE type='table' AND name='appreview_stats'
+    ''')
+    appreview_stats_exists = c.fetchone()[0] == 1
+
+    c.execute('''
+        SELECT count(name) FROM sqlite_master WHERE type='table' AND name='workqueue'
+    ''')
+    workqueue_exists = c.fetchone()[0] == 1
+
+    c.execute('''
+        SELECT count(name) FROM sqlite_master WHERE type='table' AND name='appdetails_failures'
+    ''')
+    appdetails_failures_exists = c.fetchone()[0] == 1
+
     c.close()
 
-    return gamelist_exists and appdetails_exists and appreviews_exists
+    return gamelist_exists and appdetails_exists and appreviews_exists and reviewsync_state_exists and not appreview_stats_exists and workqueue_exists and appdetails_failures_exists
 
 def create_tables(conn):
     '''
@@ -78,7 +147,7 @@ def create_tables(conn):
             appid INTEGER PRIMARY KEY,
             storedescription TEXT,
             type TEXT,
-            content_descriptors TEXT,
+            content_descriptors TEXT
         )
     ''')
 
@@ -119,9 +188,119 @@ def create_tables(conn):
         )
     ''')
 
+    # Create table 'reviewsync_state'
+    # watermark_* describe the newest review seen by the last sync
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS reviewsync_state (
+            appid INTEGER PRIMARY KEY,
+            watermark_timestamp INTEGER,
+            watermark_recommendationid INTEGER,
+            lastsync INTEGER
+        )
+    ''')
+
+    # Create table 'appdetails_failures'
+    # Apps whose details failed to fetch, they are not retried before next_retry
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS appdetails_failures (
+            appid INTEGER PRIMARY KEY,
+            failure_count INTEGER NOT NULL,
+            last_error TEXT,
+            last_failure INTEGER,
+            next_retry INTEGER NOT NULL
+        )
+    ''')
+
+    create_workqueue(c)
+    drop_appreview_stats(c)
+
     conn.commit()
     c.close()
 
+def drop_appreview_stats(c):
+    '''
+    Drops the 'appreview_stats' summary table of older databases and its triggers.
+
+    The work queue schedules the review updates now, so the table is not read anymore and only slowed down every review insert.
+
+    Args:
+        c (sqlite3.Cursor): A cursor on the SQLite database.
+    '''
+    for trigger in ["gamelist_insert", "appreviews_insert", "appreviews_delete", "lastupdate_insert", "lastupdate_update"]:
+        c.execute("DROP TRIGGER IF EXISTS appreview_stats_" + trigger)
+    c.execute("DROP INDEX IF EXISTS appreview_stats_schedule_index")
+    c.execute("DROP TABLE IF EXISTS appreview_stats")
+
+def create_workqueue(c):
+    '''
+    Creates the 'workqueue' table, which holds the appids waiting for their appdetails or appreviews to be fetched.
+
+    kind is either 'appdetails' or 'appreviews'. Work is claimed highest priority first, then by next_eligible,
+    and a claimed appid is leased to its owner until lease_expires so other scrapers skip it.
+    New apps are queued by a trigger on gamelist, existing databases are backfilled once when the table is first created.
+
+    Args:
+        c (sqlite3.Cursor): A cursor on the SQLite database.
+    '''
+    c.execute('''
+        SELECT count(name) FROM sqlite_master WHERE type='table' AND name='workqueue'
+    ''')
+    workqueue_exists = c.fetchone()[0] == 1
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS workqueue (
+            kind TEXT NOT NULL,
+            appid INTEGER NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            next_eligible INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires INTEGER,
+            PRIMARY KEY(kind, appid)
+        )
+    ''')
+
+    # Matches the order of claim_work
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS workqueue_claim_index ON workqueue(kind, priority DESC, next_eligible ASC)
+    ''')
+
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS workqueue_gamelist_insert AFTER INSERT ON gamelist
+        BEGIN
+            INSERT OR IGNORE INTO workqueue (kind, appid, priority, next_eligible) VALUES ('appdetails', NEW.appid, 1, 0);
+            INSERT OR IGNORE INTO workqueue (kind, appid, priority, next_eligible) VALUES ('appreviews', NEW.appid, 1, 0);
+        END
+    ''')
+
+    if not workqueue_exists:
+        logging.info("Building work queue, this may take a while on large databases")
+
+        # Apps never tried before go first, the rest by least recently updated.
+        # Rows are inserted in random order so apps updated at the same time are shuffled.
+        c.execute('''
+            INSERT OR IGNORE INTO workqueue (kind, appid, priority, next_eligible)
+            SELECT 'appdetails', gamelist.appid, lastupdate IS NULL, IFNULL(lastupdate, 0)
+            FROM gamelist
+            LEFT JOIN lastupdate_appdetails ON gamelist.appid = lastupdate_appdetails.appid
+            LEFT JOIN appdetails ON gamelist.appid = appdetails.appid
+            WHERE appdetails.appid IS NULL
+            ORDER BY random()
+        ''')
+
+        c.execute('''
+            INSERT OR IGNORE INTO workqueue (kind, appid, priority, next_eligible)
+            SELECT 'appreviews', gamelist.appid, IFNULL(lastupdate, 0) = 0, IFNULL(lastupdate, 0)
+            FROM gamelist
+            LEFT JOIN lastupdate_appreviews ON gamelist.appid = lastupdate_appreviews.appid
+            LEFT JOIN (
+                SELECT appid, count(appid) as review_count
+                FROM appreviews
+                GROUP BY appid
+            ) AS review_count ON gamelist.appid = review_count.appid
+            WHERE IFNULL(review_count.review_count, 0) < ?
+            ORDER BY random()
+        ''', (MINIMUM_REVIEW_COUNT,))
+
 def insert_gamelist(conn, gamelist):
     '''
     Inserts a list of games into the SQLite database.
@@ -137,12 +316,66 @@ def insert_gamelist(conn, gamelist):
     for game in gamelist:
         c.execute('''
             INSERT OR IGNORE INTO gamelist (datajson, appid, name)
-            VALUES (?, ?, ?)
+            VALUES (compress_column('gamelist.datajson', ?), ?, ?)
         ''', (json.dumps(game), game["appid"], game["name"]))
 
     conn.commit()
     c.close()
 
+def insert_gamelist_stream(conn, games, batch_size = 10000):
+    '''
+    Inserts the games from a streamed game list that are not in the SQLite database yet.
+
+    The games are staged in a temporary table in batches, then the new ones are found and inserted
+    with a single join, so the known appids never have to be loaded into Python.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        games (iterable): Dictionaries containing the appid and name of each game, e.g. from steamapi.iter_game_list.
+        batch_size (int): Number of games to stage per executemany call.
+
+    Returns:
+        tuple: (new_count, total_count), the number of games inserted and the number of games in the list.
+    '''
+    logging.debug("Inserting streamed gamelist into SQLite database")
+
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS gamelist_incoming (
+            appid INTEGER PRIMARY KEY,
+            name TEXT
+        )
+    ''')
+    c.execute("DELETE FROM gamelist_incoming")
+
+    total_count = 0
+    batch = []
+    for game in games:
+        batch.append((game["appid"], game["name"]))
+        if len(batch) >= batch_size:
+            c.executemany("INSERT OR IGNORE INTO gamelist_incoming (appid, name) VALUES (?, ?)", batch)
+            total_count += len(batch)
+            batch = []
+    c.executemany("INSERT OR IGNORE INTO gamelist_incoming (appid, name) VALUES (?, ?)", batch)
+    total_count += len(batch)
+
+    c.execute('''
+        INSERT INTO gamelist (datajson, appid, name)
+        SELECT compress_column('gamelist.datajson', json_object('appid', gamelist_incoming.appid, 'name', gamelist_incoming.name)), gamelist_incoming.appid, gamelist_incoming.name
+        FROM gamelist_incoming
+        LEFT JOIN gamelist ON gamelist_incoming.appid = gamelist.appid
+        WHERE gamelist.appid IS NULL
+    ''')
+    new_count = c.rowcount
+    metrics.increment("sqlite_rows_written_total", new_count, table = "gamelist")
+
+    c.execute("DROP TABLE gamelist_incoming")
+    conn.commit()
+    c.close()
+
+    return new_count, total_count
+
 def get_known_appids(conn):
     '''
     Returns a list of all appids in the SQLite database.
@@ -166,6 +399,32 @@ def get_known_appids(conn):
 
     return appids
 
+def get_appdetails_row(appid, appdetails):
+    '''
+    Converts the details of a game into a row for the appdetails table.
+
+    Args:
+        appid (int): The appid of the game.
+        appdetails (dict): A dictionary containing the details of the game.
+
+    Returns:
+        tuple: (datajson, appid, storedescription, type, content_descriptors)
+    '''
+    return (json.dumps(appdetails), appid, appdetails["detailed_description"], appdetails["type"], json.dumps(appdetails["content_descriptors"]["ids"]))
+
+def get_appreview_rows(appid, appreviews):
+    '''
+    Converts a list of reviews for a game into rows for the appreviews table.
+
+    Args:
+        appid (int): The appid of the game.
+        appreviews (list): A list of dictionaries containing the reviews of the game.
+
+    Returns:
+        list: A list of (datajson, recommendationid, appid, review) tuples.
+    '''
+    return [(json.dumps(review), review["recommendationid"], appid, review["review"]) for review in appreviews]
+
 def insert_appdetails(conn, appid, appdetails):
     '''
     Inserts a list of games into the SQLite database.
@@ -176,14 +435,27 @@ def insert_appdetails(conn, appid, appdetails):
     '''
     logging.debug("Inserting appdetails into SQLite database")
 
+    insert_appdetails_rows(conn, [get_appdetails_row(appid, appdetails)])
+    conn.commit()
+
+@metrics.timed("sqlite_write_seconds", operation = "insert_appdetails_rows")
+def insert_appdetails_rows(conn, rows):
+    '''
+    Inserts rows into the appdetails table without committing.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        rows (list): A list of rows from get_appdetails_row.
+    '''
     c = conn.cursor()
 
-    c.execute('''
+    c.executemany('''
         INSERT OR IGNORE INTO appdetails (datajson, appid, storedescription, type, content_descriptors)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (json.dumps(appdetails), appid, appdetails["detailed_description"], appdetails["type"], str(appdetails["content_descriptors"]["ids"])))
+        VALUES (compress_column('appdetails.datajson', ?), ?, compress_column('appdetails.storedescription', ?), ?, ?)
+    ''', rows)
+
+    metrics.increment("sqlite_rows_written_total", c.rowcount, table = "appdetails")
 
-    conn.commit()
     c.close()
 
 def mark_appdetails_updated(conn, appid):
@@ -196,20 +468,25 @@ def mark_appdetails_updated(conn, appid):
     '''
     logging.debug("Marking appdetails for appid " + str(appid) + " as updated in SQLite database")
 
-    c = conn.cursor()
+    mark_appdetails_updated_many(conn, [appid])
+    conn.commit()
 
-    c.execute('''
-        INSERT OR IGNORE INTO lastupdate_appdetails (appid, lastupdate)
-        VALUES (?, NULL)
-    ''', (appid,))
+def mark_appdetails_updated_many(conn, appids):
+    '''
+    Marks the appdetails for several games as updated without committing.
 
-    c.execute('''
-        UPDATE lastupdate_appdetails
-        SET lastupdate = CAST(strftime('%s', 'now') AS INTEGER)
-        WHERE appid = ?
-    ''', (appid,))
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appids (list): The appids of the games.
+    '''
+    c = conn.cursor()
+
+    c.executemany('''
+        INSERT INTO lastupdate_appdetails (appid, lastupdate)
+        VALUES (?, CAST(strftime('%s', 'now') AS INTEGER))
+        ON CONFLICT(appid) DO UPDATE SET lastupdate = excluded.lastupdate
+    ''', [(appid,) for appid in appids])
 
-    conn.commit()
     c.close()
 
 def insert_appreviews(conn, appid, appreviews):
@@ -223,17 +500,163 @@ def insert_appreviews(conn, appid, appreviews):
     '''
     logging.debug("Inserting appreviews for appid " + str(appid) + " into SQLite database")
 
+    insert_appreview_rows(conn, get_appreview_rows(appid, appreviews))
+    conn.commit()
+
+@metrics.timed("sqlite_write_seconds", operation = "insert_appreview_rows")
+def insert_appreview_rows(conn, rows):
+    '''
+    Inserts rows into the appreviews table without committing.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        rows (list): A list of rows from get_appreview_rows.
+    '''
     c = conn.cursor()
 
-    for review in appreviews:
+    c.executemany('''
+        INSERT OR IGNORE INTO appreviews (datajson, recommendationid, appid, review)
+        VALUES (compress_column('appreviews.datajson', ?), ?, ?, compress_column('appreviews.review', ?))
+    ''', rows)
+
+    metrics.increment("sqlite_rows_written_total", c.rowcount, table = "appreviews")
+
+    c.close()
+
+def rebuild_appdetails(conn, rows, batch_size = 10000, replace_all = False):
+    '''
+    Rewrites the appdetails rows of the given appids in a single transaction, e.g. with rows re-derived from the response archive.
+
+    Rows of appids that are not given (e.g. scraped before the archive existed, or with --no-archive) are kept,
+    unless replace_all is set. The type index is dropped while loading and rebuilt once at the end.
+    When an appid appears more than once, the last row wins. Existing rows are updated in place, so columns
+    added by later steps (e.g. 02_embeddingdataset) keep their values.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        rows (iterable): Rows from get_appdetails_row, oldest first.
+        batch_size (int): Number of rows per executemany call.
+        replace_all (bool): Delete the rows of appids that are not given, so the table only holds the given rows.
+
+    Returns:
+        tuple: (row_count, uncovered_count), the number of rows loaded including replaced duplicates,
+            and the number of existing rows whose appid was not given (deleted if replace_all is set).
+    '''
+    logging.debug("Rebuilding appdetails table")
+
+    c = conn.cursor()
+    row_count = 0
+
+    with conn:
+        # Explicit, so the schema changes are part of the transaction too
+        c.execute("BEGIN")
+        c.execute("DROP INDEX IF EXISTS appdetails_type_index")
+        _create_rebuilt_keys_table(c)
+
+        for batch in _batches(rows, batch_size):
+            c.executemany('''
+                INSERT INTO appdetails (datajson, appid, storedescription, type, content_descriptors)
+                VALUES (compress_column('appdetails.datajson', ?), ?, compress_column('appdetails.storedescription', ?), ?, ?)
+                ON CONFLICT(appid) DO UPDATE SET
+                    datajson = excluded.datajson,
+                    storedescription = excluded.storedescription,
+                    type = excluded.type,
+                    content_descriptors = excluded.content_descriptors
+            ''', batch)
+            c.executemany("INSERT OR IGNORE INTO rebuilt_keys (key) VALUES (?)", [(row[1],) for row in batch])
+            row_count += len(batch)
+
+        uncovered_count = _remove_rows_not_rebuilt(c, "appdetails", "appid", replace_all)
+
         c.execute('''
-            INSERT OR IGNORE INTO appreviews (datajson, recommendationid, appid, review)
-            VALUES (?, ?, ?, ?)
-        ''', (json.dumps(review), review["recommendationid"], appid, review["review"]))           
+            CREATE INDEX IF NOT EXISTS appdetails_type_index ON appdetails(type)
+        ''')
 
-    conn.commit()
     c.close()
 
+    return row_count, uncovered_count
+
+def rebuild_appreviews(conn, rows, batch_size = 10000, replace_all = False):
+    '''
+    Rewrites the appreviews rows of the given reviews in a single transaction, e.g. with rows re-derived from the response archive.
+
+    Reviews that are not given are kept, unless replace_all is set. The appid index is dropped while loading
+    and rebuilt once at the end.
+    When a review appears more than once, the last row wins. Existing rows are updated in place, so columns
+    added by later steps keep their values.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        rows (iterable): Rows from get_appreview_rows, oldest first.
+        batch_size (int): Number of rows per executemany call.
+        replace_all (bool): Delete the reviews that are not given, so the table only holds the given rows.
+
+    Returns:
+        tuple: (row_count, uncovered_count), the number of rows loaded including replaced duplicates,
+            and the number of existing reviews that were not given (deleted if replace_all is set).
+    '''
+    logging.debug("Rebuilding appreviews table")
+
+    c = conn.cursor()
+    row_count = 0
+
+    with conn:
+        # Explicit, so the schema changes are part of the transaction too
+        c.execute("BEGIN")
+        c.execute("DROP INDEX IF EXISTS appreviews_appid_index")
+        _create_rebuilt_keys_table(c)
+
+        for batch in _batches(rows, batch_size):
+            c.executemany('''
+                INSERT INTO appreviews (datajson, recommendationid, appid, review)
+                VALUES (compress_column('appreviews.datajson', ?), ?, ?, compress_column('appreviews.review', ?))
+                ON CONFLICT(recommendationid) DO UPDATE SET
+                    datajson = excluded.datajson,
+                    appid = excluded.appid,
+                    review = excluded.review
+            ''', batch)
+            c.executemany("INSERT OR IGNORE INTO rebuilt_keys (key) VALUES (?)", [(row[1],) for row in batch])
+            row_count += len(batch)
+
+        uncovered_count = _remove_rows_not_rebuilt(c, "appreviews", "recommendationid", replace_all)
+
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS appreviews_appid_index ON appreviews(appid)
+        ''')
+
+    c.close()
+
+    return row_count, uncovered_count
+
+def _create_rebuilt_keys_table(c):
+    # Keys written by a rebuild, to find the existing rows it did not cover
+    c.execute("DROP TABLE IF EXISTS temp.rebuilt_keys")
+    c.execute("CREATE TEMP TABLE rebuilt_keys (key INTEGER PRIMARY KEY)")
+
+def _remove_rows_not_rebuilt(c, table, key_column, delete):
+    c.execute(f'''
+        SELECT count(*) FROM {table}
+        LEFT JOIN rebuilt_keys ON rebuilt_keys.key = {table}.{key_column}
+        WHERE rebuilt_keys.key IS NULL
+    ''')
+    uncovered_count = c.fetchone()[0]
+
+    if delete:
+        c.execute(f"DELETE FROM {table} WHERE {key_column} NOT IN (SELECT key FROM rebuilt_keys)")
+    c.execute("DROP TABLE temp.rebuilt_keys")
+
+    return uncovered_count
+
+def _batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
 def mark_appreviews_updated(conn, appid):
     '''
     Marks the appreviews for a game as updated in the SQLite database.
@@ -244,32 +667,96 @@ def mark_appreviews_updated(conn, appid):
     '''
     logging.debug("Marking appreviews for appid " + str(appid) + " as updated in SQLite database")
 
+    mark_appreviews_updated_many(conn, [appid])
+    conn.commit()
+
+def mark_appreviews_updated_many(conn, appids):
+    '''
+    Marks the appreviews for several games as updated without committing.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appids (list): The appids of the games.
+    '''
     c = conn.cursor()
 
-    c.execute('''
-        INSERT OR IGNORE INTO lastupdate_appreviews (appid, lastupdate)
-        VALUES (?, NULL)
-    ''', (appid,))
+    c.executemany('''
+        INSERT INTO lastupdate_appreviews (appid, lastupdate)
+        VALUES (?, CAST(strftime('%s', 'now') AS INTEGER))
+        ON CONFLICT(appid) DO UPDATE SET lastupdate = excluded.lastupdate
+    ''', [(appid,) for appid in appids])
 
-    c.execute('''
-        UPDATE lastupdate_appreviews
-        SET lastupdate = CAST(strftime('%s', 'now') AS INTEGER)
-        WHERE appid = ?
-    ''', (appid,))
+    c.close()
+
+def record_appdetails_failure_rows(conn, rows, now = None):
+    '''
+    Records failures to fetch appdetails without committing, and requeues the apps for when their backoff ends.
+
+    The backoff starts at FAILURE_BACKOFF_BASE for the error class and doubles with every consecutive failure.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        rows (list): A list of (appid, error_class) tuples, where error_class is the name of the exception raised.
+        now (int): The current unix time, defaults to the system time.
+    '''
+    now = int(time.time()) if now is None else now
+
+    c = conn.cursor()
+
+    c.executemany('''
+        INSERT INTO appdetails_failures (appid, failure_count, last_error, last_failure, next_retry)
+        VALUES (:appid, 1, :error, :now, :now + MIN(:max, :base))
+        ON CONFLICT(appid) DO UPDATE SET
+            failure_count = failure_count + 1,
+            last_error = excluded.last_error,
+            last_failure = excluded.last_failure,
+            next_retry = excluded.last_failure + MIN(:max, :base * (1 << MIN(failure_count, 30)))
+    ''', [{
+        "appid": appid,
+        "error": error_class,
+        "now": now,
+        "base": FAILURE_BACKOFF_BASE.get(error_class, FAILURE_BACKOFF_DEFAULT),
+        "max": FAILURE_BACKOFF_MAX,
+    } for appid, error_class in rows])
+
+    c.executemany('''
+        INSERT INTO workqueue (kind, appid, priority, next_eligible)
+        VALUES ('appdetails', :appid, 0, (SELECT next_retry FROM appdetails_failures WHERE appid = :appid))
+        ON CONFLICT(kind, appid) DO UPDATE SET
+            priority = 0,
+            next_eligible = excluded.next_eligible,
+            lease_owner = NULL,
+            lease_expires = NULL
+    ''', [{"appid": appid} for appid, error_class in rows])
+
+    c.close()
+
+def clear_appdetails_failure_rows(conn, appids):
+    '''
+    Forgets past failures of apps whose details were fetched, without committing.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appids (list): The appids of the games.
+    '''
+    c = conn.cursor()
+
+    c.executemany('''
+        DELETE FROM appdetails_failures WHERE appid = ?
+    ''', [(appid,) for appid in appids])
 
-    conn.commit()
     c.close()
 
 def get_appreview_recommendationids(conn, appid):
     '''
-    Returns a list of all recommendationids for a game in the SQLite database.
+    Returns the set of all recommendationids for a game in the SQLite database.
 
     Args:
         conn (sqlite3.Connection): A connection to the SQLite database.
         appid (int): The appid of the game.
 
     Returns:
-        list: A list of all recommendationids for a game in the SQLite database.
+        set: The set of all recommendationids for a game in the SQLite database.
     '''
     logging.debug("Getting all recommendationids for appid " + str(appid) + " from SQLite database")
 
@@ -278,74 +765,252 @@ def get_appreview_recommendationids(conn, appid):
     c.execute('''
         SELECT recommendationid FROM appreviews WHERE appid = ?
     ''', (appid,))
-    recommendationids = [recommendationid[0] for recommendationid in c.fetchall()]
+    recommendationids = set(recommendationid[0] for recommendationid in c.fetchall())
 
     c.close()
 
     return recommendationids
 
-def get_appdetails_to_update(conn, count=100):
+def get_reviewsync_state(conn, appid):
     '''
-    Returns a list of appids that need updating in the SQLite database.
+    Returns the state of the last review sync for a game.
 
     Args:
         conn (sqlite3.Connection): A connection to the SQLite database.
-        count (int): The number of appids to return.
+        appid (int): The appid of the game.
 
     Returns:
-        list: A list of appids that do not exist in appdetails, ordered by least recently updated.
+        dict: The watermark_timestamp, watermark_recommendationid and lastsync of the game, or None if it was never synced.
     '''
-    logging.debug("Getting " + str(count) + " appids to update from SQLite database")
+    logging.debug("Getting review sync state for appid " + str(appid) + " from SQLite database")
 
     c = conn.cursor()
 
     c.execute('''
-        SELECT gamelist.appid 
-        FROM gamelist
-        LEFT JOIN lastupdate_appdetails ON gamelist.appid = lastupdate_appdetails.appid
-        LEFT JOIN appdetails ON gamelist.appid = appdetails.appid
-        WHERE appdetails.appid IS NULL              -- appdetails do not exist in the DB
-        ORDER BY IFNULL(lastupdate, 0) ASC,         -- order by least recently updated
-                random() ASC                        -- randomize order of appids that have not been updated
-        LIMIT ?
-    ''', (count,))
-    appids = [appid[0] for appid in c.fetchall()]
+        SELECT watermark_timestamp, watermark_recommendationid, lastsync
+        FROM reviewsync_state WHERE appid = ?
+    ''', (appid,))
+    row = c.fetchone()
+
+    c.close()
+
+    if row is None:
+        return None
+
+    return {
+        "watermark_timestamp": row[0],
+        "watermark_recommendationid": row[1],
+        "lastsync": row[2],
+    }
+
+def update_reviewsync_state_rows(conn, rows):
+    '''
+    Stores the state of review syncs without committing.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        rows (list): A list of (appid, watermark_timestamp, watermark_recommendationid) tuples.
+    '''
+    c = conn.cursor()
+
+    c.executemany('''
+        INSERT INTO reviewsync_state (appid, watermark_timestamp, watermark_recommendationid, lastsync)
+        VALUES (?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+        ON CONFLICT(appid) DO UPDATE SET
+            watermark_timestamp = excluded.watermark_timestamp,
+            watermark_recommendationid = excluded.watermark_recommendationid,
+            lastsync = excluded.lastsync
+    ''', rows)
 
     c.close()
 
+def shard_filter(shard):
+    '''
+    Returns the SQL condition and parameters that restrict appids to one shard.
+
+    Args:
+        shard (tuple): (index, count) to only match appids where appid % count == index, or None to match every appid.
+
+    Returns:
+        tuple: (condition, parameters)
+    '''
+    if shard is None:
+        return "1", ()
+    index, count = shard
+    return "appid % ? = ?", (count, index)
+
+@metrics.timed("sqlite_claim_seconds")
+def claim_work(conn, kind, owner, count = 100, lease_seconds = 600, now = None, shard = None):
+    '''
+    Atomically claims a batch of appids from the work queue.
+
+    Only appids whose next_eligible time has passed and that are not leased to another owner (or whose lease expired) are claimed.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        kind (str): The kind of work to claim, 'appdetails' or 'appreviews'.
+        owner (str): Name of the scraper claiming the work.
+        count (int): The maximum number of appids to claim.
+        lease_seconds (int): How long the appids stay leased to the owner.
+        now (int): The current unix time, defaults to the system time.
+        shard (tuple): Optional (index, count) to only claim appids where appid % count == index.
+
+    Returns:
+        list: The claimed appids, in priority order.
+    '''
+    logging.debug("Claiming " + str(count) + " " + kind + " appids from work queue")
+
+    now = int(time.time()) if now is None else now
+    shard_condition, shard_parameters = shard_filter(shard)
+
+    c = conn.cursor()
+
+    # BEGIN IMMEDIATE takes the write lock up front, so two scrapers can never claim the same rows
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute('''
+            SELECT appid
+            FROM workqueue
+            WHERE kind = ?
+                AND next_eligible <= ?
+                AND IFNULL(lease_expires, 0) <= ?
+                AND ''' + shard_condition + '''
+            ORDER BY priority DESC, next_eligible ASC
+            LIMIT ?
+        ''', (kind, now, now) + shard_parameters + (count,))
+        appids = [appid[0] for appid in c.fetchall()]
+
+        c.executemany('''
+            UPDATE workqueue
+            SET lease_owner = ?, lease_expires = ?
+            WHERE kind = ? AND appid = ?
+        ''', [(owner, now + lease_seconds, kind, appid) for appid in appids])
+
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
+
     return appids
 
-def get_appreviews_to_update(conn, minimum_review_count = 100, output_count=100):
+def renew_work_leases(conn, kind, owner, appids, lease_seconds = 600, now = None):
+    '''
+    Extends the leases of claimed appids that are still leased to the owner.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        kind (str): The kind of work, 'appdetails' or 'appreviews'.
+        owner (str): Name of the scraper that claimed the work.
+        appids (list): The claimed appids.
+        lease_seconds (int): How long the appids stay leased to the owner from now.
+        now (int): The current unix time, defaults to the system time.
+
+    Returns:
+        list: The appids still leased to the owner. The others were finished, or their lease expired and another owner claimed them.
+    '''
+    logging.debug("Renewing " + str(len(appids)) + " " + kind + " leases in work queue")
+
+    now = int(time.time()) if now is None else now
+    held = []
+
+    c = conn.cursor()
+
+    with conn:
+        for appid in appids:
+            c.execute('''
+                UPDATE workqueue
+                SET lease_expires = ?
+                WHERE kind = ? AND appid = ? AND lease_owner = ?
+            ''', (now + lease_seconds, kind, appid, owner))
+            if c.rowcount > 0:
+                held.append(appid)
+
+    c.close()
+
+    return held
+
+def count_eligible_work(conn, kind, now = None, shard = None):
     '''
-    Returns a list of appids that need updating in the SQLite database.
+    Returns the number of appids in the work queue that could be claimed right now.
 
     Args:
         conn (sqlite3.Connection): A connection to the SQLite database.
-        count (int): The number of appids to return.
+        kind (str): The kind of work, 'appdetails' or 'appreviews'.
+        now (int): The current unix time, defaults to the system time.
+        shard (tuple): Optional (index, count) to only count appids where appid % count == index.
 
     Returns:
-        list: A list of appids that do not exist in appreviews, ordered by least recently updated.
+        int: The number of claimable appids.
     '''
-    logging.debug("Getting " + str(output_count) + " appids to update from SQLite database")
+    now = int(time.time()) if now is None else now
+    shard_condition, shard_parameters = shard_filter(shard)
 
     c = conn.cursor()
 
     c.execute('''
-        SELECT gamelist.appid 
-        FROM gamelist
-        LEFT JOIN lastupdate_appreviews ON gamelist.appid = lastupdate_appreviews.appid
-        LEFT JOIN (
-            SELECT appid, count(appid) as review_count
-            FROM appreviews
-            GROUP BY appid
-        ) AS review_count ON gamelist.appid = review_count.appid
-        WHERE IFNULL(review_count.review_count, 0) < ?      -- app has less than minimum_review_count reviews
-        ORDER BY IFNULL(lastupdate, 0) ASC,                 -- order by least recently updated
-              random() ASC                                  -- randomize order of appids that have not been updated
-        LIMIT ?
-    ''', (minimum_review_count, output_count))
-    appids = [appid[0] for appid in c.fetchall()]
+        SELECT count(*)
+        FROM workqueue
+        WHERE kind = ?
+            AND next_eligible <= ?
+            AND IFNULL(lease_expires, 0) <= ?
+            AND ''' + shard_condition + '''
+    ''', (kind, now, now) + shard_parameters)
+    count = c.fetchone()[0]
 
     c.close()
 
-    return appids
\ No newline at end of file
+    return count
+
+def iter_claimed_work(conn, kind, owner, limit = None, batch_size = 50, lease_seconds = 600, shard = None, on_claim = None):
+    '''
+    Yields appids from the work queue, claiming them in batches as they are consumed.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        kind (str): The kind of work to claim, 'appdetails' or 'appreviews'.
+        owner (str): Name of the scraper claiming the work.
+        limit (int): The maximum number of appids to yield, or None for no limit.
+        batch_size (int): The number of appids to claim at a time.
+        lease_seconds (int): How long claimed appids stay leased to the owner.
+        shard (tuple): Optional (index, count) to only claim appids where appid % count == index.
+        on_claim (callable): Optional function called with each claimed batch before it is yielded, e.g. to renew its leases.
+
+    Yields:
+        int: The claimed appids.
+    '''
+    claimed = 0
+    while limit is None or claimed < limit:
+        count = batch_size if limit is None else min(batch_size, limit - claimed)
+        appids = claim_work(conn, kind, owner, count = count, lease_seconds = lease_seconds, shard = shard)
+        if len(appids) == 0:
+            return
+        if on_claim is not None:
+            on_claim(appids)
+        claimed += len(appids)
+        yield from appids
+
+def finish_work_rows(conn, kind, rows):
+    '''
+    Releases claimed appids back to the work queue without committing.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        kind (str): The kind of work, 'appdetails' or 'appreviews'.
+        rows (list): A list of (appid, next_eligible) tuples. Appids with a next_eligible of None are removed from the queue,
+            the rest are requeued at normal priority once next_eligible has passed.
+    '''
+    c = conn.cursor()
+
+    c.executemany('''
+        DELETE FROM workqueue WHERE kind = ? AND appid = ?
+    ''', [(kind, appid) for appid, next_eligible in rows if next_eligible is None])
+
+    c.executemany('''
+        UPDATE workqueue
+        SET priority = 0, next_eligible = ?, lease_owner = NULL, lease_expires = NULL
+        WHERE kind = ? AND appid = ?
+    ''', [(next_eligible, kind, appid) for appid, next_eligible in rows if next_eligible is not None])
+
+    c.close()
@@ -1,18 +1,302 @@
+import http_session
+import ratelimiter
+import metrics
 import requests
-import ratelimit
+import email.utils
+import json
 import logging
-from tenacity import retry, stop_after_attempt, wait_exponential
 import time
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from ratelimiter import AdaptiveRateController
 
-# Rate limit the API calls to 200 per 5 minutes / 1 call per 1.5 seconds
-@ratelimit.sleep_and_retry
-@ratelimit.limits(calls=200, period=300)
-def call_api(url, params = {}):
+# Rate limit the API calls to 200 per 5 minutes, tracked separately for each endpoint
+ENDPOINT_RATE_LIMITS = {
+    "applist": (200, 300),
+    "appdetails": (200, 300),
+    "appreviews": (200, 300),
+}
+ENDPOINT_BURST = 5
+
+rate_controllers = {endpoint: AdaptiveRateController(endpoint, calls, period, burst = ENDPOINT_BURST) for endpoint, (calls, period) in ENDPOINT_RATE_LIMITS.items()}
+
+# Optional limit on the total number of calls per day across every endpoint, see set_daily_budget
+daily_budget = None
+
+def record_request_timings(endpoint, timings):
+    # Timing hook for http_session, called after every request
+    metrics.observe("steam_request_seconds", timings["connect"] + timings["ttfb"] + timings["download"], endpoint = endpoint)
+    metrics.observe("steam_connect_seconds", timings["connect"], endpoint = endpoint)
+    metrics.observe("steam_ttfb_seconds", timings["ttfb"], endpoint = endpoint)
+    metrics.increment("steam_response_bytes_total", timings["bytes"], endpoint = endpoint)
+    metrics.increment("steam_responses_total", endpoint = endpoint, status = timings["status"])
+
+http_session.add_timing_hook(record_request_timings)
+
+def record_retry(retry_state):
+    # Called by tenacity before sleeping between attempts
+    metrics.increment("steam_retries_total", function = retry_state.fn.__name__, error = type(retry_state.outcome.exception()).__name__)
+
+class TransientFetchError(Exception):
+    '''
+    A call failed in a way that may succeed if retried, such as throttling, a server error or a timeout.
+    '''
+    pass
+
+class PermanentFetchError(Exception):
+    '''
+    A call failed in a way that retrying will not fix, such as an app without store details.
+    '''
+    pass
+
+# Base urls of the two Steam hosts, can be pointed at mock_steam_server.py with set_base_url
+WEB_API_BASE_URL = "https://api.steampowered.com"
+STORE_BASE_URL = "https://store.steampowered.com"
+
+def set_base_url(base_url):
+    '''
+    Sends all API calls to a different server, such as a local mock_steam_server.py.
+
+    Args:
+        base_url (str): The base url of the server, e.g. http://localhost:8080
+    '''
+    global WEB_API_BASE_URL, STORE_BASE_URL
+    logging.info("Using Steam API base url " + base_url)
+    WEB_API_BASE_URL = base_url.rstrip("/")
+    STORE_BASE_URL = base_url.rstrip("/")
+
+def set_rate_limit(calls, period):
+    '''
+    Replaces the rate limit of every endpoint, for example to benchmark against a local server.
+
+    Args:
+        calls (int): Maximum number of calls allowed per period.
+        period (float): Length of the period in seconds.
+    '''
+    for endpoint, controller in rate_controllers.items():
+        rate_controllers[endpoint] = AdaptiveRateController(endpoint, calls, period, burst = min(ENDPOINT_BURST, calls - 1), max_concurrency = controller.max_concurrency)
+
+def share_rate_limits(share_count):
+    '''
+    Divides the rate limit of every endpoint between several scraper processes calling from the same address.
+
+    Args:
+        share_count (int): The number of processes sharing the rate limits.
+    '''
+    for endpoint, controller in rate_controllers.items():
+        calls = max(2, controller.calls // share_count)
+        rate_controllers[endpoint] = AdaptiveRateController(endpoint, calls, controller.period, burst = min(controller.burst, calls - 1), max_concurrency = controller.max_concurrency)
+
+def set_daily_budget(calls):
+    '''
+    Limits the total number of calls per day across every endpoint, spread evenly over the day.
+
+    Up to 15 minutes worth of unused budget may be spent back to back, e.g. after the work queue was empty for a while.
+
+    Args:
+        calls (int): The number of calls allowed per day, at least 2.
+    '''
+    global daily_budget
+    period = 24 * 60 * 60
+    daily_budget = ratelimiter.TokenBucket("daily-budget", calls, period, burst = min(max(1, calls // 96), calls - 1))
+
+def set_max_concurrency(max_concurrency):
+    '''
+    Sets the maximum number of calls in flight at once, per endpoint.
+
+    Args:
+        max_concurrency (int): The maximum number of concurrent calls.
+    '''
+    for controller in rate_controllers.values():
+        controller.set_max_concurrency(max_concurrency)
+
+def parse_retry_after(value):
+    '''
+    Parses a Retry-After header, which is either a number of seconds or an HTTP date.
+
+    Returns:
+        float: The number of seconds to wait, or None if the header is missing or invalid.
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def call_api(url, params = {}, endpoint = None):
+    '''
+    Calls the Steam API, waiting on the rate controller for the endpoint first.
+
+    Args:
+        url (str): The url to call.
+        params (dict): Query parameters for the call.
+        endpoint (str): The endpoint being called, one of the keys of ENDPOINT_RATE_LIMITS.
+
+    Returns:
+        dict: The decoded JSON response.
+
+    Raises:
+        TransientFetchError: The call was throttled, timed out or hit a server error.
+        PermanentFetchError: The call was rejected by the server.
+    '''
+    if daily_budget is not None:
+        metrics.observe("steam_budget_wait_seconds", daily_budget.acquire())
+    controller = rate_controllers[endpoint]
+    metrics.observe("steam_ratelimit_wait_seconds", controller.acquire(), endpoint = endpoint)
     logging.debug("Calling API: " + url)
     logging.debug("Params: " + str(params))
-    time.sleep(1.5) # Sleep for 1.5 seconds to avoid rate limiting
-    response = requests.get(url = url, params = params)
-    return response.json()
+
+    # Released exactly once whatever happens, a leaked slot would shrink the endpoint's concurrency for good.
+    # Anything that fails before an outcome is known counts as a transient error.
+    outcome = ratelimiter.TRANSIENT_ERROR
+    retry_after = None
+    try:
+        try:
+            response = http_session.get(url, params = params, endpoint = endpoint)
+        except requests.RequestException as e:
+            raise TransientFetchError("Request to " + url + " failed: " + repr(e)) from e
+
+        outcome, retry_after = get_response_outcome(response)
+        check_response_status(outcome, response, url)
+
+        try:
+            return response.json()
+        except ValueError as e:
+            # Usually a truncated response or an HTML error page
+            outcome = ratelimiter.TRANSIENT_ERROR
+            raise TransientFetchError("Request to " + url + " returned invalid JSON") from e
+    finally:
+        controller.release(outcome, retry_after = retry_after)
+
+def get_response_outcome(response):
+    '''
+    Classifies a response for the rate controller.
+
+    Returns:
+        tuple: (outcome, retry_after), the outcome to release the rate controller with and the Retry-After delay of throttled calls.
+    '''
+    if response.status_code == 429:
+        return ratelimiter.THROTTLED, parse_retry_after(response.headers.get("Retry-After"))
+    elif response.status_code >= 500:
+        return ratelimiter.TRANSIENT_ERROR, None
+    elif response.status_code >= 400:
+        return ratelimiter.PERMANENT_ERROR, None
+    return ratelimiter.SUCCESS, None
+
+def check_response_status(outcome, response, url):
+    '''
+    Raises if the response status is an error.
+
+    Args:
+        outcome (str): The outcome of the response, from get_response_outcome.
+
+    Raises:
+        TransientFetchError: The call was throttled or hit a server error.
+        PermanentFetchError: The call was rejected by the server.
+    '''
+    if outcome == ratelimiter.THROTTLED:
+        raise TransientFetchError("Request to " + url + " was throttled")
+    elif outcome == ratelimiter.TRANSIENT_ERROR:
+        raise TransientFetchError("Request to " + url + " failed with status " + str(response.status_code))
+    elif outcome == ratelimiter.PERMANENT_ERROR:
+        raise PermanentFetchError("Request to " + url + " failed with status " + str(response.status_code))
+
+def iter_json_array(chunks, key):
+    '''
+    Incrementally parses the items of the first JSON array stored under the given key, without loading the whole document.
+
+    Args:
+        chunks (iterable): The JSON document, as an iterable of text chunks.
+        key (str): The key of the array, e.g. "apps".
+
+    Yields:
+        The decoded items of the array.
+    '''
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    position = -1
+
+    # Find the start of the array
+    while position < 0:
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("Key " + key + " not found in JSON document")
+        buffer += chunk
+        position = buffer.find('"' + key + '"')
+    buffer = buffer[position + len(key) + 2:]
+
+    while True:
+        position = buffer.find("[")
+        if position >= 0:
+            buffer = buffer[position + 1:]
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("Array " + key + " not found in JSON document")
+        buffer += chunk
+
+    # Decode one item at a time, reading more text whenever an item is incomplete
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+
+        if position < len(buffer) and buffer[position] == "]":
+            return
+
+        try:
+            if position >= len(buffer):
+                raise ValueError("Need more data")
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError("JSON document ended inside array " + key)
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        yield item
+
+def iter_game_list():
+    '''
+    Streams the list of all games on Steam, parsing it as it is downloaded.
+
+    Yields:
+        dict: The appid and name of each game.
+    '''
+    logging.debug("Streaming game list from Steam API")
+    url = WEB_API_BASE_URL + "/ISteamApps/GetAppList/v2/"
+    if daily_budget is not None:
+        metrics.observe("steam_budget_wait_seconds", daily_budget.acquire())
+    controller = rate_controllers["applist"]
+    metrics.observe("steam_ratelimit_wait_seconds", controller.acquire(), endpoint = "applist")
+
+    # Released once the response headers are in, like call_api it is released even if something unexpected fails
+    outcome = ratelimiter.TRANSIENT_ERROR
+    retry_after = None
+    try:
+        try:
+            response, chunks = http_session.get_stream(url, params = {"format": "json"}, endpoint = "applist")
+        except requests.RequestException as e:
+            raise TransientFetchError("Request to " + url + " failed: " + repr(e)) from e
+
+        outcome, retry_after = get_response_outcome(response)
+        check_response_status(outcome, response, url)
+    finally:
+        controller.release(outcome, retry_after = retry_after)
+
+    with response:
+        yield from iter_json_array(chunks, "apps")
+
+        # Read the rest of the body, so the connection can be reused and its timings are reported
+        for _ in chunks:
+            pass
 
 def get_game_list():
     '''
@@ -22,14 +306,15 @@ def get_game_list():
         list: A list of dictionaries containing the appid and name of each game.
     '''
     logging.debug("Getting game list from Steam API")
-    url = "https://api.steampowered.com/ISteamApps/GetAppList/v2/"
-    response = call_api(url, params = {"format": "json"})
+    url = WEB_API_BASE_URL + "/ISteamApps/GetAppList/v2/"
+    response = call_api(url, params = {"format": "json"}, endpoint = "applist")
     app_list = response["applist"]["apps"]
     logging.info("Found " + str(len(app_list)) + " games in steam app list.")
     return app_list
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
+@metrics.timed("steam_fetch_seconds", function = "get_app_details")
+@retry(retry=retry_if_exception_type(TransientFetchError), stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), before_sleep=record_retry, reraise=True)
 def get_app_details(appid):
     '''
     Returns a dictionary containing the details of a game on Steam.
@@ -41,35 +326,52 @@ def get_app_details(appid):
         dict: A dictionary containing the details of the game.
     '''
     logging.debug("Getting details for appid " + str(appid))
-    url = "https://store.steampowered.com/api/appdetails"
-    response = call_api(url, params = {"appids": appid})
+    url = STORE_BASE_URL + "/api/appdetails"
+    response = call_api(url, params = {"appids": appid}, endpoint = "appdetails")
+    if response is None:
+        # The store has been known to answer with null instead of a 429 when throttling
+        raise TransientFetchError("Empty details response for appid " + str(appid))
+
     game_details = response[str(appid)]
 
     if game_details["success"]:
         return game_details["data"]
     else:
-        logging.debug("Failed to get details for appid " + str(appid) + ". Retrying...")
-        raise Exception("Failed to get details for appid " + str(appid))
+        # Steam answers like this for delisted, region locked and non-existent apps, retrying won't help
+        logging.debug("Failed to get details for appid " + str(appid) + ". Not retrying.")
+        raise PermanentFetchError("Failed to get details for appid " + str(appid))
 
 # Source: https://andrew-muller.medium.com/scraping-steam-user-reviews-9a43f9e38c92
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
+@retry(retry=retry_if_exception_type(TransientFetchError), stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10), before_sleep=record_retry, reraise=True)
 def get_reviews(appid, params={'json':1}):
-    url = f'https://store.steampowered.com/appreviews/{appid}'
-    response = call_api(url, params)
+    url = f'{STORE_BASE_URL}/appreviews/{appid}'
+    response = call_api(url, params, endpoint = "appreviews")
     
     if response['success'] == 1:
         return response
     else:
         logging.warning("Failed to get reviews for appid " + str(appid) + ". Retrying...")
-        raise Exception("Failed to get reviews for appid " + str(appid))
+        raise TransientFetchError("Failed to get reviews for appid " + str(appid))
 
-def get_n_reviews(appid, n=100):
-    logging.debug("Getting reviews for appid " + str(appid))
+def page_reviews(appid, filter = 'all', n = 100, stop_at = None):
+    '''
+    Pages through the reviews of a game on Steam.
+
+    Args:
+        appid (int): The appid of the game.
+        filter (str): Review ordering, 'all' for most helpful first or 'recent' for newest first.
+        n (int): The maximum number of reviews to return.
+        stop_at (callable): Optional function taking a review. Paging stops at the first review it returns True for,
+            and that review is not included in the results.
+
+    Returns:
+        tuple: (reviews, cursor), where cursor is the cursor for the page after the last review returned.
+    '''
     reviews = []
     cursor = '*'
     params = {
             'json' : 1,
-            'filter' : 'all',
+            'filter' : filter,
             'language' : 'english',
             'review_type' : 'all',
             'purchase_type' : 'all'
@@ -82,9 +384,47 @@ def get_n_reviews(appid, n=100):
 
         response = get_reviews(appid, params)
         cursor = response['cursor']
-        reviews += response['reviews']
+
+        for review in response['reviews']:
+            if stop_at is not None and stop_at(review):
+                return reviews, cursor
+            reviews.append(review)
 
         if len(response['reviews']) < 100: break
 
+    return reviews, cursor
+
+@metrics.timed("steam_fetch_seconds", function = "get_n_reviews")
+def get_n_reviews(appid, n=100):
+    logging.debug("Getting reviews for appid " + str(appid))
+    reviews, _ = page_reviews(appid, filter = 'all', n = n)
     logging.debug("Found " + str(len(reviews)) + " reviews for appid " + str(appid))
-    return reviews
\ No newline at end of file
+    return reviews
+
+@metrics.timed("steam_fetch_seconds", function = "get_new_reviews")
+def get_new_reviews(appid, known_recommendationids, watermark_timestamp = None, n=500):
+    '''
+    Returns the reviews of a game that were written since the last sync, newest first.
+
+    Paging stops at the first review that is already known, or that was created before the watermark.
+    Reviews created in the same second as the watermark are only skipped if they are known, they may be new.
+
+    Args:
+        appid (int): The appid of the game.
+        known_recommendationids (set): The recommendationids already stored for the game.
+        watermark_timestamp (int): The creation time of the newest review seen by the last sync, if any.
+        n (int): The maximum number of reviews to return.
+
+    Returns:
+        list: The new reviews.
+    '''
+    logging.debug("Getting new reviews for appid " + str(appid))
+
+    def is_known(review):
+        if int(review["recommendationid"]) in known_recommendationids:
+            return True
+        return watermark_timestamp is not None and review["timestamp_created"] < watermark_timestamp
+
+    reviews, _ = page_reviews(appid, filter = 'recent', n = n, stop_at = is_known)
+    logging.debug("Found " + str(len(reviews)) + " new reviews for appid " + str(appid))
+    return reviews
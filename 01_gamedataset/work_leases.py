@@ -0,0 +1,81 @@
+import sqlite_helpers
+import threading
+import logging
+import time
+
+class WorkLeases():
+    '''
+    Keeps the leases of appids claimed from the work queue alive until they are finished.
+
+    Claimed appids can wait far longer than a lease before they are fetched, e.g. on the daily budget,
+    on throttling backoff or behind the fetch queue. Without renewal another scraper (or this one)
+    would claim them again once their leases expire and fetch them twice.
+
+    The leases of every claimed appid are renewed on a background thread every third of the lease time.
+    Appids whose work was finished are forgotten, and so are appids whose lease was lost anyway,
+    which the claimer then skips.
+    '''
+    def __init__(self, db, kind, owner, lease_seconds = 600):
+        '''
+        Args:
+            db (str): The path to the SQLite database.
+            kind (str): The kind of work, 'appdetails' or 'appreviews'.
+            owner (str): Name of the scraper that claims the work.
+            lease_seconds (int): How long the appids stay leased after each renewal.
+        '''
+        self.db = db
+        self.kind = kind
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.held = set()
+        self.lock = threading.Lock()
+
+    def add(self, appids):
+        '''
+        Starts renewing the leases of newly claimed appids.
+
+        Args:
+            appids (list): The claimed appids.
+        '''
+        with self.lock:
+            self.held.update(appids)
+
+    def holds(self, appid):
+        '''
+        Returns:
+            bool: False if the lease of the appid was lost, so it must not be fetched.
+        '''
+        with self.lock:
+            return appid in self.held
+
+    def renew(self, conn):
+        with self.lock:
+            appids = list(self.held)
+        if len(appids) == 0:
+            return
+
+        still_held = set(sqlite_helpers.renew_work_leases(conn, self.kind, self.owner, appids, lease_seconds = self.lease_seconds))
+
+        # Only forgets the appids that were checked, ones claimed in the meantime are renewed next time
+        with self.lock:
+            self.held.difference_update(appid for appid in appids if appid not in still_held)
+
+    def run(self):
+        conn = sqlite_helpers.get_thread_connection(self.db)
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                self.renew(conn)
+            except Exception as e:
+                logging.warning("Failed to renew " + self.kind + " work leases, retrying later: " + repr(e))
+
+    def start(self):
+        '''
+        Starts renewing the leases on a background thread, until the process exits. The leases then expire on their own.
+
+        Returns:
+            threading.Thread: The started renewal thread.
+        '''
+        thread = threading.Thread(target = self.run, name = self.kind + "-leases", daemon = True)
+        thread.start()
+        return thread
@@ -0,0 +1,238 @@
+import hashlib
+import logging
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from encoder_pool import EncoderPool
+from instructor_model import InstructorModel
+
+# (key, chunk_number, instruction, token_ids, token_length, content_hash) of a chunk
+Chunk = Tuple[Hashable, int, str, List[int], int, Optional[bytes]]
+
+def content_hash(model_name: str, instruction: str, token_ids: List[int]) -> bytes:
+    """
+    Hashes the contents of a chunk for the embedding cache.
+
+    Token ids are the tokenizer's normalized form of the chunk text, so texts that only differ
+    in whitespace the tokenizer ignores share a hash.
+
+    Args:
+        model_name (str): The name of the model encoding the chunk.
+        instruction (str): The embedding instruction of the chunk.
+        token_ids (List[int]): The token ids of the chunk.
+
+    Returns:
+        bytes: A 16 byte hash.
+    """
+    h = hashlib.blake2b(digest_size = 16)
+    h.update(model_name.encode("utf-8") + b"\0" + instruction.encode("utf-8") + b"\0")
+    h.update(np.asarray(token_ids, dtype = "<i4").tobytes())
+    return h.digest()
+
+class BatchEncoder():
+    """
+    Collects chunks from many documents and encodes them together in batches of similar token length.
+
+    Documents are split into chunks that fit the model, the chunks are sorted by token length so each batch
+    needs as little padding as possible, and the embeddings are mapped back to the document they came from.
+
+    Short chunks can be looked up in an embedding cache by content hash. Identical chunks are only encoded
+    once, the embeddings of new ones are collected for the caller to add to the cache.
+    """
+    def __init__(
+            self,
+            instructor: InstructorModel,
+            batch_size: int = 32,
+            max_batch_tokens: Optional[int] = None,
+            pool: Optional[EncoderPool] = None,
+            cache_max_tokens: int = 0):
+        """
+        Args:
+            instructor (InstructorModel): The model to encode with.
+            batch_size (int): Maximum number of chunks per batch.
+            max_batch_tokens (Optional[int]): Maximum number of tokens per batch, counting padding, instead of a fixed number of chunks.
+            pool (Optional[EncoderPool]): Encoder processes to encode the batches on, instead of this process.
+            cache_max_tokens (int): Chunks of up to this many tokens are cached by content hash, 0 disables the cache.
+        """
+        self.instructor = instructor
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.pool = pool
+        self.cache_max_tokens = cache_max_tokens
+
+        # Every chunk waiting to be encoded
+        self.pending_chunks: List[Chunk] = []
+        self.pending_chunk_counts: Dict[Hashable, int] = {}
+        # Embeddings of queued chunks that were found in the cache, by (key, chunk_number)
+        self.cached_embeddings: Dict[Tuple[Hashable, int], np.ndarray] = {}
+        # (content_hash, embedding) of encoded chunks that were not cached yet
+        self.new_cache_entries: List[Tuple[bytes, np.ndarray]] = []
+
+    def split(self, key: Hashable, contents: str) -> List[Chunk]:
+        """
+        Splits a document into chunks that fit the model, with the current embedding instruction of the model.
+
+        The document is tokenized once and the chunks keep their token ids, so they are never detokenized and tokenized again.
+        Only reads the model's tokenizer, so it can run on another thread than encode_pending.
+
+        Args:
+            key (Hashable): Identifies the document in the results, e.g. an appid or recommendationid.
+            contents (str): The text of the document.
+
+        Returns:
+            List[Chunk]: (key, chunk_number, instruction, token_ids, token_length, content_hash) for each chunk.
+                content_hash is None for chunks too long to cache.
+        """
+        instruction = self.instructor.embedding_instruction
+        # The instruction and the end of sequence token are part of every chunk
+        instruction_length = len(self.instructor.get_instruction_token_ids(instruction)) + 1
+
+        # Tokenize the contents in chunks based on the model's max chunk length
+        tokens = self.instructor.tokenize_chunk_text(contents)
+        max_chunk_length = self.instructor.get_max_document_chunk_length()
+
+        # Empty text still gets one chunk with only the end of sequence token, so every document has an embedding
+        chunks = []
+        for chunk_number, i in enumerate(range(0, max(len(tokens), 1), max_chunk_length)):
+            chunk = tokens[i:i + max_chunk_length]
+            chunk_hash = None
+            if len(chunk) <= self.cache_max_tokens:
+                chunk_hash = content_hash(self.instructor.get_model_name(), instruction, chunk)
+
+            logging.debug(f'Chunk {chunk_number} token length: {len(chunk)} | Max chunk length: {max_chunk_length}')
+            chunks.append((key, chunk_number, instruction, chunk, instruction_length + len(chunk), chunk_hash))
+
+        return chunks
+
+    def add_chunks(self, key: Hashable, chunks: List[Chunk], cached_embeddings: Dict[bytes, np.ndarray] = {}):
+        """
+        Queues the chunks of a document from split for encoding.
+
+        Args:
+            key (Hashable): Identifies the document in the results.
+            chunks (List[Chunk]): Every chunk of the document, from split.
+            cached_embeddings (Dict[bytes, np.ndarray]): Embeddings found in the cache by content hash, these chunks are not encoded again.
+        """
+        for chunk in chunks:
+            chunk_hash = chunk[5]
+            if chunk_hash is not None and chunk_hash in cached_embeddings:
+                self.cached_embeddings[(key, chunk[1])] = cached_embeddings[chunk_hash]
+            else:
+                self.pending_chunks.append(chunk)
+        self.pending_chunk_counts[key] = len(chunks)
+
+    def add(self, key: Hashable, contents: str):
+        """
+        Splits a document into chunks and queues them for encoding with the current embedding instruction of the model.
+
+        Args:
+            key (Hashable): Identifies the document in the results, e.g. an appid or recommendationid.
+            contents (str): The text of the document.
+        """
+        self.add_chunks(key, self.split(key, contents))
+
+    def pending_count(self) -> int:
+        """
+        Returns:
+            int: The number of chunks waiting to be encoded.
+        """
+        return len(self.pending_chunks)
+
+    def pending_document_count(self) -> int:
+        """
+        Returns:
+            int: The number of queued documents, including ones that only have cached chunks.
+        """
+        return len(self.pending_chunk_counts)
+
+    def make_batches(self, chunks: List[Chunk]) -> List[List[Chunk]]:
+        """
+        Sorts chunks by token length and groups them into batches.
+
+        Args:
+            chunks (List[Chunk]): The chunks to encode.
+
+        Returns:
+            List[List[Chunk]]: The batches, each a list of chunks.
+        """
+        batches = []
+        batch = []
+        for chunk in sorted(chunks, key = lambda chunk: chunk[4]):
+            # Chunks are sorted, so the newest chunk is the longest and sets the padded length of the batch
+            padded_tokens = (len(batch) + 1) * chunk[4]
+            if len(batch) > 0 and (len(batch) >= self.batch_size or (self.max_batch_tokens is not None and padded_tokens > self.max_batch_tokens)):
+                batches.append(batch)
+                batch = []
+            batch.append(chunk)
+
+        if len(batch) > 0:
+            batches.append(batch)
+
+        return batches
+
+    def encode_pending(self) -> Dict[Hashable, List[List[float]]]:
+        """
+        Encodes every pending chunk, chunks with the same content hash only once.
+
+        Returns:
+            Dict[Hashable, List[List[float]]]: The embeddings of each queued document, in chunk order.
+        """
+        embeddings = {key: [None] * chunk_count for key, chunk_count in self.pending_chunk_counts.items()}
+        for (key, chunk_number), embedding in self.cached_embeddings.items():
+            embeddings[key][chunk_number] = embedding
+
+        # Chunks with the same content hash as an earlier pending chunk reuse its embedding
+        unique_chunks = []
+        duplicate_chunks = []
+        first_chunks = {}
+        for chunk in self.pending_chunks:
+            chunk_hash = chunk[5]
+            if chunk_hash is None:
+                unique_chunks.append(chunk)
+            elif chunk_hash in first_chunks:
+                duplicate_chunks.append(chunk)
+            else:
+                first_chunks[chunk_hash] = chunk
+                unique_chunks.append(chunk)
+
+        batches = self.make_batches(unique_chunks)
+        batch_inputs = [[(instruction, token_ids) for _, _, instruction, token_ids, _, _ in batch] for batch in batches]
+
+        if self.pool is not None:
+            # Every batch of the window is queued at once, so all workers stay busy
+            logging.debug(f'Encoding {len(batches)} batches on {len(self.pool.workers)} encoder processes')
+            all_batch_embeddings = self.pool.encode_batches(batch_inputs)
+        else:
+            all_batch_embeddings = []
+            for batch, batch_input in zip(batches, batch_inputs):
+                logging.debug(f'Encoding batch of {len(batch)} chunks, padded to {batch[-1][4]} tokens')
+                all_batch_embeddings.append(self.instructor.generate_embeddings_for_token_ids(batch_input))
+
+        for batch, batch_embeddings in zip(batches, all_batch_embeddings):
+            for (key, chunk_number, _, _, _, chunk_hash), embedding in zip(batch, batch_embeddings):
+                embeddings[key][chunk_number] = embedding
+                if chunk_hash is not None:
+                    self.new_cache_entries.append((chunk_hash, embedding))
+
+        for key, chunk_number, _, _, _, chunk_hash in duplicate_chunks:
+            first_key, first_chunk_number = first_chunks[chunk_hash][:2]
+            embeddings[key][chunk_number] = embeddings[first_key][first_chunk_number]
+
+        if len(self.cached_embeddings) > 0 or len(duplicate_chunks) > 0:
+            logging.debug(f'Reused {len(self.cached_embeddings)} cached and {len(duplicate_chunks)} duplicate chunk embeddings')
+
+        self.pending_chunks = []
+        self.pending_chunk_counts = {}
+        self.cached_embeddings = {}
+
+        return embeddings
+
+    def take_new_cache_entries(self) -> List[Tuple[bytes, np.ndarray]]:
+        """
+        Returns:
+            List[Tuple[bytes, np.ndarray]]: (content_hash, embedding) of every chunk encoded since the last call that can be cached.
+        """
+        entries = self.new_cache_entries
+        self.new_cache_entries = []
+        return entries
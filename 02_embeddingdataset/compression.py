@@ -0,0 +1,93 @@
+import sqlite3
+import threading
+from typing import Dict, Optional
+import zstandard
+
+class ColumnCodec():
+    """
+    Decompresses column values written by the zstd dictionary compression of 01_gamedataset.
+
+    Compressed values are BLOBs holding a zstd frame whose header names the dictionary it was compressed with,
+    values that were never compressed are TEXT and are returned unchanged.
+    """
+    def __init__(self, dictionaries: Dict[int, bytes] = {}):
+        """
+        Args:
+            dictionaries (Dict[int, bytes]): The trained dictionaries, by dictionary id.
+        """
+        self.dictionaries = {dict_id: zstandard.ZstdCompressionDict(dictionary) for dict_id, dictionary in dictionaries.items()}
+
+        # zstd decompressors must not be shared between threads
+        self._local = threading.local()
+
+    def _decompressor(self, dict_id: int) -> zstandard.ZstdDecompressor:
+        decompressors = getattr(self._local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id == 0:
+                decompressor = zstandard.ZstdDecompressor()
+            elif dict_id in self.dictionaries:
+                decompressor = zstandard.ZstdDecompressor(dict_data = self.dictionaries[dict_id])
+            else:
+                raise ValueError(f"Unknown compression dictionary {dict_id}")
+            decompressors[dict_id] = decompressor
+        return decompressor
+
+    def decompress(self, value) -> Optional[str]:
+        """
+        Decompresses a stored column value.
+
+        Args:
+            value: A value read from a compressed column.
+
+        Returns:
+            Optional[str]: The original text.
+        """
+        if not isinstance(value, bytes):
+            return value
+        dict_id = zstandard.get_frame_parameters(value).dict_id
+        return self._decompressor(dict_id).decompress(value).decode("utf-8")
+
+def load_codec(conn: sqlite3.Connection) -> ColumnCodec:
+    """
+    Creates a codec with every dictionary stored in the database.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Returns:
+        ColumnCodec: The codec, without dictionaries if the database was never compressed.
+    """
+    c = conn.cursor()
+
+    c.execute('''
+        SELECT count(name) FROM sqlite_master WHERE type='table' AND name='compression_dictionaries'
+    ''')
+    if c.fetchone()[0] == 0:
+        c.close()
+        return ColumnCodec()
+
+    c.execute('''
+        SELECT dict_id, dictionary FROM compression_dictionaries
+    ''')
+    dictionaries = {dict_id: dictionary for dict_id, dictionary in c.fetchall()}
+
+    c.close()
+
+    return ColumnCodec(dictionaries)
+
+def register_functions(conn: sqlite3.Connection) -> ColumnCodec:
+    """
+    Makes decompress_column(value) available to SQL on the connection, returning the original text of a stored value.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Returns:
+        ColumnCodec: The loaded codec.
+    """
+    codec = load_codec(conn)
+    conn.create_function("decompress_column", 1, codec.decompress, deterministic = True)
+    return codec
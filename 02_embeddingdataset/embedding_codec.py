@@ -0,0 +1,85 @@
+import pickle
+import struct
+from typing import List, Union
+
+import numpy as np
+
+# Stored embeddings start with this header:
+#   magic (4 bytes), format version, dtype code, reserved (2 bytes), embedding dimension, chunk count
+# followed by chunk count * dimension little-endian floats, one row per chunk.
+MAGIC = b"EMBD"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHII")
+
+DTYPE_CODES = {
+    "float32": 1,
+    "float16": 2,
+}
+CODE_DTYPES = {
+    1: np.dtype("<f4"),
+    2: np.dtype("<f2"),
+}
+
+def encode_embeddings(embeddings: Union[List[List[float]], np.ndarray], dtype: str = "float32") -> bytes:
+    """
+    Encodes the chunk embeddings of a document for storage.
+
+    Args:
+        embeddings (Union[List[List[float]], np.ndarray]): One embedding per chunk, may be empty.
+        dtype (str): The stored precision, float32 or float16.
+
+    Returns:
+        bytes: The header followed by the raw embeddings.
+    """
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported embedding dtype {dtype}")
+
+    dtype_code = DTYPE_CODES[dtype]
+    if len(embeddings) == 0:
+        return HEADER.pack(MAGIC, VERSION, dtype_code, 0, 0, 0)
+
+    array = np.asarray(embeddings, dtype = CODE_DTYPES[dtype_code])
+    if array.ndim != 2:
+        raise ValueError(f"Expected one embedding per chunk, got an array of shape {array.shape}")
+
+    chunk_count, dimension = array.shape
+    return HEADER.pack(MAGIC, VERSION, dtype_code, 0, dimension, chunk_count) + array.tobytes()
+
+def decode_embeddings(blob: bytes) -> np.ndarray:
+    """
+    Decodes stored chunk embeddings without copying them.
+
+    Blobs written before the codec existed (pickled lists) are still read.
+
+    Args:
+        blob (bytes): A stored embedding value.
+
+    Returns:
+        np.ndarray: A read-only (chunk count, dimension) array in the stored precision.
+    """
+    if not is_encoded(blob):
+        embeddings = pickle.loads(blob)
+        if len(embeddings) == 0:
+            return np.empty((0, 0), dtype = np.float32)
+        return np.asarray(embeddings, dtype = np.float32)
+
+    _, version, dtype_code, _, dimension, chunk_count = HEADER.unpack_from(blob)
+    if version != VERSION or dtype_code not in CODE_DTYPES:
+        raise ValueError(f"Unsupported embedding format version {version}, dtype {dtype_code}")
+
+    return np.frombuffer(blob, dtype = CODE_DTYPES[dtype_code], count = chunk_count * dimension, offset = HEADER.size).reshape(chunk_count, dimension)
+
+def is_encoded(blob: bytes) -> bool:
+    """
+    Returns:
+        bool: Whether a stored embedding value was written by this codec, rather than pickled.
+    """
+    return blob[:len(MAGIC)] == MAGIC
+
+def get_encoded_dtype(blob: bytes) -> str:
+    """
+    Returns:
+        str: The stored precision of a value written by this codec.
+    """
+    dtype_code = HEADER.unpack_from(blob)[2]
+    return next(dtype for dtype, code in DTYPE_CODES.items() if code == dtype_code)
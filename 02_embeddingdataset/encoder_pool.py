@@ -0,0 +1,134 @@
+import logging
+import multiprocessing
+import os
+import queue
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from instructor_model import InstructorModel
+
+# Put on the task queue to stop a worker
+STOP_WORKER = None
+
+class WorkerError():
+    """
+    Carries an exception raised in an encoder process back to the parent.
+    """
+    def __init__(self, message: str):
+        self.message = message
+
+class EncoderPool():
+    """
+    Encodes batches on several processes, each pinned to its own cores with its own torch thread budget.
+
+    The workers are forked from the process that loaded the model, so they share its weights copy-on-write
+    instead of each loading a copy. Start the pool before encoding anything in the parent, torch must not
+    have started its thread pool when it is forked. CPU only, CUDA cannot be used in a forked process.
+    """
+    def __init__(
+            self,
+            instructor: InstructorModel,
+            processes: int,
+            threads_per_process: Optional[int] = None):
+        """
+        Args:
+            instructor (InstructorModel): The loaded model, shared with the workers.
+            processes (int): Number of encoder processes.
+            threads_per_process (Optional[int]): Torch threads per process, defaults to the number of cores it is pinned to.
+        """
+        context = multiprocessing.get_context("fork")
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+
+        core_sets = split_cores(sorted(os.sched_getaffinity(0)), processes)
+        self.workers = []
+        for worker_number, cores in enumerate(core_sets):
+            threads = threads_per_process if threads_per_process is not None else len(cores)
+            logging.debug(f'Starting encoder process {worker_number} on cores {cores} with {threads} threads')
+            worker = context.Process(
+                target = run_worker,
+                args = (instructor, cores, threads, self.task_queue, self.result_queue),
+                name = f"encoder-{worker_number}",
+                daemon = True)
+            worker.start()
+            self.workers.append(worker)
+
+    def encode_batches(self, batches: List[List[Tuple[str, List[int]]]]) -> List[List[np.ndarray]]:
+        """
+        Encodes batches on the workers, as many at once as there are workers.
+
+        Args:
+            batches (List[List[Tuple[str, List[int]]]]): (instruction, token ids) for each chunk of each batch.
+
+        Returns:
+            List[List[np.ndarray]]: The embeddings of each batch, in the order of the batches.
+        """
+        for batch_number, batch in enumerate(batches):
+            self.task_queue.put((batch_number, batch))
+
+        results = [None] * len(batches)
+        for _ in range(len(batches)):
+            batch_number, embeddings = self._get_result()
+            if isinstance(embeddings, WorkerError):
+                raise RuntimeError(f"Encoder process failed: {embeddings.message}")
+            results[batch_number] = list(embeddings)
+
+        return results
+
+    def _get_result(self):
+        while True:
+            try:
+                return self.result_queue.get(timeout = 1)
+            except queue.Empty:
+                dead_workers = [worker.name for worker in self.workers if not worker.is_alive()]
+                if len(dead_workers) > 0:
+                    raise RuntimeError(f"Encoder processes {', '.join(dead_workers)} exited early")
+
+    def close(self):
+        """
+        Stops the workers once they are done with the queued batches.
+        """
+        for _ in self.workers:
+            self.task_queue.put(STOP_WORKER)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+def split_cores(cores: List[int], processes: int) -> List[List[int]]:
+    """
+    Splits the cores into contiguous sets, one per process, so neighbouring cores (and their caches) go to the same process.
+
+    Args:
+        cores (List[int]): The cores available to this process.
+        processes (int): Number of sets to make. Processes share cores if there are more processes than cores.
+
+    Returns:
+        List[List[int]]: The cores of each process.
+    """
+    if processes >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(processes)]
+
+    core_sets = []
+    for i in range(processes):
+        core_sets.append(cores[i * len(cores) // processes:(i + 1) * len(cores) // processes])
+    return core_sets
+
+def run_worker(instructor, cores, threads, task_queue, result_queue):
+    import torch
+
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+
+    while True:
+        task = task_queue.get()
+        if task is STOP_WORKER:
+            break
+
+        batch_number, batch = task
+        try:
+            embeddings = np.stack(instructor.generate_embeddings_for_token_ids(batch))
+        except Exception as e:
+            logging.exception("Encoder process failed")
+            embeddings = WorkerError(repr(e))
+        result_queue.put((batch_number, embeddings))
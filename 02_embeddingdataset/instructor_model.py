@@ -1,6 +1,8 @@
 import logging
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+import torch
 from InstructorEmbedding import INSTRUCTOR
 
 # Taken from another project of mine, repo_search
@@ -22,6 +24,9 @@ class InstructorModel():
         default_retrieval_instruction = 'Represent the code search query for retrieving code documents matching the query: '
         self.retrieval_instruction = retrieval_instruction if retrieval_instruction is not None else default_retrieval_instruction
 
+        # Token ids of each instruction, without special tokens
+        self.instruction_token_ids: Dict[str, List[int]] = {}
+
         logging.info("You may see warnings about sequence length being too long. These can be safely ignored.")
     
     def generate_embedding_for_document(self, chunk: str, verbose: bool = False) -> List[float]:
@@ -33,6 +38,51 @@ class InstructorModel():
     def generate_embedding_with_instruction(self, chunk: List[str], verbose: bool = False) -> List[float]:
         return self.model.encode(chunk)[0]
 
+    def generate_embeddings_for_token_ids(self, chunks: List[Tuple[str, List[int]]]) -> List[np.ndarray]:
+        """
+        Encodes pre-tokenized chunks in a single forward pass, without tokenizing them again.
+
+        Builds the same inputs as INSTRUCTOR.encode does for [instruction, chunk] pairs: the instruction tokens
+        followed by the chunk tokens and the end of sequence token, with the instruction left out of the pooling.
+
+        Args:
+            chunks (List[Tuple[str, List[int]]]): (instruction, token ids) for each chunk, token ids from tokenize_chunk_text.
+
+        Returns:
+            List[np.ndarray]: The embedding of each chunk.
+        """
+        tokenizer = self.model.tokenizer
+        max_length = self.model.get_max_seq_length()
+
+        sequences = []
+        context_masks = []
+        for instruction, token_ids in chunks:
+            instruction_token_ids = self.get_instruction_token_ids(instruction)
+            sequences.append((instruction_token_ids + token_ids)[:max_length - 1] + [tokenizer.eos_token_id])
+            # Like INSTRUCTOR, single token instructions are not masked
+            context_masks.append(len(instruction_token_ids) if len(instruction_token_ids) > 1 else 0)
+
+        padded_length = max(len(sequence) for sequence in sequences)
+        input_ids = torch.full((len(sequences), padded_length), tokenizer.pad_token_id, dtype = torch.long)
+        attention_mask = torch.zeros((len(sequences), padded_length), dtype = torch.long)
+        for i, sequence in enumerate(sequences):
+            input_ids[i, :len(sequence)] = torch.tensor(sequence, dtype = torch.long)
+            attention_mask[i, :len(sequence)] = 1
+
+        device = self.model._target_device
+        self.model.to(device)
+        self.model.eval()
+
+        features = {
+            'input_ids': input_ids.to(device),
+            'attention_mask': attention_mask.to(device),
+            'context_masks': torch.tensor(context_masks, dtype = torch.long).to(device),
+        }
+        with torch.no_grad():
+            embeddings = self.model.forward(features)['sentence_embedding']
+
+        return list(embeddings.detach().cpu().numpy())
+
     def get_max_document_chunk_length(self) -> int:
         embed_document_instruction_length = len(self.tokenize(self.embedding_instruction))
         return self.model.get_max_seq_length() - embed_document_instruction_length
@@ -46,6 +96,16 @@ class InstructorModel():
     
     def detokenize(self, tokens: List[int]) -> str:
         return self.model.tokenizer.decode(tokens)
+
+    def tokenize_chunk_text(self, text: str) -> List[int]:
+        # No end of sequence token, generate_embeddings_for_token_ids adds one to every chunk
+        return self.model.tokenizer(text.strip(), add_special_tokens = False)['input_ids']
+
+    def get_instruction_token_ids(self, instruction: str) -> List[int]:
+        token_ids = self.instruction_token_ids.get(instruction)
+        if token_ids is None:
+            token_ids = self.instruction_token_ids[instruction] = self.model.tokenizer(instruction, add_special_tokens = False)['input_ids']
+        return token_ids
     
     @staticmethod
     def get_model_type() -> str:
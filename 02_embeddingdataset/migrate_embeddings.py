@@ -0,0 +1,96 @@
+"""
+Rewrites stored embeddings in place with the binary embedding codec, replacing pickled lists.
+
+Also converts embeddings between float32 and float16. Safe to interrupt and re-run,
+values that are already stored in the requested format are left alone.
+
+Usage:
+    python migrate_embeddings.py --db steam.db --dtype float16 --vacuum
+"""
+import click
+import embedding_codec
+import sqlite_helpers
+import tqdm
+import logging
+import os
+
+COLOR_DARK_GREY = "\x1b[38;5;240m"
+COLOR_BOLD = "\x1b[1m"
+COLOR_RESET = "\x1b[0m"
+LOGGING_FORMAT = COLOR_DARK_GREY + '[%(asctime)s - %(name)s]' + COLOR_RESET + COLOR_BOLD + ' %(levelname)s:' + COLOR_RESET + ' %(message)s'
+
+EMBEDDING_TABLES = ["description_embeddings", "review_embeddings"]
+
+@click.command()
+@click.option('--db', required=True, help='Path to SQLite database to migrate')
+@click.option('--dtype', default='float32', type=click.Choice(['float32', 'float16']), help='Precision to store the embeddings in')
+@click.option('--batch-size', default=5000, help='Number of rows to rewrite per transaction')
+@click.option('--vacuum', is_flag=True, help='Vacuum the database afterwards to return the freed space to the file system')
+@click.option('--verbose', is_flag=True, help='Print verbose output')
+def main(db, dtype, batch_size, vacuum, verbose):
+    logging.basicConfig(format = LOGGING_FORMAT, level = logging.INFO if not verbose else logging.DEBUG)
+
+    if not os.path.exists(db):
+        logging.error(f"Input SQLite database {db} does not exist")
+        exit(1)
+
+    conn = sqlite_helpers.create_connection(db)
+    if not sqlite_helpers.check_output_db_tables(conn):
+        logging.error(f"SQLite database {db} does not have any embeddings to migrate")
+        exit(1)
+
+    for table in EMBEDDING_TABLES:
+        migrate_table(conn, table, dtype, batch_size)
+
+    if vacuum:
+        logging.info("Vacuuming database")
+        conn.execute("VACUUM")
+
+    conn.close()
+
+def needs_migration(blob: bytes, dtype: str) -> bool:
+    return not embedding_codec.is_encoded(blob) or embedding_codec.get_encoded_dtype(blob) != dtype
+
+def migrate_table(conn, table: str, dtype: str, batch_size: int):
+    c = conn.cursor()
+
+    c.execute(f'''
+        SELECT count(*) FROM {table}
+    ''')
+    bar = tqdm.tqdm(total = c.fetchone()[0], desc = f"Migrating {table}", smoothing = 0.1)
+
+    # Walks the table in rowid order, so each batch is a short range scan
+    migrated_count = 0
+    last_rowid = -(2 ** 63)
+    while True:
+        c.execute(f'''
+            SELECT rowid, embedding FROM {table}
+            WHERE rowid > ?
+            ORDER BY rowid
+            LIMIT ?
+        ''', (last_rowid, batch_size))
+        rows = c.fetchall()
+        if len(rows) == 0:
+            break
+
+        updates = [
+            (embedding_codec.encode_embeddings(embedding_codec.decode_embeddings(embedding), dtype), rowid)
+            for rowid, embedding in rows
+            if needs_migration(embedding, dtype)
+        ]
+        with conn:
+            c.executemany(f'''
+                UPDATE {table} SET embedding = ? WHERE rowid = ?
+            ''', updates)
+
+        migrated_count += len(updates)
+        last_rowid = rows[-1][0]
+        bar.update(len(rows))
+
+    bar.close()
+    c.close()
+
+    logging.info(f"Rewrote {migrated_count} rows of {table}")
+
+if __name__ == "__main__":
+    main()
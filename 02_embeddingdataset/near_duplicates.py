@@ -0,0 +1,141 @@
+import re
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Reviews with fewer words than this are left to the exact embedding cache, their shingles say too little
+MIN_WORDS = 8
+
+WORD_PATTERN = re.compile(r"\w+")
+
+class MinHasher():
+    """
+    Computes MinHash signatures of texts over word shingles, and finds near-duplicates among them with LSH.
+
+    The fraction of equal values in two signatures estimates the Jaccard similarity of the shingle sets of the texts.
+    Signatures are split into bands, texts sharing any band are candidates, and candidates are verified on the full signature.
+    """
+    def __init__(
+            self,
+            num_perm: int = 128,
+            bands: int = 16,
+            shingle_size: int = 3,
+            seed: int = 1):
+        """
+        Args:
+            num_perm (int): Number of hash functions, the length of each signature.
+            bands (int): Number of LSH bands, num_perm must be a multiple of it. More bands find less similar candidates.
+            shingle_size (int): Number of consecutive words per shingle.
+            seed (int): Seed of the hash functions, signatures are only comparable with the same seed.
+        """
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        # Multiply-shift hashing, the multiplication wraps around at 64 bits
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2 ** 63, size = num_perm, dtype = np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, size = num_perm, dtype = np.uint64)
+
+    def shingles(self, text: str) -> List[str]:
+        words = WORD_PATTERN.findall(text.lower())
+        if len(words) < MIN_WORDS:
+            return []
+        return [" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)]
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """
+        Args:
+            text (str): The text to sign.
+
+        Returns:
+            Optional[np.ndarray]: The MinHash signature, None if the text is too short.
+        """
+        shingles = self.shingles(text)
+        if len(shingles) == 0:
+            return None
+
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in set(shingles)), dtype = np.uint64)
+        with np.errstate(over = "ignore"):
+            permuted = (hashes[:, None] * self.a[None, :] + self.b[None, :]) >> np.uint64(32)
+        return permuted.min(axis = 0).astype(np.uint32)
+
+    def find_groups(self, signatures: Dict[int, np.ndarray], threshold: float) -> List[List[int]]:
+        """
+        Groups texts whose estimated similarity to another text of the group is at least the threshold.
+
+        Args:
+            signatures (Dict[int, np.ndarray]): The signature of each text, by id.
+            threshold (float): Minimum estimated Jaccard similarity of near-duplicates.
+
+        Returns:
+            List[List[int]]: The ids of each group with more than one text.
+        """
+        parents = {text_id: text_id for text_id in signatures}
+
+        def find(text_id):
+            while parents[text_id] != text_id:
+                parents[text_id] = parents[parents[text_id]]
+                text_id = parents[text_id]
+            return text_id
+
+        for band in range(self.bands):
+            buckets: Dict[bytes, List[int]] = {}
+            for text_id, signature in signatures.items():
+                band_key = signature[band * self.rows:(band + 1) * self.rows].tobytes()
+                buckets.setdefault(band_key, []).append(text_id)
+
+            for bucket in buckets.values():
+                first = bucket[0]
+                for other in bucket[1:]:
+                    if find(first) == find(other):
+                        continue
+                    if np.mean(signatures[first] == signatures[other]) >= threshold:
+                        parents[find(other)] = find(first)
+
+        groups: Dict[int, List[int]] = {}
+        for text_id in signatures:
+            groups.setdefault(find(text_id), []).append(text_id)
+
+        return [group for group in groups.values() if len(group) > 1]
+
+def find_duplicate_reviews(
+        reviews: List[Tuple[int, str, bool]],
+        hasher: MinHasher,
+        threshold: float) -> List[Tuple[int, int]]:
+    """
+    Finds the reviews of a game that do not need their own embedding, because they are near-duplicates of another review.
+
+    Each group of near-duplicates keeps one representative: a review that already has an embedding if there is one,
+    otherwise the oldest. Reviews that already have an embedding are never mapped to another review.
+
+    Args:
+        reviews (List[Tuple[int, str, bool]]): (recommendationid, review, has_embedding) of every review of the game
+            that is not a duplicate already or skipped.
+        hasher (MinHasher): Computes the signatures.
+        threshold (float): Minimum estimated Jaccard similarity of near-duplicates.
+
+    Returns:
+        List[Tuple[int, int]]: (recommendationid, representative recommendationid) of each review to map to a representative.
+    """
+    has_embedding = {}
+    signatures = {}
+    for recommendationid, review, embedded in reviews:
+        signature = hasher.signature(review or "")
+        if signature is not None:
+            signatures[recommendationid] = signature
+            has_embedding[recommendationid] = embedded
+
+    duplicates = []
+    for group in hasher.find_groups(signatures, threshold):
+        representative = min(group, key = lambda recommendationid: (not has_embedding[recommendationid], recommendationid))
+        for recommendationid in group:
+            if recommendationid != representative and not has_embedding[recommendationid]:
+                duplicates.append((recommendationid, representative))
+
+    return duplicates
@@ -0,0 +1,145 @@
+import logging
+import queue
+import threading
+from typing import Callable, Hashable, Iterator, Optional, Tuple
+
+import sqlite_helpers
+from batch_encoder import BatchEncoder
+
+# Put on a queue by a stage once it has nothing more to send
+STAGE_DONE = None
+
+class StageError():
+    """
+    Carries an exception raised on a pipeline thread to the thread reading its queue.
+    """
+    def __init__(self, error: Exception):
+        self.error = error
+
+def put_while_alive(output_queue: queue.Queue, item, thread: threading.Thread):
+    """
+    Puts an item on a bounded queue, raising instead of blocking forever if the thread reading it has died.
+    """
+    while True:
+        try:
+            output_queue.put(item, timeout = 1)
+            return
+        except queue.Full:
+            if not thread.is_alive():
+                raise RuntimeError(f"Pipeline stage {thread.name} exited early")
+
+def embed_documents(
+        db: str,
+        read_documents: Callable[..., Iterator[Tuple[Hashable, object, str]]],
+        write_rows: Callable[..., None],
+        encoder: BatchEncoder,
+        progress = None,
+        sort_window: int = 1024,
+        commit_size: int = 1000,
+        write_cache_entries: Optional[Callable[..., None]] = None):
+    """
+    Embeds documents with a three stage pipeline, so the model never waits on SQLite or the tokenizer:
+        1. A reader thread streams the documents from one query, splits them into chunks ahead of the encoder
+           and looks up the embeddings of short chunks in the embedding cache.
+        2. The calling thread encodes the remaining chunks in length sorted batches.
+        3. A writer thread inserts the embeddings, and the new cache entries, and commits them in large transactions.
+    The stages are connected by bounded queues, so a slow stage holds back the ones before it.
+
+    Args:
+        db (str): The path to the SQLite database. The reader and writer open their own connections.
+        read_documents (Callable): Called with a connection, yields (key, extra, contents) for every document to embed.
+        write_rows (Callable): Called with a connection and a list of (key, embeddings, extra) rows, inserts them without committing.
+        encoder (BatchEncoder): The encoder, splitting with the current embedding instruction of its model.
+        progress: Optional tqdm progress bar, updated as embeddings are written.
+        sort_window (int): Number of chunks to collect and sort by length before encoding them.
+        commit_size (int): Number of documents to insert per transaction.
+        write_cache_entries (Optional[Callable]): Called with a connection and a list of (content_hash, embedding) entries
+            new to the embedding cache, inserts them without committing. The cache is only used if the encoder caches chunks.
+    """
+    # Up to two windows of documents are tokenized ahead of the encoder
+    documents_queue = queue.Queue(maxsize = 2 * sort_window)
+    results_queue = queue.Queue(maxsize = 4)
+    stop_event = threading.Event()
+    writer_errors = []
+
+    reader = threading.Thread(target = read_stage, args = (db, read_documents, encoder, documents_queue, stop_event), name = "embedding-reader", daemon = True)
+    writer = threading.Thread(target = write_stage, args = (db, write_rows, write_cache_entries, results_queue, progress, commit_size, writer_errors), name = "embedding-writer", daemon = True)
+    reader.start()
+    writer.start()
+
+    try:
+        extras = {}
+        reader_done = False
+        while not reader_done:
+            item = documents_queue.get()
+            if item is STAGE_DONE:
+                reader_done = True
+            elif isinstance(item, StageError):
+                raise item.error
+            else:
+                key, extra, chunks, cached_embeddings = item
+                encoder.add_chunks(key, chunks, cached_embeddings)
+                extras[key] = extra
+
+            # Documents whose chunks were all cached count too, so they are not held back indefinitely
+            if encoder.pending_count() >= sort_window or encoder.pending_document_count() >= sort_window or (reader_done and len(extras) > 0):
+                rows = [(key, embeddings, extras.pop(key)) for key, embeddings in encoder.encode_pending().items()]
+                put_while_alive(results_queue, (rows, encoder.take_new_cache_entries()), writer)
+
+        put_while_alive(results_queue, STAGE_DONE, writer)
+        writer.join()
+    except RuntimeError:
+        # The writer died, its own error is more useful
+        if len(writer_errors) > 0:
+            raise writer_errors[0]
+        raise
+    finally:
+        stop_event.set()
+
+    if len(writer_errors) > 0:
+        raise writer_errors[0]
+
+def read_stage(db, read_documents, encoder, documents_queue, stop_event):
+    try:
+        conn = sqlite_helpers.create_connection(db)
+        for key, extra, contents in read_documents(conn):
+            if stop_event.is_set():
+                break
+
+            chunks = encoder.split(key, contents)
+            content_hashes = [chunk[5] for chunk in chunks if chunk[5] is not None]
+            cached_embeddings = sqlite_helpers.get_cached_embeddings(conn, content_hashes) if len(content_hashes) > 0 else {}
+            documents_queue.put((key, extra, chunks, cached_embeddings))
+        conn.close()
+        documents_queue.put(STAGE_DONE)
+    except Exception as e:
+        logging.exception("Embedding reader failed")
+        documents_queue.put(StageError(e))
+
+def write_stage(db, write_rows, write_cache_entries, results_queue, progress, commit_size, errors):
+    conn = sqlite_helpers.create_connection(db)
+    try:
+        uncommitted = 0
+        while True:
+            item = results_queue.get()
+            if item is STAGE_DONE:
+                break
+
+            rows, cache_entries = item
+            write_rows(conn, rows)
+            if write_cache_entries is not None and len(cache_entries) > 0:
+                write_cache_entries(conn, cache_entries)
+            uncommitted += len(rows)
+            if uncommitted >= commit_size:
+                conn.commit()
+                uncommitted = 0
+
+            if progress is not None:
+                progress.update(len(rows))
+
+        conn.commit()
+    except Exception as e:
+        logging.exception("Embedding writer failed")
+        errors.append(e)
+    finally:
+        conn.close()
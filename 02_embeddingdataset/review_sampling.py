@@ -0,0 +1,104 @@
+import json
+import re
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+# Reasons recorded for reviews that are not embedded
+SKIPPED_TOO_SHORT = "too_short"
+SKIPPED_OVER_APP_CAP = "over_app_cap"
+
+WORD_PATTERN = re.compile(r"\w+")
+
+def get_helpfulness(review_data: dict) -> Tuple[float, int]:
+    # weighted_vote_score is a string in the Steam API
+    try:
+        weighted_vote_score = float(review_data.get("weighted_vote_score") or 0)
+    except ValueError:
+        weighted_vote_score = 0.0
+    return (weighted_vote_score, int(review_data.get("votes_up") or 0))
+
+def get_tiers(candidate_ids: List[int], sort_key: Dict[int, object], tier_count: int) -> Dict[int, int]:
+    # Tier 0 holds the candidates with the highest keys
+    ranked = sorted(candidate_ids, key = lambda recommendationid: sort_key[recommendationid], reverse = True)
+    return {recommendationid: rank * tier_count // len(ranked) for rank, recommendationid in enumerate(ranked)}
+
+def sample_reviews(candidates: List[Tuple[int, Tuple[float, int], int]], count: int, tier_count: int = 3) -> Tuple[List[int], List[int]]:
+    """
+    Picks reviews spread over helpfulness and recency.
+
+    The candidates are split into tiers by helpfulness and by recency, and the strata (one per pair of tiers) take turns
+    contributing their most helpful remaining review, so new and old, popular and obscure reviews are all represented.
+
+    Args:
+        candidates (List[Tuple[int, Tuple[float, int], int]]): (recommendationid, helpfulness, timestamp_created) of each review.
+        count (int): The number of reviews to pick.
+        tier_count (int): The number of helpfulness tiers and of recency tiers.
+
+    Returns:
+        Tuple[List[int], List[int]]: The recommendationids picked and the ones left out.
+    """
+    if len(candidates) <= count:
+        return [recommendationid for recommendationid, _, _ in candidates], []
+
+    candidate_ids = [recommendationid for recommendationid, _, _ in candidates]
+    helpfulness = {recommendationid: review_helpfulness for recommendationid, review_helpfulness, _ in candidates}
+    recency = {recommendationid: timestamp_created for recommendationid, _, timestamp_created in candidates}
+
+    helpfulness_tiers = get_tiers(candidate_ids, helpfulness, tier_count)
+    recency_tiers = get_tiers(candidate_ids, recency, tier_count)
+
+    strata: Dict[Tuple[int, int], List[int]] = {}
+    for recommendationid in sorted(candidate_ids, key = lambda recommendationid: helpfulness[recommendationid], reverse = True):
+        strata.setdefault((helpfulness_tiers[recommendationid], recency_tiers[recommendationid]), []).append(recommendationid)
+
+    picked = []
+    stratum_queues = [deque(strata[key]) for key in sorted(strata)]
+    while len(picked) < count:
+        for stratum_queue in stratum_queues:
+            if len(stratum_queue) > 0 and len(picked) < count:
+                picked.append(stratum_queue.popleft())
+
+    picked_set = set(picked)
+    return picked, [recommendationid for recommendationid in candidate_ids if recommendationid not in picked_set]
+
+def apply_policy(
+        candidates: List[Tuple[int, Optional[str], Optional[str]]],
+        embedded_count: int,
+        max_reviews_per_app: Optional[int],
+        min_review_words: int,
+        representatives: Set[int] = set()) -> List[Tuple[int, str]]:
+    """
+    Decides which reviews of a game to skip instead of embedding.
+
+    Representatives of near-duplicates are always kept, their near-duplicates have no embedding of their own.
+
+    Args:
+        candidates (List[Tuple[int, Optional[str], Optional[str]]]): (recommendationid, review, datajson) of each review of the game waiting for an embedding.
+        embedded_count (int): The number of reviews of the game that already have an embedding, they count towards the cap.
+        max_reviews_per_app (Optional[int]): The maximum number of embedded reviews per game, None for no cap.
+        min_review_words (int): Reviews with fewer words are skipped.
+        representatives (Set[int]): The recommendationids of the game's near-duplicate representatives, they count towards the cap.
+
+    Returns:
+        List[Tuple[int, str]]: (recommendationid, reason) of each review to skip.
+    """
+    skipped = []
+    long_enough = []
+    kept_count = embedded_count
+    for recommendationid, review, datajson in candidates:
+        if recommendationid in representatives:
+            kept_count += 1
+            continue
+
+        if len(WORD_PATTERN.findall(review or "")) < min_review_words:
+            skipped.append((recommendationid, SKIPPED_TOO_SHORT))
+            continue
+
+        review_data = json.loads(datajson) if datajson is not None else {}
+        long_enough.append((recommendationid, get_helpfulness(review_data), int(review_data.get("timestamp_created") or 0)))
+
+    if max_reviews_per_app is not None:
+        _, left_out = sample_reviews(long_enough, max(0, max_reviews_per_app - kept_count))
+        skipped += [(recommendationid, SKIPPED_OVER_APP_CAP) for recommendationid in left_out]
+
+    return skipped
@@ -1,12 +1,18 @@
 
 import click
 from instructor_model import InstructorModel
+from batch_encoder import BatchEncoder
+from encoder_pool import EncoderPool
+from near_duplicates import MinHasher, find_duplicate_reviews
+import review_sampling
+import pipeline
 #from sqlite_helpers import * # TODO: Define functions
 import sqlite_helpers
 import tqdm
+import torch
 import logging
 import os
-from typing import List
+from functools import partial
 
 COLOR_DARK_GREY = "\x1b[38;5;240m"
 COLOR_BOLD = "\x1b[1m"
@@ -19,8 +25,20 @@ LOGGING_FORMAT = COLOR_DARK_GREY + '[%(asctime)s - %(name)s]' + COLOR_RESET + CO
 @click.option('--embed-description', default='Represent a video game that is self-described as:', help='Embedding instruction for game descriptions')
 @click.option('--embed-review', default='Represent a video game that a player would review as: ', help='Embedding instruction for game reviews')
 @click.option('--model-name', default='hkunlp/instructor-large', help='Name of the instructor model to use')
+@click.option('--batch-size', default=32, help='Maximum number of chunks encoded per batch')
+@click.option('--max-batch-tokens', default=None, type=int, help='Maximum number of tokens per batch, including padding (e.g. 8192)')
+@click.option('--sort-window', default=1024, help='Number of chunks to collect and sort by length before encoding them')
+@click.option('--commit-size', default=1000, help='Number of embeddings to write to the database per transaction')
+@click.option('--embedding-dtype', default='float32', type=click.Choice(['float32', 'float16']), help='Precision to store the embeddings in, float16 halves their size')
+@click.option('--cache-max-tokens', default=32, help='Cache the embeddings of chunks of up to this many tokens by content, so identical short reviews are encoded once (0 to disable)')
+@click.option('--near-duplicate-threshold', default=0.8, help='Reviews of a game at least this similar (estimated Jaccard similarity of word shingles) share one embedding (0 to disable)')
+@click.option('--max-reviews-per-app', default=None, type=int, help='Embed at most this many reviews per game, picked across helpfulness and recency (e.g. 200)')
+@click.option('--min-review-words', default=0, help='Skip reviews with fewer words than this')
+@click.option('--resample-reviews', is_flag=True, help='Reconsider previously skipped reviews with the current sampling options')
+@click.option('--processes', default=1, help='Number of encoder processes, each pinned to its share of the CPU cores (CPU only)')
+@click.option('--threads-per-process', default=None, type=int, help='Torch threads per encoder process, defaults to its number of cores')
 @click.option('--verbose', is_flag=True, help='Print verbose output')
-def main(db, embed_description, embed_review, model_name, verbose):
+def main(db, embed_description, embed_review, model_name, batch_size, max_batch_tokens, sort_window, commit_size, embedding_dtype, cache_max_tokens, near_duplicate_threshold, max_reviews_per_app, min_review_words, resample_reviews, processes, threads_per_process, verbose):
     logging.basicConfig(format = LOGGING_FORMAT, level = logging.INFO if not verbose else logging.DEBUG)
     # Load input sqlite database
     # Check output tables & create if necessary
@@ -33,6 +51,12 @@ def main(db, embed_description, embed_review, model_name, verbose):
     # Update game reviews
     #   Same as above, but for reviews
 
+    # The encoder processes are forked after the model is loaded, and CUDA cannot be used in a forked process.
+    # INSTRUCTOR puts the model on the GPU whenever there is one, so the pool is CPU only.
+    if processes > 1 and torch.cuda.is_available():
+        logging.error("--processes is for CPU only hosts, a CUDA GPU is available so encode on it with a single process")
+        exit(1)
+
     # Load input sqlite database
     if not os.path.exists(db):
         logging.error(f"Input SQLite database {db} does not exist")
@@ -49,6 +73,20 @@ def main(db, embed_description, embed_review, model_name, verbose):
     if not sqlite_helpers.check_output_db_tables(conn):
         logging.info(f"Output SQLite database {db} does not have the required tables. Creating them now.")
         sqlite_helpers.create_output_db_tables(conn)
+
+    sqlite_helpers.add_normalized_description_columns(conn)
+    sqlite_helpers.create_embedding_cache_table(conn)
+    sqlite_helpers.create_review_duplicates_table(conn)
+    sqlite_helpers.create_skipped_reviews_table(conn)
+    sqlite_helpers.add_banned_content_column(conn)
+
+    empty_count = sqlite_helpers.delete_empty_embeddings(conn)
+    if empty_count > 0:
+        logging.info(f"Deleted {empty_count} embeddings of empty texts, they will be embedded again")
+
+    # Flag games with banned content descriptors once, so selecting what to embed does not parse them for every review
+    flagged_count = sqlite_helpers.update_banned_content_flags(conn)
+    logging.info(f"Updated the banned content flag of {flagged_count} games")
     
     # Load instructor model
     instructor = InstructorModel(
@@ -58,66 +96,117 @@ def main(db, embed_description, embed_review, model_name, verbose):
         model_name = model_name,
     )
 
-    # Update game descriptions
-    instructor.embedding_instruction = embed_description
-    update_description_embeddings(conn, instructor)
+    # Fork the encoder processes before anything is encoded, they share the loaded weights
+    pool = None
+    if processes > 1:
+        logging.info(f"Starting {processes} encoder processes")
+        pool = EncoderPool(instructor, processes, threads_per_process = threads_per_process)
 
-    # Update game reviews
-    instructor.embedding_instruction = embed_review
-    update_review_embeddings(conn, instructor)
+    encoder = BatchEncoder(instructor, batch_size = batch_size, max_batch_tokens = max_batch_tokens, pool = pool, cache_max_tokens = cache_max_tokens)
+
+    try:
+        # Update game descriptions
+        instructor.embedding_instruction = embed_description
+        update_description_embeddings(conn, db, encoder, sort_window, commit_size, embedding_dtype)
+
+        # Cleared before finding near-duplicates, so reviews skipped before can be representatives again
+        if resample_reviews:
+            sqlite_helpers.clear_skipped_reviews(conn)
+
+        # Map near-duplicate reviews to one representative, so only it is embedded
+        if near_duplicate_threshold > 0:
+            update_review_duplicates(conn, near_duplicate_threshold)
+
+        # A skipped representative would drop its whole group of near-duplicates, earlier runs could skip them
+        unskipped_count = sqlite_helpers.unskip_review_representatives(conn)
+        if unskipped_count > 0:
+            logging.info(f"Unskipped {unskipped_count} representative reviews")
+
+        # Pick which of the remaining reviews to embed
+        if max_reviews_per_app is not None or min_review_words > 0:
+            update_skipped_reviews(conn, max_reviews_per_app, min_review_words)
+
+        # Update game reviews
+        instructor.embedding_instruction = embed_review
+        update_review_embeddings(conn, db, encoder, sort_window, commit_size, embedding_dtype)
+    finally:
+        if pool is not None:
+            pool.close()
 
     # Close connection
     conn.close()
 
-def generate_embeddings_for_contents(
-        file_contents: str,
-        instructor: InstructorModel) -> List[List[float]]:
-    # Tokenize the file contents in chunks based on the model's max chunk length
-    tokens = instructor.tokenize(file_contents)
-    max_chunk_length = instructor.get_max_document_chunk_length()
-
-    # Split tokens into chunks
-    all_embeddings: List[List[float]] = []
-    for chunk_number, i in enumerate(range(0, len(tokens), max_chunk_length)):
-
-        chunk = tokens[i:i + max_chunk_length]
-        chunk = instructor.detokenize(chunk)
-        
-        logging.debug(f'Chunk {chunk_number} token length: {min(max_chunk_length, len(tokens) - i)} | Chunk string length: {len(chunk)} | Max chunk length: {max_chunk_length}')
-        all_embeddings.append(instructor.generate_embedding_for_document(chunk))
-    
-    return all_embeddings
+def update_description_embeddings(conn, db, encoder, sort_window, commit_size, embedding_dtype):
+    # Strip the HTML of the descriptions before they are tokenized, the result is cached in appdetails
+    normalized_count = sqlite_helpers.update_normalized_descriptions(conn)
+    logging.info(f"Normalized {normalized_count} store descriptions")
 
-def update_description_embeddings(conn, instructor):
-    # Find game app ids that need embeddings
-    appids_need_updating = sqlite_helpers.get_game_appids_without_description_embeddings(conn)
+    # Count game app ids that need embeddings, the pipeline streams them itself
+    description_count = sqlite_helpers.count_game_descriptions_without_embeddings(conn)
 
     # Update embeddings
-    logging.info(f"Updating {len(appids_need_updating)} description embeddings")
+    logging.info(f"Updating {description_count} description embeddings")
     logging.info("NOTE: This only includes game appids, not all appids.")
-    for appid in tqdm.tqdm(appids_need_updating, desc = "Updating description embeddings", smoothing = 0.1):
-        # Get description
-        description = sqlite_helpers.get_input_description_for_appid(conn, appid)
-        # Generate embeddings
-        embeddings = generate_embeddings_for_contents(description, instructor)
-        # Insert embeddings
-        sqlite_helpers.insert_description_embeddings(conn, appid, embeddings)
-
-def update_review_embeddings(conn, instructor):
-    new_recommendationids = sqlite_helpers.get_recommendationids_without_embeddings(conn)
-    logging.info(f"Updating {len(new_recommendationids)} review embeddings")
+    bar = tqdm.tqdm(total = description_count, desc = "Updating description embeddings", smoothing = 0.1)
+    pipeline.embed_documents(
+        db,
+        sqlite_helpers.iter_game_descriptions_without_embeddings,
+        partial(sqlite_helpers.insert_description_embedding_rows, dtype = embedding_dtype),
+        encoder,
+        progress = bar,
+        sort_window = sort_window,
+        commit_size = commit_size,
+        write_cache_entries = partial(sqlite_helpers.insert_cached_embeddings, dtype = embedding_dtype))
+    bar.close()
+
+def update_review_duplicates(conn, threshold):
+    appids = sqlite_helpers.get_appids_with_reviews_without_embeddings(conn)
+    logging.info(f"Finding near-duplicate reviews of {len(appids)} games")
+
+    hasher = MinHasher()
+    duplicate_count = 0
+    for appid in tqdm.tqdm(appids, desc = "Finding near-duplicate reviews", smoothing = 0.1):
+        duplicates = find_duplicate_reviews(sqlite_helpers.get_reviews_for_deduplication(conn, appid), hasher, threshold)
+        if len(duplicates) > 0:
+            sqlite_helpers.insert_review_duplicates(conn, appid, duplicates)
+            duplicate_count += len(duplicates)
+
+    logging.info(f"Mapped {duplicate_count} near-duplicate reviews to a representative review")
+
+def update_skipped_reviews(conn, max_reviews_per_app, min_review_words):
+    appids = sqlite_helpers.get_appids_with_reviews_without_embeddings(conn)
+    logging.info(f"Sampling the reviews of {len(appids)} games")
+
+    skipped_count = 0
+    for appid in tqdm.tqdm(appids, desc = "Sampling reviews", smoothing = 0.1):
+        skipped = review_sampling.apply_policy(
+            sqlite_helpers.get_reviews_without_embeddings_for_appid(conn, appid),
+            sqlite_helpers.count_review_embeddings_for_appid(conn, appid),
+            max_reviews_per_app,
+            min_review_words,
+            sqlite_helpers.get_review_representatives_for_appid(conn, appid))
+        if len(skipped) > 0:
+            sqlite_helpers.insert_skipped_reviews(conn, appid, skipped)
+            skipped_count += len(skipped)
+
+    logging.info(f"Skipped {skipped_count} reviews")
+
+def update_review_embeddings(conn, db, encoder, sort_window, commit_size, embedding_dtype):
+    review_count = sqlite_helpers.count_reviews_without_embeddings(conn)
+    logging.info(f"Updating {review_count} review embeddings")
 
     # Update reviews
-    bar = tqdm.tqdm(new_recommendationids, desc = "Updating review embeddings", smoothing = 0.1)
-    for recommendationid in bar:
-        # Get review
-        review = sqlite_helpers.get_review_for_recommendationid(conn, recommendationid)
-        # Generate embeddings
-        embeddings = generate_embeddings_for_contents(review, instructor)
-        # Get appid
-        appid = sqlite_helpers.get_appid_for_recommendationid(conn, recommendationid)
-        # Insert embeddings
-        sqlite_helpers.insert_review_embeddings(conn, recommendationid, embeddings, appid)
+    bar = tqdm.tqdm(total = review_count, desc = "Updating review embeddings", smoothing = 0.1)
+    pipeline.embed_documents(
+        db,
+        sqlite_helpers.iter_reviews_without_embeddings,
+        partial(sqlite_helpers.insert_review_embedding_rows, dtype = embedding_dtype),
+        encoder,
+        progress = bar,
+        sort_window = sort_window,
+        commit_size = commit_size,
+        write_cache_entries = partial(sqlite_helpers.insert_cached_embeddings, dtype = embedding_dtype))
+    bar.close()
 
 if __name__ == '__main__':
     main()
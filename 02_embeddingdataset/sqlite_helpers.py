@@ -1,8 +1,9 @@
 import sqlite3
 import logging
-from typing import List, Optional, Set, Dict
-import pickle
-import json
+from typing import List, Optional, Set, Dict, Iterator, Tuple
+import compression
+import embedding_codec
+import text_normalization
 
 
 '''
@@ -37,7 +38,14 @@ def create_connection(db_file: str = "steam.db") -> sqlite3.Connection:
         sqlite3.Connection: A connection to the SQLite database.
     """
     logging.debug("Creating connection to SQLite database")
-    return sqlite3.connect(db_file)
+    conn = sqlite3.connect(db_file)
+
+    # Lets the embedding pipeline stream reads on one connection while it commits on another
+    conn.execute('PRAGMA journal_mode=WAL')
+
+    # Descriptions and reviews may be stored compressed by 01_gamedataset, read them through decompress_column
+    compression.register_functions(conn)
+    return conn
 
 def check_table(conn: sqlite3.Connection, table_name: str) -> bool:
     """
@@ -200,7 +208,7 @@ def get_input_description_for_appid(conn: sqlite3.Connection, appid: int) -> str
     c = conn.cursor()
 
     c.execute('''
-        SELECT storedescription FROM appdetails WHERE appid = ?
+        SELECT decompress_column(storedescription) FROM appdetails WHERE appid = ?
     ''', (appid,))
     description = c.fetchone()[0]
 
@@ -248,7 +256,7 @@ def get_input_reviews_for_appid(conn: sqlite3.Connection, appid: int) -> Dict[in
     c = conn.cursor()
 
     c.execute('''
-        SELECT recommendationid, review FROM appreviews WHERE appid = ?
+        SELECT recommendationid, decompress_column(review) FROM appreviews WHERE appid = ?
     ''', (appid,))
     reviews = {recommendationid: review for recommendationid, review in c.fetchall()}
 
@@ -280,150 +288,654 @@ def get_output_review_recommendationids(conn: sqlite3.Connection) -> Set[int]:
 
     return set(recommendationids)
 
-def insert_description_embeddings(conn: sqlite3.Connection, appid: int, embeddings: List[List[float]]):
+def get_review_for_recommendationid(conn: sqlite3.Connection, recommendationid: int) -> str:
     """
-    Inserts the description embeddings for the given appid into the output SQLite database.
+    Gets the review for the given recommendationid from the input SQLite database.
 
     Args:
         conn (sqlite3.Connection): A connection to the SQLite database.
-        appid (int): The appid to insert the description embeddings for.
-        embeddings (List[List[float]]): A list of description embeddings for the given appid.
+        recommendationid (int): The recommendationid to get the review for.
+
+    Returns:
+        str: The review for the given recommendationid from the input SQLite database.
     """
-    logging.debug(f"Inserting description embeddings for appid {appid} into output SQLite database")
+    logging.debug(f"Getting review for recommendationid {recommendationid} from input SQLite database")
 
     c = conn.cursor()
 
     c.execute('''
-        INSERT INTO description_embeddings (appid, embedding)
-        VALUES (?, ?)
-    ''', (appid, pickle.dumps(embeddings)))
+        SELECT decompress_column(review) FROM appreviews WHERE recommendationid = ?
+    ''', (recommendationid,))
+    review = c.fetchone()[0]
+
+    c.close()
+
+    return review
+
+def get_appid_for_recommendationid(conn: sqlite3.Connection, recommendationid: int) -> int:
+    """
+    Gets the appid for the given recommendationid from the input SQLite database.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        recommendationid (int): The recommendationid to get the appid for.
+
+    Returns:
+        int: The appid for the given recommendationid.
+    """
+    logging.debug(f"Getting appid for recommendationid {recommendationid} from input SQLite database.")
+
+    c = conn.cursor()
+
+    c.execute(f'''
+        SELECT appid FROM appreviews WHERE recommendationid = ?
+    ''', (recommendationid,))
+    results = c.fetchone()[0]
+
+    c.close()
+
+    return results
+
+BANNED_DESCRIPTORS_SQL = ", ".join(str(descriptor) for descriptor in sorted(banned_descriptors))
+
+# Games that need a description embedding, skipping games with banned content descriptors.
+# Anti-joins instead of NOT IN subqueries, and the banned flag is computed once per game by update_banned_content_flags
+GAMES_WITHOUT_DESCRIPTION_EMBEDDINGS = '''
+    FROM appdetails
+    LEFT JOIN description_embeddings ON description_embeddings.appid = appdetails.appid
+    WHERE appdetails.type = 'game'
+        AND appdetails.bannedcontent = 0
+        AND description_embeddings.appid IS NULL
+'''
+
+# Reviews of games that need a review embedding, skipping near-duplicates, reviews left out by the sampling policy
+# and games with banned content descriptors
+REVIEWS_WITHOUT_EMBEDDINGS = '''
+    FROM appreviews
+    JOIN appdetails ON appdetails.appid = appreviews.appid
+    LEFT JOIN review_embeddings ON review_embeddings.recommendationid = appreviews.recommendationid
+    LEFT JOIN review_duplicates ON review_duplicates.recommendationid = appreviews.recommendationid
+    LEFT JOIN skipped_reviews ON skipped_reviews.recommendationid = appreviews.recommendationid
+    WHERE appdetails.type = 'game'
+        AND appdetails.bannedcontent = 0
+        AND review_embeddings.recommendationid IS NULL
+        AND review_duplicates.recommendationid IS NULL
+        AND skipped_reviews.recommendationid IS NULL
+'''
+
+def add_banned_content_column(conn: sqlite3.Connection):
+    """
+    Adds the columns flagging games with banned content descriptors to the appdetails table, if it does not have them yet,
+    and indexes the flag with the app type.
+
+    A trigger clears the flag when the content descriptors of a game change, so update_banned_content_flags looks at it again.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+    """
+    c = conn.cursor()
+
+    c.execute('''
+        PRAGMA table_info(appdetails)
+    ''')
+    columns = [row[1] for row in c.fetchall()]
+
+    # NULL until update_banned_content_flags has looked at the row, such games are not embedded
+    if "bannedcontent" not in columns:
+        c.execute('''
+            ALTER TABLE appdetails ADD COLUMN bannedcontent INTEGER
+        ''')
+    # The banned descriptors the flag was computed with
+    if "bannedcontentdescriptors" not in columns:
+        c.execute('''
+            ALTER TABLE appdetails ADD COLUMN bannedcontentdescriptors TEXT
+        ''')
+
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS appdetails_type_bannedcontent_index ON appdetails (type, bannedcontent)
+    ''')
+
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS appdetails_bannedcontent_reset AFTER UPDATE OF content_descriptors ON appdetails
+        WHEN OLD.content_descriptors IS NOT NEW.content_descriptors
+        BEGIN
+            UPDATE appdetails SET bannedcontent = NULL WHERE appid = NEW.appid;
+        END
+    ''')
+
+    conn.commit()
+    c.close()
+
+def update_banned_content_flags(conn: sqlite3.Connection) -> int:
+    """
+    Flags the games whose content descriptors contain a banned descriptor, only for rows that were never flagged,
+    whose content descriptors changed, or that were flagged with other banned_descriptors.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Returns:
+        int: The number of games flagged.
+    """
+    c = conn.cursor()
+
+    # content_descriptors holds a list of ids such as [1, 5], which is valid JSON
+    c.execute(f'''
+        UPDATE appdetails
+        SET bannedcontent = EXISTS (
+                SELECT 1 FROM json_each(CASE WHEN json_valid(content_descriptors) THEN content_descriptors ELSE '[]' END)
+                WHERE json_each.value IN ({BANNED_DESCRIPTORS_SQL})
+            ),
+            bannedcontentdescriptors = ?
+        WHERE bannedcontent IS NULL
+            OR bannedcontentdescriptors IS NOT ?
+    ''', (BANNED_DESCRIPTORS_SQL, BANNED_DESCRIPTORS_SQL))
+    count = c.rowcount
+
+    conn.commit()
+    c.close()
+
+    return count
+
+def add_normalized_description_columns(conn: sqlite3.Connection):
+    """
+    Adds the columns caching the normalized store description to the appdetails table, if it does not have them yet.
+
+    A trigger clears the normalization version when the store description changes, so it is normalized again.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+    """
+    c = conn.cursor()
+
+    c.execute('''
+        PRAGMA table_info(appdetails)
+    ''')
+    columns = [row[1] for row in c.fetchall()]
+
+    if "normalizeddescription" not in columns:
+        c.execute('''
+            ALTER TABLE appdetails ADD COLUMN normalizeddescription TEXT
+        ''')
+    if "normalizationversion" not in columns:
+        c.execute('''
+            ALTER TABLE appdetails ADD COLUMN normalizationversion INTEGER
+        ''')
+
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS appdetails_normalizeddescription_reset AFTER UPDATE OF storedescription ON appdetails
+        WHEN OLD.storedescription IS NOT NEW.storedescription
+        BEGIN
+            UPDATE appdetails SET normalizationversion = NULL WHERE appid = NEW.appid;
+        END
+    ''')
 
     conn.commit()
     c.close()
 
-def insert_review_embeddings(conn: sqlite3.Connection, recommendationid: int, embeddings: List[List[float]], appid: int):
+def update_normalized_descriptions(conn: sqlite3.Connection) -> int:
     """
-    Inserts the review embeddings for the given recommendationid into the output SQLite database.
+    Normalizes the store descriptions of the games that need a description embedding,
+    unless they were already normalized by the current version of text_normalization.
 
     Args:
         conn (sqlite3.Connection): A connection to the SQLite database.
-        recommendationid (int): The recommendationid to insert the review embeddings for.
-        embeddings (List[List[float]]): A list of review embeddings for the given recommendationid.
+
+    Returns:
+        int: The number of descriptions normalized.
     """
-    logging.debug(f"Inserting review embeddings for recommendationid {recommendationid} into output SQLite database")
+    conn.create_function("normalize_description", 1, text_normalization.normalize_description, deterministic = True)
 
     c = conn.cursor()
 
     c.execute('''
+        UPDATE appdetails
+        SET normalizeddescription = normalize_description(decompress_column(storedescription)),
+            normalizationversion = ?
+        WHERE appid IN (SELECT appdetails.appid ''' + GAMES_WITHOUT_DESCRIPTION_EMBEDDINGS + ''')
+            AND normalizationversion IS NOT ?
+    ''', (text_normalization.NORMALIZATION_VERSION, text_normalization.NORMALIZATION_VERSION))
+    count = c.rowcount
+
+    conn.commit()
+    c.close()
+
+    return count
+
+def count_game_descriptions_without_embeddings(conn: sqlite3.Connection) -> int:
+    """
+    Counts the games whose description does not have embeddings yet.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Returns:
+        int: The number of descriptions iter_game_descriptions_without_embeddings will yield.
+    """
+    c = conn.cursor()
+
+    c.execute("SELECT count(*) " + GAMES_WITHOUT_DESCRIPTION_EMBEDDINGS)
+    count = c.fetchone()[0]
+
+    c.close()
+
+    return count
+
+def iter_game_descriptions_without_embeddings(conn: sqlite3.Connection) -> Iterator[Tuple[int, None, str]]:
+    """
+    Streams the descriptions of games that do not have embeddings yet, from a single query.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Yields:
+        Tuple[int, None, str]: (appid, None, description), in the same shape as iter_reviews_without_embeddings.
+            The description is the normalized text from update_normalized_descriptions.
+    """
+    logging.debug("Streaming game descriptions without embeddings from input SQLite database")
+
+    c = conn.cursor()
+
+    c.execute("SELECT appdetails.appid, NULL, appdetails.normalizeddescription " + GAMES_WITHOUT_DESCRIPTION_EMBEDDINGS)
+    yield from c
+
+    c.close()
+
+def count_reviews_without_embeddings(conn: sqlite3.Connection) -> int:
+    """
+    Counts the reviews that do not have embeddings yet.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Returns:
+        int: The number of reviews iter_reviews_without_embeddings will yield.
+    """
+    c = conn.cursor()
+
+    c.execute("SELECT count(*) " + REVIEWS_WITHOUT_EMBEDDINGS)
+    count = c.fetchone()[0]
+
+    c.close()
+
+    return count
+
+def iter_reviews_without_embeddings(conn: sqlite3.Connection) -> Iterator[Tuple[int, int, str]]:
+    """
+    Streams the reviews that do not have embeddings yet, with their appid, from a single query.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Yields:
+        Tuple[int, int, str]: (recommendationid, appid, review)
+    """
+    logging.debug("Streaming reviews without embeddings from input SQLite database")
+
+    c = conn.cursor()
+
+    c.execute("SELECT appreviews.recommendationid, appreviews.appid, decompress_column(appreviews.review) " + REVIEWS_WITHOUT_EMBEDDINGS)
+    yield from c
+
+    c.close()
+
+def insert_description_embedding_rows(conn: sqlite3.Connection, rows: List[Tuple[int, List[List[float]], None]], dtype: str = "float32"):
+    """
+    Inserts description embeddings without committing.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        rows (List[Tuple[int, List[List[float]], None]]): (appid, embeddings, None) for each description.
+        dtype (str): The stored precision, float32 or float16.
+    """
+    c = conn.cursor()
+
+    c.executemany('''
+        INSERT INTO description_embeddings (appid, embedding)
+        VALUES (?, ?)
+    ''', [(appid, embedding_codec.encode_embeddings(embeddings, dtype)) for appid, embeddings, _ in rows])
+
+    c.close()
+
+def insert_review_embedding_rows(conn: sqlite3.Connection, rows: List[Tuple[int, List[List[float]], int]], dtype: str = "float32"):
+    """
+    Inserts review embeddings without committing.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        rows (List[Tuple[int, List[List[float]], int]]): (recommendationid, embeddings, appid) for each review.
+        dtype (str): The stored precision, float32 or float16.
+    """
+    c = conn.cursor()
+
+    c.executemany('''
         INSERT INTO review_embeddings (recommendationid, embedding, appid)
         VALUES (?, ?, ?)
-    ''', (recommendationid, pickle.dumps(embeddings), appid))
+    ''', [(recommendationid, embedding_codec.encode_embeddings(embeddings, dtype), appid) for recommendationid, embeddings, appid in rows])
+
+    c.close()
+
+def create_embedding_cache_table(conn: sqlite3.Connection):
+    """
+    Creates the table of chunk embeddings by content hash, if it does not exist yet.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+    """
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            content_hash BLOB PRIMARY KEY,
+            embedding BLOB NOT NULL
+        ) WITHOUT ROWID
+    ''')
 
     conn.commit()
     c.close()
 
-def get_game_appids_without_description_embeddings(conn: sqlite3.Connection) -> Set[int]:
+def get_cached_embeddings(conn: sqlite3.Connection, content_hashes: List[bytes]) -> Dict[bytes, List[float]]:
     """
-    Gets all appids from the input SQLite database that do not have description embeddings.
+    Gets the cached embeddings of chunks.
 
     Args:
         conn (sqlite3.Connection): A connection to the SQLite database.
+        content_hashes (List[bytes]): The content hashes of the chunks, from BatchEncoder.split.
 
     Returns:
-        Set[int]: A set of all appids in the input SQLite database that do not have description embeddings.
+        Dict[bytes, List[float]]: The embedding of each chunk found in the cache, by content hash.
+    """
+    c = conn.cursor()
+
+    c.execute(f'''
+        SELECT content_hash, embedding FROM embedding_cache
+        WHERE content_hash IN ({', '.join('?' * len(content_hashes))})
+    ''', content_hashes)
+    results = c.fetchall()
+
+    c.close()
+
+    return {content_hash: embedding_codec.decode_embeddings(embedding)[0] for content_hash, embedding in results}
+
+def insert_cached_embeddings(conn: sqlite3.Connection, entries: List[Tuple[bytes, List[float]]], dtype: str = "float32"):
+    """
+    Adds chunk embeddings to the cache without committing.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        entries (List[Tuple[bytes, List[float]]]): (content_hash, embedding) for each chunk.
+        dtype (str): The stored precision, float32 or float16.
+    """
+    c = conn.cursor()
+
+    c.executemany('''
+        INSERT OR IGNORE INTO embedding_cache (content_hash, embedding)
+        VALUES (?, ?)
+    ''', [(content_hash, embedding_codec.encode_embeddings([embedding], dtype)) for content_hash, embedding in entries])
+
+    c.close()
+
+def create_review_duplicates_table(conn: sqlite3.Connection):
     """
-    logging.debug("Getting all appids from input SQLite database that do not have description embeddings")
+    Creates the table mapping near-duplicate reviews to the review whose embedding they share, if it does not exist yet.
 
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+    """
     c = conn.cursor()
 
     c.execute('''
-        SELECT appid, content_descriptors FROM appdetails 
-        WHERE appid NOT IN (
-            SELECT appid FROM description_embeddings
+        CREATE TABLE IF NOT EXISTS review_duplicates (
+            recommendationid INTEGER PRIMARY KEY,
+            representative_recommendationid INTEGER NOT NULL,
+            appid INTEGER NOT NULL
         )
-        AND type = 'game'
     ''')
 
-    # Only return appids for games whose content descriptors does not contain any banned descriptors
-    appids = [appid[0] for appid in c.fetchall() if not any(descriptor in banned_descriptors for descriptor in json.loads(appid[1]))]
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS review_duplicates_appid_index ON review_duplicates (appid)
+    ''')
+
+    conn.commit()
+    c.close()
+
+def get_appids_with_reviews_without_embeddings(conn: sqlite3.Connection) -> List[int]:
+    """
+    Gets the games with reviews that need a review embedding.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+
+    Returns:
+        List[int]: The appids.
+    """
+    c = conn.cursor()
+
+    c.execute("SELECT DISTINCT appreviews.appid " + REVIEWS_WITHOUT_EMBEDDINGS)
+    results = c.fetchall()
 
     c.close()
 
-    return set(appids)
+    return [appid for appid, in results]
 
-def get_recommendationids_without_embeddings(conn):
+def get_reviews_for_deduplication(conn: sqlite3.Connection, appid: int) -> List[Tuple[int, str, bool]]:
     """
-    Gets all recommendationids from the input SQLite database that do not have embeddings.
+    Gets the reviews of a game that are not near-duplicates of another review.
+
+    Reviews skipped by the sampling policy are left out, they are never embedded so they cannot be a representative.
 
     Args:
         conn (sqlite3.Connection): A connection to the SQLite database.
+        appid (int): The appid of the game.
 
     Returns:
-        List[int]: A list of all recommendationids in the input SQLite database that do not have embeddings.
+        List[Tuple[int, str, bool]]: (recommendationid, review, has_embedding) for each review.
+    """
+    c = conn.cursor()
+
+    c.execute('''
+        SELECT appreviews.recommendationid, decompress_column(appreviews.review), review_embeddings.recommendationid IS NOT NULL
+        FROM appreviews
+        LEFT JOIN review_embeddings ON review_embeddings.recommendationid = appreviews.recommendationid
+        LEFT JOIN review_duplicates ON review_duplicates.recommendationid = appreviews.recommendationid
+        LEFT JOIN skipped_reviews ON skipped_reviews.recommendationid = appreviews.recommendationid
+        WHERE appreviews.appid = ?
+            AND review_duplicates.recommendationid IS NULL
+            AND skipped_reviews.recommendationid IS NULL
+    ''', (appid,))
+    results = c.fetchall()
+
+    c.close()
+
+    return [(recommendationid, review, bool(has_embedding)) for recommendationid, review, has_embedding in results]
+
+def insert_review_duplicates(conn: sqlite3.Connection, appid: int, duplicates: List[Tuple[int, int]]):
+    """
+    Maps near-duplicate reviews of a game to their representative review.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appid (int): The appid of the game.
+        duplicates (List[Tuple[int, int]]): (recommendationid, representative recommendationid) for each near-duplicate.
+    """
+    c = conn.cursor()
+
+    c.executemany('''
+        INSERT OR REPLACE INTO review_duplicates (recommendationid, representative_recommendationid, appid)
+        VALUES (?, ?, ?)
+    ''', [(recommendationid, representative, appid) for recommendationid, representative in duplicates])
+
+    conn.commit()
+    c.close()
+
+def get_review_representatives_for_appid(conn: sqlite3.Connection, appid: int) -> Set[int]:
     """
-    logging.debug("Getting all recommendationids from input SQLite database that do not have embeddings")
+    Gets the reviews of a game that near-duplicate reviews are mapped to.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appid (int): The appid of the game.
 
+    Returns:
+        Set[int]: The representative recommendationids.
+    """
     c = conn.cursor()
 
     c.execute('''
-        SELECT recommendationid, content_descriptors FROM appreviews
-        JOIN appdetails USING (appid)
-        WHERE recommendationid NOT IN (
-            SELECT recommendationid FROM review_embeddings
-        ) AND type = 'game'
+        SELECT DISTINCT representative_recommendationid FROM review_duplicates
+        WHERE appid = ?
+    ''', (appid,))
+    results = c.fetchall()
+
+    c.close()
+
+    return set(recommendationid for recommendationid, in results)
+
+def create_skipped_reviews_table(conn: sqlite3.Connection):
+    """
+    Creates the table of reviews the sampling policy decided not to embed, if it does not exist yet.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+    """
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS skipped_reviews (
+            recommendationid INTEGER PRIMARY KEY,
+            appid INTEGER NOT NULL,
+            reason TEXT NOT NULL
+        )
     ''')
 
-    ## Only return recommendationids for games whose content descriptors does not contain any banned descriptors
-    recommendationids = [recommendationid[0] for recommendationid in c.fetchall() if not any(descriptor in banned_descriptors for descriptor in json.loads(recommendationid[1]))]
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS skipped_reviews_appid_index ON skipped_reviews (appid)
+    ''')
 
+    conn.commit()
     c.close()
 
-    return recommendationids
+def clear_skipped_reviews(conn: sqlite3.Connection):
+    """
+    Forgets every skipped review, so they are sampled again with the current policy.
 
-def get_review_for_recommendationid(conn: sqlite3.Connection, recommendationid: int) -> str:
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
     """
-    Gets the review for the given recommendationid from the input SQLite database.
+    c = conn.cursor()
+
+    c.execute('''
+        DELETE FROM skipped_reviews
+    ''')
+
+    conn.commit()
+    c.close()
+
+def unskip_review_representatives(conn: sqlite3.Connection) -> int:
+    """
+    Forgets skipped reviews that are the representative of near-duplicates, their near-duplicates share their embedding.
 
     Args:
         conn (sqlite3.Connection): A connection to the SQLite database.
-        recommendationid (int): The recommendationid to get the review for.
 
     Returns:
-        str: The review for the given recommendationid from the input SQLite database.
+        int: The number of representatives that will be embedded again.
     """
-    logging.debug(f"Getting review for recommendationid {recommendationid} from input SQLite database")
-
     c = conn.cursor()
 
     c.execute('''
-        SELECT review FROM appreviews WHERE recommendationid = ?
-    ''', (recommendationid,))
-    review = c.fetchone()[0]
+        DELETE FROM skipped_reviews
+        WHERE recommendationid IN (SELECT representative_recommendationid FROM review_duplicates)
+    ''')
+    unskipped_count = c.rowcount
 
+    conn.commit()
     c.close()
 
-    return review
+    return unskipped_count
 
-def get_appid_for_recommendationid(conn: sqlite3.Connection, recommendationid: int) -> int:
+def delete_empty_embeddings(conn: sqlite3.Connection) -> int:
     """
-    Gets the appid for the given recommendationid from the input SQLite database.
+    Deletes stored embeddings without any chunks, so their documents are embedded again.
+
+    Empty texts used to be stored with no chunks, they now get one chunk with only the end of sequence token.
 
     Args:
         conn (sqlite3.Connection): A connection to the SQLite database.
-        recommendationid (int): The recommendationid to get the appid for.
 
     Returns:
-        int: The appid for the given recommendationid.
+        int: The number of embeddings deleted.
     """
-    logging.debug(f"Getting appid for recommendationid {recommendationid} from input SQLite database.")
+    c = conn.cursor()
 
+    # An encoded embedding is only its header when it has no chunks
+    deleted_count = 0
+    for table in ['description_embeddings', 'review_embeddings']:
+        c.execute(f'DELETE FROM {table} WHERE length(embedding) = ?', (embedding_codec.HEADER.size,))
+        deleted_count += c.rowcount
+
+    conn.commit()
+    c.close()
+
+    return deleted_count
+
+def get_reviews_without_embeddings_for_appid(conn: sqlite3.Connection, appid: int) -> List[Tuple[int, str, str]]:
+    """
+    Gets the reviews of a game that need a review embedding.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appid (int): The appid of the game.
+
+    Returns:
+        List[Tuple[int, str, str]]: (recommendationid, review, datajson) for each review.
+    """
     c = conn.cursor()
 
-    c.execute(f'''
-        SELECT appid FROM appreviews WHERE recommendationid = ?
-    ''', (recommendationid,))
-    results = c.fetchone()[0]
+    c.execute("SELECT appreviews.recommendationid, decompress_column(appreviews.review), decompress_column(appreviews.datajson) " + REVIEWS_WITHOUT_EMBEDDINGS + " AND appreviews.appid = ?", (appid,))
+    results = c.fetchall()
 
     c.close()
 
-    return results
\ No newline at end of file
+    return results
+
+def count_review_embeddings_for_appid(conn: sqlite3.Connection, appid: int) -> int:
+    """
+    Counts the reviews of a game that have an embedding.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appid (int): The appid of the game.
+
+    Returns:
+        int: The number of review embeddings.
+    """
+    c = conn.cursor()
+
+    c.execute('''
+        SELECT count(*) FROM review_embeddings WHERE appid = ?
+    ''', (appid,))
+    count = c.fetchone()[0]
+
+    c.close()
+
+    return count
+
+def insert_skipped_reviews(conn: sqlite3.Connection, appid: int, skipped: List[Tuple[int, str]]):
+    """
+    Records reviews of a game the sampling policy decided not to embed.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appid (int): The appid of the game.
+        skipped (List[Tuple[int, str]]): (recommendationid, reason) for each skipped review.
+    """
+    c = conn.cursor()
+
+    c.executemany('''
+        INSERT OR REPLACE INTO skipped_reviews (recommendationid, appid, reason)
+        VALUES (?, ?, ?)
+    ''', [(recommendationid, appid, reason) for recommendationid, reason in skipped])
+
+    conn.commit()
+    c.close()
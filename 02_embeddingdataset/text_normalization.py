@@ -0,0 +1,93 @@
+import re
+from html.parser import HTMLParser
+from typing import List, Optional
+
+# Stored with every normalized description, bump it whenever normalize_description changes so they are normalized again
+NORMALIZATION_VERSION = 1
+
+# Tags that end a line of text
+BLOCK_TAGS = {"br", "p", "div", "li", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "table", "blockquote", "hr"}
+# Tags whose contents are not text
+SKIPPED_TAGS = {"script", "style"}
+
+URL_PATTERN = re.compile(r"(?:https?://|www\.)\S+", re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+# Lines that are the same on many store pages and say nothing about the game
+BOILERPLATE_PATTERNS = [
+    re.compile(r"^about (this|the) game:?$", re.IGNORECASE),
+    re.compile(r"^(join|follow) (us|our)\b.*\b(discord|twitter|facebook|instagram|youtube|tiktok|reddit|newsletter)\b", re.IGNORECASE),
+    re.compile(r"^(add (it )?to your )?wishlist( (it )?now)?!?$", re.IGNORECASE),
+    re.compile(r"^(©|\(c\)|copyright\b)|all rights reserved\.?$", re.IGNORECASE),
+]
+# Longer lines are prose that happens to match a pattern
+BOILERPLATE_MAX_LENGTH = 200
+
+class TextExtractor(HTMLParser):
+    """
+    Collects the text of an HTML document line by line, dropping tags, images and scripts.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs = True)
+        self.lines: List[str] = []
+        self.current_line: List[str] = []
+        self.skipped_depth = 0
+
+    def end_line(self):
+        self.lines.append("".join(self.current_line))
+        self.current_line = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skipped_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.end_line()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self.end_line()
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skipped_depth = max(0, self.skipped_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.end_line()
+
+    def handle_data(self, data):
+        if self.skipped_depth == 0:
+            self.current_line.append(data)
+
+    def get_lines(self) -> List[str]:
+        self.close()
+        self.end_line()
+        return self.lines
+
+def is_boilerplate(line: str) -> bool:
+    return len(line) <= BOILERPLATE_MAX_LENGTH and any(pattern.search(line) for pattern in BOILERPLATE_PATTERNS)
+
+def normalize_description(description: Optional[str]) -> Optional[str]:
+    """
+    Turns a Steam store description (HTML) into the plain prose to embed.
+
+    Strips markup and images, decodes entities, removes URLs and boilerplate lines, and collapses whitespace.
+
+    Args:
+        description (Optional[str]): The raw store description.
+
+    Returns:
+        Optional[str]: The normalized text.
+    """
+    if description is None:
+        return None
+
+    extractor = TextExtractor()
+    extractor.feed(description)
+
+    lines = []
+    for line in extractor.get_lines():
+        line = WHITESPACE_PATTERN.sub(" ", URL_PATTERN.sub(" ", line)).strip()
+        if len(line) > 0 and not is_boilerplate(line):
+            lines.append(line)
+
+    # The tokenizer treats line breaks as spaces, so the lines are joined into one
+    return " ".join(lines)
@@ -7,6 +7,7 @@ import numpy as np
 from typing import List, Optional, Set, Dict, Iterator, Tuple, Callable
 import sqlite3
 import os
+from functools import partial
 
 
 COLOR_DARK_GREY = "\x1b[38;5;240m"
@@ -18,8 +19,9 @@ LOGGING_FORMAT = COLOR_DARK_GREY + '[%(asctime)s - %(name)s]' + COLOR_RESET + CO
 @click.option('--db', required=True, help='Path to SQLite database')
 @click.option('--index-type', type=click.Choice(['description', 'review', 'mixed', 'all']), default='all', help='Type of index to create')
 @click.option('--remove-old-indexes', default=False, is_flag=True, help='Remove old indexes after creating new ones')
+@click.option('--collapse-near-duplicates', default=False, is_flag=True, help='Count each group of near-duplicate reviews once when pooling reviews, instead of once per review')
 @click.option('--verbose', is_flag=True, help='Print verbose output')
-def main(db, index_type, remove_old_indexes, verbose):
+def main(db, index_type, remove_old_indexes, collapse_near_duplicates, verbose):
   logging.basicConfig(format = LOGGING_FORMAT, level = logging.INFO if not verbose else logging.DEBUG)
 
   # Load input sqlite database
@@ -67,7 +69,7 @@ def main(db, index_type, remove_old_indexes, verbose):
       ef_recall=4000, 
       ef_construct=num_elements, 
       M=32, 
-      get_batches=get_reviews_by_appid_batched
+      get_batches=partial(get_reviews_by_appid_batched, collapse_near_duplicates=collapse_near_duplicates)
     )
     sqlite_helpers.add_review_index(conn, review_index)
 
@@ -81,7 +83,7 @@ def main(db, index_type, remove_old_indexes, verbose):
       ef_recall=1500, 
       ef_construct=num_elements, 
       M=32, 
-      get_batches=get_mixed_by_appid_batched
+      get_batches=partial(get_mixed_by_appid_batched, collapse_near_duplicates=collapse_near_duplicates)
     )
     sqlite_helpers.add_mixed_index(conn, mixed_index)
 
@@ -93,7 +95,7 @@ def main(db, index_type, remove_old_indexes, verbose):
 
 
 def mean_pooling(embeddings: List[List[float]]) -> List[float]:
-  return np.sum(embeddings, axis=0) / len(embeddings)
+  return np.sum(embeddings, axis=0, dtype=np.float32) / len(embeddings)
 
 def get_index_dimension(conn: sqlite3.Connection) -> int:
   return len(sqlite_helpers.get_any_description_embeddings_list(conn)[0])
@@ -102,24 +104,34 @@ def pool_description_embeddings(embeddings: List[List[float]]) -> List[float]:
   # embeddings[chunk_size][embedding_dim]
   return mean_pooling(embeddings)
 
-def pool_review_embeddings(embeddings: Dict[str, List[List[float]]]) -> List[float]:
+def pool_review_embeddings(embeddings: Dict[str, List[List[float]]], duplicate_counts: Dict[int, int] = {}) -> List[float]:
   # embeddings[review_id][chunk_size][embedding_dim]
   flat_embeddings = [review_embedding for review_id in embeddings for review_embedding in embeddings[review_id]]
   # flat_embeddings[chunk_size][embedding_dim]
-  return mean_pooling(flat_embeddings)
+  if len(duplicate_counts) == 0:
+    return mean_pooling(flat_embeddings)
+
+  # Near-duplicate reviews have no embedding of their own, their representative counts once for each of them
+  weights = [1 + duplicate_counts.get(review_id, 0) for review_id in embeddings for _ in embeddings[review_id]]
+  return np.average(np.asarray(flat_embeddings, dtype=np.float32), axis=0, weights=np.asarray(weights, dtype=np.float32))
+
+def get_review_duplicate_counts(conn: sqlite3.Connection, appid: int, collapse_near_duplicates: bool) -> Dict[int, int]:
+  if collapse_near_duplicates:
+    return {}
+  return sqlite_helpers.get_review_duplicate_counts_for_appid(conn, appid)
 
 def get_descriptions_by_appid_batched(conn: sqlite3.Connection, page_size: int = 1000) -> Iterator[List[Tuple[int, List[float]]]]:
   for batch in sqlite_helpers.get_description_embeddings_batch(conn, page_size):
     appids, embeddings = zip(*batch)
     yield [(appid, pool_description_embeddings(embedding)) for appid, embedding in zip(appids, embeddings)]
 
-def get_reviews_by_appid_batched(conn: sqlite3.Connection, page_size: int = 1000) -> Iterator[List[Tuple[int, List[float]]]]:
+def get_reviews_by_appid_batched(conn: sqlite3.Connection, page_size: int = 1000, collapse_near_duplicates: bool = False) -> Iterator[List[Tuple[int, List[float]]]]:
   appids = sqlite_helpers.get_appids_with_review_embeddings(conn)
 
   for i in range(0, len(appids), page_size):
-    yield [(appid, pool_review_embeddings(sqlite_helpers.get_review_embeddings_for_appid(conn, appid))) for appid in appids[i:i+page_size]]
+    yield [(appid, pool_review_embeddings(sqlite_helpers.get_review_embeddings_for_appid(conn, appid), get_review_duplicate_counts(conn, appid, collapse_near_duplicates))) for appid in appids[i:i+page_size]]
 
-def get_mixed_by_appid_batched(conn: sqlite3.Connection, page_size: int = 1000, review_weight: float = 0.7) -> Iterator[List[Tuple[int, List[float]]]]:
+def get_mixed_by_appid_batched(conn: sqlite3.Connection, page_size: int = 1000, review_weight: float = 0.7, collapse_near_duplicates: bool = False) -> Iterator[List[Tuple[int, List[float]]]]:
   appids_with_description_embeddings = set(sqlite_helpers.get_appids_with_description_embeddings(conn))
   appids_with_reviews = set(sqlite_helpers.get_appids_with_review_embeddings(conn))
   appids = list(appids_with_description_embeddings.union(appids_with_reviews))
@@ -129,6 +141,7 @@ def get_mixed_by_appid_batched(conn: sqlite3.Connection, page_size: int = 1000,
     for appid in appids[i:i+page_size]:
       all_description_embeddings = sqlite_helpers.get_description_embeddings_for_appid(conn, appid)
       all_review_embeddings = sqlite_helpers.get_review_embeddings_for_appid(conn, appid)
+      duplicate_counts = get_review_duplicate_counts(conn, appid, collapse_near_duplicates)
 
       #if len(all_review_embeddings) == 0 and len(all_description_embeddings) == 0:
       #  raise ValueError(f"No description or review embeddings found for appid {appid}")
@@ -139,13 +152,13 @@ def get_mixed_by_appid_batched(conn: sqlite3.Connection, page_size: int = 1000,
         page.append((appid, description_embedding))
       elif len(all_description_embeddings) == 0:
         #review_weight = 1.0
-        review_embedding = pool_review_embeddings(all_review_embeddings)
+        review_embedding = pool_review_embeddings(all_review_embeddings, duplicate_counts)
         page.append((appid, review_embedding))
       else:
         # Weighted average of description and review embeddings
         # Default of 0.7 was chosen mostly arbitrarily
         description_embedding = pool_description_embeddings(all_description_embeddings)
-        review_embedding = pool_review_embeddings(all_review_embeddings)
+        review_embedding = pool_review_embeddings(all_review_embeddings, duplicate_counts)
         final_embedding = review_weight * review_embedding + (1.0 - review_weight) * description_embedding
         page.append((appid, final_embedding))
     yield page
@@ -2,6 +2,7 @@ import sqlite3
 import logging
 from typing import List, Optional, Set, Dict, Iterator, Tuple
 import pickle
+import embedding_codec
 import hnswlib
 
 def create_connection(db_file: str = "steam.db") -> sqlite3.Connection:
@@ -224,7 +225,7 @@ def get_any_description_embeddings_list(conn: sqlite3.Connection) -> List[List[f
 
     c.close()
 
-    return pickle.loads(results)
+    return embedding_codec.decode_embeddings(results)
 
 def get_count_appids_with_description_embeddings(conn: sqlite3.Connection) -> int:
     """
@@ -320,7 +321,7 @@ def get_description_embeddings_batch(conn: sqlite3.Connection, page_size: int =
         if not results:
             break
 
-        yield [(appid, pickle.loads(embedding)) for appid, embedding in results]
+        yield [(appid, embedding_codec.decode_embeddings(embedding)) for appid, embedding in results]
 
     c.close()
 
@@ -390,7 +391,7 @@ def get_review_embeddings_for_appid(conn: sqlite3.Connection, appid: int) -> Dic
 
     c.close()
 
-    return {recommendationid: pickle.loads(embedding) for recommendationid, embedding in results}
+    return {recommendationid: embedding_codec.decode_embeddings(embedding) for recommendationid, embedding in results}
 
 def get_description_embeddings_for_appid(conn: sqlite3.Connection, appid: int) -> List[List[float]]:
     """
@@ -420,4 +421,32 @@ def get_description_embeddings_for_appid(conn: sqlite3.Connection, appid: int) -
 
     #return [pickle.loads(embedding) for embedding, in results]
     embedding, = results[0]
-    return pickle.loads(embedding)
\ No newline at end of file
+    return embedding_codec.decode_embeddings(embedding)
+
+def get_review_duplicate_counts_for_appid(conn: sqlite3.Connection, appid: int) -> Dict[int, int]:
+    """
+    Gets how many near-duplicate reviews of an appid share each review's embedding, see 02_embeddingdataset.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appid (int): The appid to get the near-duplicate counts for.
+
+    Returns:
+        Dict[int, int]: The number of near-duplicates by representative recommendationid, empty if reviews were never deduplicated.
+    """
+
+    if not check_table(conn, 'review_duplicates'):
+        return {}
+
+    c = conn.cursor()
+
+    c.execute('''
+        SELECT representative_recommendationid, count(*) FROM review_duplicates
+        WHERE appid = ?
+        GROUP BY representative_recommendationid
+    ''', (appid,))
+    results = c.fetchall()
+
+    c.close()
+
+    return {recommendationid: count for recommendationid, count in results}
@@ -6,7 +6,7 @@ import sqlite_helpers
 import tqdm
 import logging
 import os
-from typing import List
+from typing import Dict, List
 import numpy as np
 import hnswlib
 import time
@@ -98,8 +98,7 @@ def custom_query(conn, query, query_for_type, embed_query, model_name, max_resul
 
         # [num_reviews][num_chunks][embedding_size]
         all_review_embeddings = sqlite_helpers.get_review_embeddings_for_appid(conn, appid)
-        flat_review_embeddings = [review_embedding for review_id in all_review_embeddings for review_embedding in all_review_embeddings[review_id]]
-        review_embed = mean_pooling(flat_review_embeddings)
+        review_embed = pool_review_embeddings(all_review_embeddings, sqlite_helpers.get_review_duplicate_counts_for_appid(conn, appid))
 
         score = cosine_similarity(description_embed, review_embed)
         name = sqlite_helpers.get_name_for_appid(conn, appid)
@@ -168,7 +167,17 @@ def cosine_similarity(a: List[float], b: List[float]) -> float:
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
 def mean_pooling(embeddings: List[List[float]]) -> List[float]:
-    return np.sum(embeddings, axis=0) / len(embeddings)
+    return np.sum(embeddings, axis=0, dtype=np.float32) / len(embeddings)
+
+def pool_review_embeddings(embeddings: Dict[int, List[List[float]]], duplicate_counts: Dict[int, int] = {}) -> List[float]:
+    # Pools like 03_hnsw-index, so the query vector of a game matches the vector indexed for it.
+    # Near-duplicate reviews have no embedding of their own, their representative counts once for each of them
+    flat_embeddings = [review_embedding for review_id in embeddings for review_embedding in embeddings[review_id]]
+    if len(duplicate_counts) == 0:
+        return mean_pooling(flat_embeddings)
+
+    weights = [1 + duplicate_counts.get(review_id, 0) for review_id in embeddings for _ in embeddings[review_id]]
+    return np.average(np.asarray(flat_embeddings, dtype=np.float32), axis=0, weights=np.asarray(weights, dtype=np.float32))
 
 def euclidean_distance(a: List[float], b: List[float]) -> float:
     distance = np.linalg.norm(a - b)
@@ -217,8 +226,7 @@ def slow_search(conn, query_embed, query_for_type, max_results=10):
 
         for appid in tqdm.tqdm(appids_with_reviews, desc="Reviews"):
             all_review_embeddings = sqlite_helpers.get_review_embeddings_for_appid(conn, appid)
-            flat_embeddings = [review_embedding for review_id in all_review_embeddings for review_embedding in all_review_embeddings[review_id]]
-            average_embedding = mean_pooling(flat_embeddings)
+            average_embedding = pool_review_embeddings(all_review_embeddings, sqlite_helpers.get_review_duplicate_counts_for_appid(conn, appid))
 
             score = cosine_similarity(average_embedding, query_embed)
             #score = euclidean_distance(average_embedding, query_embed)
@@ -322,8 +330,7 @@ def slow_search_similar(conn, query_appid, query_for_type, max_results=10):
     if query_for_type == 'all' or query_for_type == 'review':
         query_review_embeddings = sqlite_helpers.get_review_embeddings_for_appid(conn, query_appid)
         logging.info(f"Basing review query on {len(query_review_embeddings)} user reviews.")
-        query_flat_embeddings = [review_embedding for review_id in query_review_embeddings for review_embedding in query_review_embeddings[review_id]]
-        query_embed = mean_pooling(query_flat_embeddings)
+        query_embed = pool_review_embeddings(query_review_embeddings, sqlite_helpers.get_review_duplicate_counts_for_appid(conn, query_appid))
 
         appids_with_reviews = sqlite_helpers.get_appids_with_review_embeds(conn)
 
@@ -332,8 +339,7 @@ def slow_search_similar(conn, query_appid, query_for_type, max_results=10):
                 continue
             
             all_review_embeddings = sqlite_helpers.get_review_embeddings_for_appid(conn, current_appid)
-            flat_embeddings = [review_embedding for review_id in all_review_embeddings for review_embedding in all_review_embeddings[review_id]]
-            average_embedding = mean_pooling(flat_embeddings)
+            average_embedding = pool_review_embeddings(all_review_embeddings, sqlite_helpers.get_review_duplicate_counts_for_appid(conn, current_appid))
 
             score = cosine_similarity(average_embedding, query_embed)
             #score = euclidean_distance(average_embedding, query_embed)
@@ -390,8 +396,7 @@ def index_search_similar(conn, query_appid, query_for_type, max_results=10):
         
         query_review_embeddings = sqlite_helpers.get_review_embeddings_for_appid(conn, query_appid)
         logging.info(f"Basing review query on {len(query_review_embeddings)} user reviews.")
-        query_flat_embeddings = [review_embedding for review_id in query_review_embeddings for review_embedding in query_review_embeddings[review_id]]
-        query_embed = mean_pooling(query_flat_embeddings)
+        query_embed = pool_review_embeddings(query_review_embeddings, sqlite_helpers.get_review_duplicate_counts_for_appid(conn, query_appid))
 
         appids, distances = review_index.knn_query(query_embed, k=max_results + 1)
 
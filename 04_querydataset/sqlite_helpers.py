@@ -2,6 +2,7 @@ import sqlite3
 import logging
 from typing import List, Optional, Set, Dict, Generator
 import pickle
+import embedding_codec
 import hnswlib
 
 ## Init
@@ -89,7 +90,7 @@ def get_description_embeddings_for_appid(conn: sqlite3.Connection, appid: int) -
 
     c.close()
 
-    return pickle.loads(results)
+    return embedding_codec.decode_embeddings(results)
 
 def get_all_embeddings_for_descriptions(conn: sqlite3.Connection) -> Dict[int,List[List[float]]]:
     """
@@ -111,7 +112,7 @@ def get_all_embeddings_for_descriptions(conn: sqlite3.Connection) -> Dict[int,Li
 
     c.close()
 
-    return {appid: pickle.loads(embedding) for appid, embedding in results}
+    return {appid: embedding_codec.decode_embeddings(embedding) for appid, embedding in results}
 
 def get_count_embeddings_for_descriptions(conn: sqlite3.Connection) -> int:
     """
@@ -156,7 +157,7 @@ def get_paginated_embeddings_for_descriptions(conn: sqlite3.Connection, page_siz
         results = c.fetchmany(page_size)
         if not results:
             break
-        yield {appid: pickle.loads(embedding) for appid, embedding in results}
+        yield {appid: embedding_codec.decode_embeddings(embedding) for appid, embedding in results}
 
     c.close()
 
@@ -204,7 +205,7 @@ def get_paginated_embeddings_for_reviews(conn: sqlite3.Connection, page_size = 1
         results = c.fetchmany(page_size)
         if not results:
             break
-        yield {recommendationid: pickle.loads(embedding) for recommendationid, embedding in results}
+        yield {recommendationid: embedding_codec.decode_embeddings(embedding) for recommendationid, embedding in results}
 
     c.close()
 
@@ -301,7 +302,35 @@ def get_review_embeddings_for_appid(conn: sqlite3.Connection, appid: int) -> Dic
 
     c.close()
 
-    return {recommendationid: pickle.loads(embedding) for recommendationid, embedding in results}
+    return {recommendationid: embedding_codec.decode_embeddings(embedding) for recommendationid, embedding in results}
+
+def get_review_duplicate_counts_for_appid(conn: sqlite3.Connection, appid: int) -> Dict[int, int]:
+    """
+    Gets how many near-duplicate reviews of an appid share each review's embedding, see 02_embeddingdataset.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the SQLite database.
+        appid (int): The appid to get the near-duplicate counts for.
+
+    Returns:
+        Dict[int, int]: The number of near-duplicates by representative recommendationid, empty if reviews were never deduplicated.
+    """
+
+    if not check_table(conn, 'review_duplicates'):
+        return {}
+
+    c = conn.cursor()
+
+    c.execute('''
+        SELECT representative_recommendationid, count(*) FROM review_duplicates
+        WHERE appid = ?
+        GROUP BY representative_recommendationid
+    ''', (appid,))
+    results = c.fetchall()
+
+    c.close()
+
+    return {recommendationid: count for recommendationid, count in results}
 
 def database_has_indexes_available(conn: sqlite3.Connection) -> bool:
     """
@@ -2,7 +2,7 @@
 from flask import Flask, request
 from instructor_model import InstructorModel
 import sqlite_helpers
-from typing import List
+from typing import Dict, List
 import logging
 import numpy as np
 import json
@@ -148,7 +148,17 @@ def cosine_similarity(a: List[float], b: List[float]) -> float:
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
 def mean_pooling(embeddings: List[List[float]]) -> List[float]:
-    return np.sum(embeddings, axis=0) / len(embeddings)
+    return np.sum(embeddings, axis=0, dtype=np.float32) / len(embeddings)
+
+def pool_review_embeddings(embeddings: Dict[int, List[List[float]]], duplicate_counts: Dict[int, int] = {}) -> List[float]:
+    # Pools like 03_hnsw-index, so the query vector of a game matches the vector indexed for it.
+    # Near-duplicate reviews have no embedding of their own, their representative counts once for each of them
+    flat_embeddings = [review_embedding for review_id in embeddings for review_embedding in embeddings[review_id]]
+    if len(duplicate_counts) == 0:
+        return mean_pooling(flat_embeddings)
+
+    weights = [1 + duplicate_counts.get(review_id, 0) for review_id in embeddings for _ in embeddings[review_id]]
+    return np.average(np.asarray(flat_embeddings, dtype=np.float32), axis=0, weights=np.asarray(weights, dtype=np.float32))
 
 def compare_all_embeddings_take_max(embeddings: List[List[float]], query_embed: List[float]) -> float:
     similarities = [cosine_similarity(embedding, query_embed) for embedding in embeddings]
@@ -283,8 +293,7 @@ def index_search_similar(conn, query_appid, query_for_type, max_results=10):
         
         query_review_embeddings = sqlite_helpers.get_review_embeddings_for_appid(conn, query_appid)
         logging.info(f"Basing review query on {len(query_review_embeddings)} user reviews.")
-        query_flat_embeddings = [review_embedding for review_id in query_review_embeddings for review_embedding in query_review_embeddings[review_id]]
-        query_embed = mean_pooling(query_flat_embeddings)
+        query_embed = pool_review_embeddings(query_review_embeddings, sqlite_helpers.get_review_duplicate_counts_for_appid(conn, query_appid))
 
         appids, distances = review_index.knn_query(query_embed, k=max_results + 1)
 
@@ -318,16 +327,14 @@ def index_search_similar(conn, query_appid, query_for_type, max_results=10):
             query_embed = mean_pooling(all_description_embeddings)
         elif len(all_description_embeddings) == 0:
             logging.info(f"No description found for {sqlite_helpers.get_name_for_appid(conn, query_appid)}")
-            flat_embeddings = [review_embedding for review_id in all_review_embeddings for review_embedding in all_review_embeddings[review_id]]
-            query_embed = mean_pooling(flat_embeddings)
+            query_embed = pool_review_embeddings(all_review_embeddings, sqlite_helpers.get_review_duplicate_counts_for_appid(conn, query_appid))
         else:
             # Weighted average of description and review embeddings
             review_weight = 0.7
             description_weight = 1.0 - review_weight
 
             description_embed = mean_pooling(all_description_embeddings)
-            flat_embeddings = [review_embedding for review_id in all_review_embeddings for review_embedding in all_review_embeddings[review_id]]
-            review_embed = mean_pooling(flat_embeddings)
+            review_embed = pool_review_embeddings(all_review_embeddings, sqlite_helpers.get_review_duplicate_counts_for_appid(conn, query_appid))
 
             query_embed = description_weight * description_embed + review_weight * review_embed
 